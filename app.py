@@ -10,13 +10,53 @@ import shutil
 import json
 import uuid
 import hashlib
+import hmac
+import secrets
+import sqlite3
+import threading
+import time
+import errno
+import fcntl
+import struct
+import functools
+import mmap
+import bisect
+import base64
+import ctypes
+import ctypes.util
+import select
+import heapq
+import re
+import math
+import random
+import ipaddress
+import atexit
+import cProfile
+import pstats
+import io
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from urllib.parse import quote, unquote
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
-from flask import Flask, request, jsonify, send_file, render_template_string, session, redirect, url_for
+from flask import Flask, request, jsonify, send_file, render_template_string, session, redirect, url_for, Response, g
 from flask_cors import CORS
 from functools import wraps
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装 Pillow 时不提供缩略图，前端回退为图标
+    Image = None
+
+try:
+    import blake3
+except ImportError:  # 未安装 blake3 时使用 SHA-256 计算内容校验和
+    blake3 = None
+
 app = Flask(__name__)
 CORS(app)
 
@@ -27,6 +67,107 @@ SHARES_FOLDER = 'shares'
 MAX_CONTENT_LENGTH = 20 * 1024 * 1024 * 1024  # 20GB 最大文件大小
 ALLOWED_EXTENSIONS = set()  # 允许所有文件类型
 TOTAL_STORAGE = 500 * 1024 * 1024 * 1024  # 500GB 总存储空间
+DB_PATH = 'netdisk.db'  # 元数据库（SQLite）
+STORAGE_LAYOUT = 'flat'  # 物理存储布局：'flat' 按逻辑路径直接存放，'sharded' 按对象ID哈希分片存放（适合超大平铺目录）
+OBJECTS_FOLDER = 'objects'  # 分片布局下的对象存储目录
+ARCHIVES_FOLDER = 'archives'  # 后台打包任务生成的压缩包
+LOCKS_FOLDER = 'locks'  # 进程间互斥用的锁文件
+METRICS_FOLDER = 'metrics'  # 各进程的指标快照，/metrics 汇总所有进程
+PROFILES_FOLDER = 'profiles'  # 按请求采集的性能剖析结果（pstats 格式）
+PROFILE_KEEP = 100  # 最多保留的剖析结果数，超出后删除最早的
+METRICS_FLUSH_INTERVAL = float(os.environ.get('NETDISK_METRICS_FLUSH_INTERVAL', 5))  # 指标快照写入间隔（秒），负载测试会调小以便按统计窗口计算忙碌率
+METRICS_TOKEN = None  # 设置后 Prometheus 可用 Authorization: Bearer <token> 抓取 /metrics，否则需管理员登录
+TRANSFER_MIN_SIZE = 1024 * 1024  # 小于该大小的上传下载不登记为传输（需要限速时仍登记，但不在传输列表中显示）
+TRANSFER_UPDATE_INTERVAL = 1.0  # 传输进度写入数据库、推送给浏览器的间隔（秒）
+TRANSFER_DB_TIMEOUT = 1.0  # 登记传输时等待数据库写锁的最长时间（秒），超时则该传输不登记
+TRANSFER_STREAM_MAX = 60  # 传输进度推送（SSE）单次连接的最长时间，之后浏览器自动重连；同步工作进程在连接期间被占用
+# 带宽限制（字节/秒，None 为不限）：按方向分别设置全局、每个用户（未登录的按客户端IP）和每个分享链接的上限。
+# 作用于所有请求体和响应体（与 TRANSFER_MIN_SIZE 无关），上限按优先级权重分给所有进程中进行中的传输
+BANDWIDTH_GLOBAL = {'download': None, 'upload': None}
+BANDWIDTH_PER_USER = {'download': None, 'upload': None}
+BANDWIDTH_PER_SHARE = None  # 每个分享链接的下载总带宽
+BANDWIDTH_PRIORITIES = {'interactive': None, 'stream': 4, 'bulk': 1}  # 优先级权重，None 表示不限速（如较大的目录列表）
+BANDWIDTH_ROUTE_PRIORITY = {'/files': 'interactive', '/view-text': 'interactive', '/thumb': 'interactive', '/stream': 'stream',
+                            '/transfers/stream': 'interactive', '/metrics': 'interactive'}  # 其余为 bulk
+BANDWIDTH_BURST = 0.5  # 令牌桶容量（按限速的秒数计），允许短时突发
+# 准入控制：所有进程合计同时处理的请求数按路由类别分池限制，池满时立即返回 503 而不是排队占用工作进程。
+# heavy（实际传输数据）与 events（长连接推送）两池合计小于 gunicorn 的并发处理能力（进程数 × 线程数），
+# 保证列表、登录等轻量请求总有工作进程可用；默认按 gunicorn_config.py 传入的 NETDISK_WORKER_SLOTS 计算
+WORKER_SLOTS = int(os.environ.get('NETDISK_WORKER_SLOTS', 16))  # 所有工作进程合计可同时处理的请求数
+ADMISSION_POOLS = {'heavy': max(2, WORKER_SLOTS // 2), 'events': max(1, WORKER_SLOTS // 4), 'light': 64}  # 每个池的并发上限，None 为不限
+ADMISSION_USER_LIMITS = {'heavy': max(1, ADMISSION_POOLS['heavy'] // 2)}  # 每个登录用户在各池中的并发上限（须小于池的上限），超出时返回 429
+ADMISSION_USER_EXEMPT_ROUTES = {'/stream'}  # 不计入用户并发上限：播放器会并发发出多个范围请求，被拒绝后不会重试
+ADMISSION_RETRY_AFTER = {'heavy': 5, 'events': 5, 'light': 1}  # 拒绝时 Retry-After 建议的秒数
+ADMISSION_HEAVY_ROUTES = {
+    '/upload', '/download', '/batch-download', '/stream', '/share/<share_id>/download', '/jobs/<job_id>/download',
+    '/quick-transfer-upload', '/quick-transfer-download',
+}
+ADMISSION_EVENT_ROUTES = {'/transfers/stream'}  # 长时间保持连接但不传输文件数据，不占用传输名额
+ADMISSION_EXEMPT_ROUTES = {'/metrics'}  # 不受准入控制（监控抓取在过载时也要可用）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # 耗时直方图的桶上界（秒）
+THUMBNAILS_FOLDER = 'thumbnails'  # 缩略图磁盘缓存
+JOB_WORKERS = 2  # 每个工作进程的后台任务线程数
+JOB_MAX_RUNNING = 4  # 所有进程合计同时运行的后台任务上限
+JOB_RETENTION = timedelta(days=7)  # 已结束任务（及其压缩包）保留时间
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # 无法使用 reflink/copy_file_range 时的分块复制大小
+COPY_SYNC_LIMIT = 64 * 1024 * 1024  # 小于该大小的单个文件直接在请求中复制，否则交给后台任务
+FICLONE = 0x40049409  # Linux ioctl：在 btrfs/xfs 等文件系统上创建共享数据块的副本（reflink）
+TRASH_DIR = '.trash'  # 存储根目录下的回收站（保留名称，不在列表中显示）
+INCOMING_DIR = '.incoming'  # 写入中的临时文件，完成后 rename 到最终位置（保留名称，不在列表中显示）
+TRASH_RETENTION = timedelta(days=30)  # 回收站中的文件保留时间，到期后自动清除
+TRASH_PURGE_BATCH = 500  # 后台清除时每批删除的文件数
+TRASH_PURGE_PAUSE = 0.05  # 每批之间的停顿（秒），避免清除大目录时占满磁盘IO
+THUMB_SIZES = (128, 256, 512)  # 缩略图尺寸档位（长边像素），请求的尺寸向上取整到档位
+THUMB_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+THUMB_WORKERS = 2  # 每个工作进程用于生成缩略图的子进程数
+THUMB_PREFETCH_LIMIT = 200  # 单次预取的最大图片数
+THUMB_CACHE_LIMIT = 2 * 1024 * 1024 * 1024  # 缩略图缓存上限，超出后淘汰最久未访问的
+# 可在线播放/预览的媒体类型（其余类型不以 inline 方式提供，避免浏览器直接渲染 HTML 等内容）
+STREAM_TYPES = {
+    '.mp4': 'video/mp4', '.m4v': 'video/mp4', '.mov': 'video/quicktime', '.webm': 'video/webm',
+    '.mkv': 'video/x-matroska', '.ogv': 'video/ogg',
+    '.mp3': 'audio/mpeg', '.m4a': 'audio/mp4', '.aac': 'audio/aac', '.wav': 'audio/wav',
+    '.flac': 'audio/flac', '.ogg': 'audio/ogg', '.opus': 'audio/ogg',
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+    '.webp': 'image/webp', '.bmp': 'image/bmp'
+}
+MP4_EXTENSIONS = {'.mp4', '.m4v', '.mov', '.m4a'}
+MP4_MAX_MOOV_SIZE = 64 * 1024 * 1024  # 超过该大小的 moov 不做前置处理
+MP4_LAYOUT_CACHE_BYTES = 128 * 1024 * 1024  # 每个工作进程缓存前置 moov 数据的总字节数上限
+MP4_LAYOUT_CACHE = 64  # 每个工作进程缓存前置布局的文件数
+STREAM_CHUNK_SIZE = 256 * 1024
+TEXT_INDEX_BLOCK = 256 * 1024  # 行索引的块大小，定位某行时至多在一个块内逐行查找
+TEXT_INDEX_CACHE = 32  # 每个工作进程缓存行索引的文件数
+TEXT_MAX_LINES = 2000  # 单次请求返回的最大行数
+TEXT_MAX_BYTES = 1024 * 1024  # 单次请求返回的最大字节数
+CHECKSUM_ALGORITHM = 'blake3' if blake3 is not None else 'sha256'
+HASH_BUFFER_SIZE = 1024 * 1024
+UPLOAD_WRITE_BUFFER = 1024 * 1024  # 上传写入的缓冲区大小
+UPLOAD_FLUSH_BYTES = 64 * 1024 * 1024  # 每写入这么多数据启动一次回写，避免关闭文件时集中刷出几 GB 脏页
+UPLOAD_DURABILITY = 'fsync'  # 'none' 交给内核回写；'fsync' 完成时 fsync 文件；'fsync-dir' 同时 fsync 所在目录
+SCRUB_INTERVAL = timedelta(days=30)  # 每个文件的复验周期
+SCRUB_RATE = 32 * 1024 * 1024  # 复验读取速率上限（字节/秒），避免与正常下载争抢磁盘
+SCRUB_BATCH = 100
+SCRUB_DISCOVERY_INTERVAL = timedelta(days=1)  # 为尚无校验和的文件（如旧文件）补算的间隔
+DIR_STATS_RECONCILE_INTERVAL = timedelta(hours=6)  # 目录汇总与实际存储全量对账的间隔（文件监视不可用时）
+DIR_STATS_CHECK_INTERVAL = 10  # 两次对账之间检查根目录汇总是否失效的间隔（秒），失效时提前对账
+USERS_DIR = '.users'  # 普通用户的存储空间位于 .users/<用户名>，管理员 root 的空间为存储根目录
+DEFAULT_USER_QUOTA = 20 * 1024 * 1024 * 1024  # 新建用户的默认配额
+UPLOAD_DISK_HEADROOM = 1024 * 1024 * 1024  # 上传后磁盘至少保留的剩余空间
+WATCHER_ENABLED = True  # 平铺布局下用 inotify 监视 uploads/，感知绕过应用的修改（如直接 rsync）
+WATCH_DEBOUNCE = 1.0  # 事件静默多久后统一处理（秒）
+WATCH_MAX_DELAY = 10.0  # 事件持续不断时最长多久处理一次（秒）
+PASSWORD_SCRYPT = {'n': 2 ** 14, 'r': 8, 'p': 1}  # 密码哈希参数（约 16MB 内存），调整后旧哈希在用户下次登录时自动升级
+LOGIN_HASH_CONCURRENCY = 2  # 每个工作进程同时计算密码哈希的上限，超出时直接拒绝，避免登录请求耗尽 CPU
+SESSION_LIFETIME = timedelta(days=7)  # 会话在最后一次访问后的有效期
+SESSION_TOUCH_INTERVAL = 60  # 最后访问时间的更新间隔（秒），避免每个请求都写数据库
+LOGIN_WINDOW = timedelta(hours=24)  # 登录失败计数的滑动窗口
+LOGIN_MAX_FAILURES = 10  # 窗口内单个IP允许的登录失败次数
+LOGIN_SUBNET_MAX_FAILURES = 50  # 窗口内同一网段（IPv4 /24、IPv6 /64）合计允许的失败次数，None 为不限制
+LOGIN_THROTTLE_MAX_KEYS = 100000  # 失败计数最多保留的IP/网段数，超出后淘汰最久没有失败记录的
+RECENT_FILES_LIMIT = 200  # 每个用户的最近文件最多保留的条数
+ACTIVITY_RETENTION = timedelta(days=180)  # 活动日志保留时间
+ACTIVITY_DB_TIMEOUT = 1.0  # 记录活动时等待数据库写锁的最长时间（秒），超时则不记录，不拖住操作本身
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
@@ -37,71 +178,1191 @@ app.config['SECRET_KEY'] = 'your-secret-key-change-this-in-production'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(QUICK_TRANSFER_FOLDER, exist_ok=True)
 os.makedirs(SHARES_FOLDER, exist_ok=True)
+os.makedirs(OBJECTS_FOLDER, exist_ok=True)
+os.makedirs(ARCHIVES_FOLDER, exist_ok=True)
+os.makedirs(LOCKS_FOLDER, exist_ok=True)
+os.makedirs(os.path.join(LOCKS_FOLDER, 'admission'), exist_ok=True)
+os.makedirs(METRICS_FOLDER, exist_ok=True)
+os.makedirs(PROFILES_FOLDER, exist_ok=True)
+os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+
+# 元数据库表结构
+DB_SCHEMA = [
+    # 分片布局下的逻辑目录树：每个节点只记录父目录的节点ID（0 为根目录）和自身名称，
+    # 逻辑路径逐级查找得到，重命名/移动目录只需修改一行
+    """CREATE TABLE IF NOT EXISTS nodes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        mtime REAL NOT NULL,
+        object_id TEXT,
+        UNIQUE (parent, name)
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_nodes_object ON nodes(object_id)',
+    # 后台任务队列（跨进程共享、重启后保留）
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        progress_done INTEGER NOT NULL DEFAULT 0,
+        progress_total INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_by TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        worker_pid INTEGER
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)',
+    # 回收站条目：内容位于 .trash/<id>，到期或清空后由后台分批清除
+    """CREATE TABLE IF NOT EXISTS trash (
+        id TEXT PRIMARY KEY,
+        original_path TEXT NOT NULL,
+        name TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER,
+        deleted_by TEXT,
+        deleted_at REAL NOT NULL,
+        purge_after REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'trashed',
+        purger_pid INTEGER
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_trash_purge ON trash(status, purge_after)',
+    # 文件内容校验和（平铺布局下按逻辑路径，分片布局下按对象ID；size/mtime_ns 与当前文件不一致时视为过期）
+    """CREATE TABLE IF NOT EXISTS checksums (
+        path TEXT PRIMARY KEY,
+        algorithm TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        verified_at REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'ok'
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_checksums_verified ON checksums(verified_at)',
+    # 进行中的上传预留的空间（跨进程共享，上传结束即删除）
+    """CREATE TABLE IF NOT EXISTS upload_reservations (
+        id TEXT PRIMARY KEY,
+        username TEXT,
+        bytes INTEGER NOT NULL,
+        pid INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    # 进行中的上传和下载（跨进程共享，传输结束即删除）
+    """CREATE TABLE IF NOT EXISTS transfers (
+        id TEXT PRIMARY KEY,
+        ref TEXT,
+        username TEXT,
+        direction TEXT NOT NULL,
+        name TEXT NOT NULL,
+        route TEXT NOT NULL,
+        client TEXT,
+        total INTEGER,
+        done INTEGER NOT NULL,
+        rate REAL NOT NULL,
+        pid INTEGER NOT NULL,
+        started_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        share_id TEXT,
+        priority TEXT NOT NULL DEFAULT 'bulk',
+        metered INTEGER NOT NULL DEFAULT 1
+    )""",
+    # 按请求采集的性能剖析结果，数据文件位于 PROFILES_FOLDER/<id>.prof
+    """CREATE TABLE IF NOT EXISTS profiles (
+        id TEXT PRIMARY KEY,
+        username TEXT,
+        method TEXT NOT NULL,
+        path TEXT NOT NULL,
+        status TEXT NOT NULL,
+        duration REAL NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    # 用户：每个用户有独立的存储根目录（逻辑路径前缀）和配额
+    """CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        root TEXT NOT NULL,
+        quota INTEGER NOT NULL,
+        is_admin INTEGER NOT NULL DEFAULT 0,
+        disabled INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL
+    )""",
+    # 服务端会话：Cookie 中只保存随机令牌，表中保存其 SHA-256（主键查找），删除即撤销
+    """CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        client TEXT,
+        user_agent TEXT,
+        created_at REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)',
+    # 分享链接（所有工作进程共享、重启后保留）：files 为分享目录 path 下被分享的名称列表（JSON）
+    """CREATE TABLE IF NOT EXISTS shares (
+        id TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        root TEXT NOT NULL,
+        files TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_shares_created_by ON shares(created_by, created_at)',
+    # 登录失败的滑动窗口计数（按IP和网段，所有工作进程共享）：window 为当前固定窗口的序号，
+    # current/previous 为当前和上一个窗口的次数，估算值 = previous × 上一窗口仍在滑动窗口内的比例 + current
+    """CREATE TABLE IF NOT EXISTS login_throttle (
+        key TEXT PRIMARY KEY,
+        window INTEGER NOT NULL,
+        current INTEGER NOT NULL,
+        previous INTEGER NOT NULL,
+        last_seen REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_login_throttle_seen ON login_throttle(last_seen)',
+    # 表的行数：与对应表的增删在同一事务中更新，避免在写锁内 COUNT(*) 全表
+    """CREATE TABLE IF NOT EXISTS table_rows (
+        name TEXT PRIMARY KEY,
+        rows INTEGER NOT NULL
+    )""",
+    # 活动日志：用户对文件的操作，只追加（超过 ACTIVITY_RETENTION 的记录被清除）
+    """CREATE TABLE IF NOT EXISTS activity_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        action TEXT NOT NULL,
+        path TEXT NOT NULL,
+        name TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_activity_log_created ON activity_log(created_at)',
+    # 最近文件：每个用户每个文件一条（主键去重），seq 为对应活动日志的ID，按 seq 保留最新的 RECENT_FILES_LIMIT 条
+    """CREATE TABLE IF NOT EXISTS recent_files (
+        username TEXT NOT NULL,
+        path TEXT NOT NULL,
+        name TEXT NOT NULL,
+        action TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (username, path, name)
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_recent_files_seq ON recent_files(username, seq)',
+    # 目录汇总：目录（含所有子目录）下的文件总大小与文件数，'' 为根目录；
+    # 平铺布局下按逻辑路径，分片布局下按 '@节点ID'（见 dir_stats_key）
+    """CREATE TABLE IF NOT EXISTS dir_stats (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        files INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+]
+
+# 已有数据库补充的列：(表, 列, 定义)
+DB_MIGRATIONS = [
+    ('transfers', 'share_id', 'TEXT'),
+    ('transfers', 'priority', "TEXT NOT NULL DEFAULT 'bulk'"),
+    ('transfers', 'metered', 'INTEGER NOT NULL DEFAULT 1'),
+]
+
+_db_local = threading.local()
+
+def get_db():
+    """获取当前线程的元数据库连接（按进程和线程缓存）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+        _db_local.depth = 0
+    return conn
+
+@contextmanager
+def db_busy_timeout(seconds):
+    """临时缩短当前连接等待写锁的时间，用于失败也无妨、但不能拖住请求的写入（如传输登记）"""
+    conn = get_db()
+    conn.execute(f'PRAGMA busy_timeout = {int(seconds * 1000)}')
+    try:
+        yield conn
+    finally:
+        conn.execute('PRAGMA busy_timeout = 30000')
+
+@contextmanager
+def db_transaction():
+    """元数据库写事务，支持嵌套（内层并入外层事务）"""
+    conn = get_db()
+    if _db_local.depth > 0:
+        _db_local.depth += 1
+        try:
+            yield conn
+        finally:
+            _db_local.depth -= 1
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    _db_local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+    finally:
+        _db_local.depth = 0
+
+# 密码以加盐的 scrypt 哈希保存：scrypt$n$r$p$盐$哈希（十六进制）。
+# 旧版本的无盐 SHA-256 哈希仍可验证，登录成功后自动升级
+
+def hash_password(password):
+    """计算密码哈希"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, dklen=32, maxmem=64 * 1024 * 1024, **PASSWORD_SCRYPT)
+    return f"scrypt${PASSWORD_SCRYPT['n']}${PASSWORD_SCRYPT['r']}${PASSWORD_SCRYPT['p']}${salt.hex()}${digest.hex()}"
 
-# 存储分享信息的字典
-shares_data = {}
+def verify_password(stored, password):
+    """验证密码（比较用常数时间）"""
+    if not stored.startswith('scrypt$'):
+        return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
+    _, n, r, p, salt, digest = stored.split('$')
+    computed = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p),
+                              dklen=len(digest) // 2, maxmem=64 * 1024 * 1024)
+    return hmac.compare_digest(computed.hex(), digest)
 
-# 存储最近使用的文件
-recent_files = []
+def password_needs_upgrade(stored):
+    """是否为旧格式或参数已调整的哈希"""
+    params = PASSWORD_SCRYPT
+    return not stored.startswith(f"scrypt${params['n']}${params['r']}${params['p']}$")
 
-# 用户数据（生产环境应使用数据库）
-users = {
-    'root': {
-        'password': hashlib.sha256('qaz341212'.encode()).hexdigest(),
-        'username': 'root'
+@functools.lru_cache(maxsize=1)
+def dummy_password_hash():
+    """用户不存在时也计算一次哈希，响应时间不会暴露用户名是否存在"""
+    return hash_password(secrets.token_hex(16))
+
+def init_db():
+    """初始化元数据库"""
+    conn = sqlite3.connect(DB_PATH)
+    for statement in DB_SCHEMA:
+        conn.execute(statement)
+    for table, column, definition in DB_MIGRATIONS:
+        if column not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+            try:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError:
+                pass  # 其他工作进程同时启动，已经加上了
+    # 旧数据库没有行数记录，统计一次
+    conn.execute("INSERT OR IGNORE INTO table_rows (name, rows) SELECT 'login_throttle', COUNT(*) FROM login_throttle")
+    # 内置管理员（原单用户模式下的账号），其存储空间即原来的整个 uploads/
+    if conn.execute("SELECT 1 FROM users WHERE username = 'root'").fetchone() is None:
+        conn.execute(
+            "INSERT OR IGNORE INTO users (username, password, root, quota, is_admin, created_at) VALUES ('root', ?, '', ?, 1, ?)",
+            (hash_password('qaz341212'), TOTAL_STORAGE, time.time())
+        )
+    conn.commit()
+    conn.close()
+
+init_db()
+
+def get_share(share_id):
+    """查询分享信息，不存在时返回None"""
+    row = get_db().execute('SELECT * FROM shares WHERE id = ?', (share_id,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'path': row['path'],
+        'root': row['root'],
+        'files': json.loads(row['files']),
+        'created_at': datetime.fromtimestamp(row['created_at']).isoformat(),
+        'created_by': row['created_by']
     }
-}
 
-# 登录失败记录 {IP: {'count': 失败次数, 'last_attempt': 最后尝试时间}}
-failed_logins = {}
+# 本进程同时计算密码哈希的名额
+login_hash_slots = threading.BoundedSemaphore(LOGIN_HASH_CONCURRENCY)
 
 def allowed_file(filename):
     """检查文件是否允许上传（目前允许所有文件）"""
     return True
 
 def get_client_ip():
-    """获取客户端IP地址"""
+    """获取客户端IP地址（X-Forwarded-For 取反向代理追加的最后一跳，前面的可由客户端伪造）"""
     if request.headers.get('X-Forwarded-For'):
-        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
+        return request.headers.get('X-Forwarded-For').split(',')[-1].strip()
     elif request.headers.get('X-Real-IP'):
         return request.headers.get('X-Real-IP')
     else:
         return request.remote_addr
 
-def is_ip_blocked(ip):
-    """检查IP是否被封禁"""
-    if ip not in failed_logins:
-        return False
-    
-    login_data = failed_logins[ip]
-    last_attempt = datetime.fromisoformat(login_data['last_attempt'])
-    
-    # 如果是新的一天，重置计数
-    if datetime.now().date() > last_attempt.date():
-        failed_logins[ip] = {'count': 0, 'last_attempt': datetime.now().isoformat()}
-        return False
-    
-    return login_data['count'] >= 10
+# 登录限制：每个IP及其所在网段各有一个滑动窗口计数（login_throttle 表），
+# 检查只需按主键读两行；表的大小有上限，超出时淘汰最久没有失败记录的IP/网段
+
+def throttle_keys(ip):
+    """IP对应的计数键及其上限"""
+    keys = [(f'ip:{ip}', LOGIN_MAX_FAILURES)]
+    if LOGIN_SUBNET_MAX_FAILURES is not None:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return keys
+        prefix = 24 if address.version == 4 else 64
+        keys.append((f'net:{ipaddress.ip_network(f"{ip}/{prefix}", strict=False)}', LOGIN_SUBNET_MAX_FAILURES))
+    return keys
+
+def window_counts(row, now):
+    """滚动到当前窗口后的 (窗口序号, current, previous, 当前窗口已过去的比例)"""
+    length = LOGIN_WINDOW.total_seconds()
+    window = int(now // length)
+    elapsed = now / length - window
+    if row is None or row['window'] < window - 1:
+        return window, 0, 0, elapsed
+    if row['window'] == window - 1:
+        return window, 0, row['current'], elapsed
+    return window, row['current'], row['previous'], elapsed
+
+def login_retry_after(ip):
+    """IP被限制登录时返回需要等待的秒数，否则返回0"""
+    now = time.time()
+    length = LOGIN_WINDOW.total_seconds()
+    conn = get_db()
+    wait = 0
+    for key, limit in throttle_keys(ip):
+        row = conn.execute('SELECT * FROM login_throttle WHERE key = ?', (key,)).fetchone()
+        _, current, previous, elapsed = window_counts(row, now)
+        if previous * (1 - elapsed) + current < limit:
+            continue
+        if current < limit:
+            # 上一窗口的次数随时间线性滑出
+            wait = max(wait, ((1 - (limit - current) / previous) - elapsed) * length)
+        else:
+            # 要等当前窗口结束，本窗口的次数再滑出一部分
+            wait = max(wait, (1 - elapsed + 1 - limit / current) * length)
+    return math.ceil(wait)
 
 def record_failed_login(ip):
-    """记录登录失败"""
-    if ip not in failed_logins:
-        failed_logins[ip] = {'count': 0, 'last_attempt': datetime.now().isoformat()}
-    
-    failed_logins[ip]['count'] += 1
-    failed_logins[ip]['last_attempt'] = datetime.now().isoformat()
+    """记录登录失败，返回该IP在窗口内还可尝试的次数"""
+    now = time.time()
+    remaining = LOGIN_MAX_FAILURES
+    added = 0
+    with db_transaction() as conn:
+        for key, limit in throttle_keys(ip):
+            row = conn.execute('SELECT * FROM login_throttle WHERE key = ?', (key,)).fetchone()
+            window, current, previous, elapsed = window_counts(row, now)
+            current += 1
+            conn.execute(
+                'INSERT OR REPLACE INTO login_throttle (key, window, current, previous, last_seen) VALUES (?, ?, ?, ?, ?)',
+                (key, window, current, previous, now)
+            )
+            added += row is None
+            if key.startswith('ip:'):
+                remaining = max(0, limit - math.ceil(previous * (1 - elapsed) + current))
+        if added:
+            # 只有新键会让表超出上限：行数记在 table_rows 中，超出多少就按 last_seen 淘汰多少个最旧的键
+            conn.execute("UPDATE table_rows SET rows = rows + ? WHERE name = 'login_throttle'", (added,))
+            rows = conn.execute("SELECT rows FROM table_rows WHERE name = 'login_throttle'").fetchone()[0]
+            if rows > LOGIN_THROTTLE_MAX_KEYS:
+                deleted = conn.execute(
+                    'DELETE FROM login_throttle WHERE key IN (SELECT key FROM login_throttle ORDER BY last_seen LIMIT ?)',
+                    (rows - LOGIN_THROTTLE_MAX_KEYS,)
+                ).rowcount
+                conn.execute("UPDATE table_rows SET rows = rows - ? WHERE name = 'login_throttle'", (deleted,))
+    return remaining
 
 def login_required(f):
     """登录验证装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if 'user_id' not in session or current_user() is None:
+            session.clear()  # 用户已被停用或删除
             if request.is_json:
                 return jsonify({'success': False, 'message': '请先登录', 'redirect': '/login'})
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    """管理员权限装饰器（需同时使用 login_required）"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user()['is_admin']:
+            return jsonify({'success': False, 'message': '需要管理员权限'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+# 用户与存储空间：每个用户只能访问自己根目录下的逻辑路径，用量直接读取根目录的汇总（O(1)）
+
+USERNAME_PATTERN = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]{0,31}$')
+
+def get_user(username):
+    """查询用户，不存在或已停用时返回None"""
+    if not username:
+        return None
+    row = get_db().execute('SELECT * FROM users WHERE username = ? AND disabled = 0', (username,)).fetchone()
+    return row
+
+def current_user():
+    """当前登录用户（每个请求只查询一次）"""
+    if 'current_user' not in g:
+        g.current_user = session_user(session.get('sid'))
+    return g.current_user
+
+# 服务端会话：密码哈希只在登录时计算一次，之后每个请求按令牌的 SHA-256 主键查找会话并取出用户（一次查询），
+# 删除会话行即可撤销（退出登录、修改密码、停用用户），所有工作进程立即生效
+
+def session_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_session(username):
+    """创建会话，返回写入 Cookie 的令牌；顺便清理已过期的会话"""
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    conn = get_db()
+    conn.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+    conn.execute(
+        'INSERT INTO sessions (id, username, client, user_agent, created_at, last_seen, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (session_digest(token), username, get_client_ip(), request.headers.get('User-Agent', '')[:255],
+         now, now, now + SESSION_LIFETIME.total_seconds())
+    )
+    return token
+
+def session_user(token):
+    """令牌对应的有效会话的用户，会话不存在、已过期或用户已停用时返回None"""
+    if not token:
+        return None
+    now = time.time()
+    conn = get_db()
+    row = conn.execute(
+        'SELECT users.*, sessions.id AS session_id, sessions.last_seen AS session_last_seen FROM sessions '
+        'JOIN users ON users.username = sessions.username WHERE sessions.id = ? AND sessions.expires_at > ? AND users.disabled = 0',
+        (session_digest(token), now)
+    ).fetchone()
+    if row is not None and now - row['session_last_seen'] > SESSION_TOUCH_INTERVAL:
+        try:
+            conn.execute('UPDATE sessions SET last_seen = ?, expires_at = ? WHERE id = ?',
+                         (now, now + SESSION_LIFETIME.total_seconds(), row['session_id']))
+        except sqlite3.OperationalError:
+            pass  # 数据库繁忙时下次再更新
+    return row
+
+def revoke_sessions(username, keep=None):
+    """撤销用户的所有会话（keep 为保留的会话ID）"""
+    get_db().execute('DELETE FROM sessions WHERE username = ? AND id IS NOT ?', (username, keep))
+
+def user_root(username=None):
+    """用户存储根目录的逻辑路径，未指定时为当前用户"""
+    user = current_user() if username is None else get_user(username)
+    if user is None:
+        raise PermissionError('用户不存在或已停用')
+    return user['root']
+
+def user_path(*parts):
+    """当前用户空间内的逻辑路径，越界时返回None"""
+    return normalize_path(*parts, root=user_root())
+
+def display_path(path, root):
+    """去掉用户根目录前缀，得到用户看到的路径"""
+    if root and (path == root or path.startswith(root + '/')):
+        return path[len(root) + 1:]
+    return path
+
+def user_usage(user):
+    """用户已用空间：根目录汇总减去其中不属于该用户的部分（管理员根目录下的其他用户空间和回收站）；
+    汇总尚未统计时返回 None"""
+    if user['root']:
+        return tree_totals(user['root'])[0]
+    sizes = [tree_totals(path)[0] for path in ('', USERS_DIR, TRASH_DIR, INCOMING_DIR)]
+    if None in sizes:
+        return None
+    return sizes[0] - sum(sizes[1:])
+
+QUOTA_PENDING_MESSAGE = '正在统计已用空间，请稍后重试'
+
+def quota_error(user, incoming):
+    """写入 incoming 字节前的配额检查，允许时返回 None，否则返回拒绝原因。
+    已用空间尚未统计（升级后或汇总失效后，对账完成前）时拒绝写入，不按未知放行"""
+    used = user_usage(user)
+    if used is None:
+        return QUOTA_PENDING_MESSAGE
+    if used + incoming > user['quota']:
+        return '存储空间不足，超出配额'
+    return None
+
+# 上传预检：在读取请求体之前，根据声明的大小检查配额和磁盘剩余空间，并为进行中的上传预留空间
+
+class UploadRejected(Exception):
+    """上传因配额或磁盘空间不足被拒绝"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def declared_upload_size():
+    """请求声明的上传大小：Content-Length 与前端提供的 X-Upload-Size 中较大者（不读取请求体）。
+    没有 Content-Length（如分块传输）时请求体大小无法预先确定，拒绝上传"""
+    if request.content_length is None:
+        raise UploadRejected('上传请求缺少 Content-Length', 411)
+    return max(request.content_length, request.headers.get('X-Upload-Size', 0, type=int))
+
+def disk_free_bytes():
+    """存储所在文件系统的可用空间"""
+    stat = os.statvfs(OBJECTS_FOLDER if STORAGE_LAYOUT == 'sharded' else UPLOAD_FOLDER)
+    return stat.f_bavail * stat.f_frsize
+
+@contextmanager
+def reserve_upload_space(user, size):
+    """检查并预留上传空间，上传结束后释放；user 为 None 时只检查磁盘（如快传）"""
+    reservation_id = uuid.uuid4().hex
+    with db_transaction() as conn:
+        # 清理已退出进程遗留的预留
+        for row in conn.execute('SELECT DISTINCT pid FROM upload_reservations').fetchall():
+            if not process_alive(row['pid']):
+                conn.execute('DELETE FROM upload_reservations WHERE pid = ?', (row['pid'],))
+        
+        # 已用空间与预留在同一个写事务中读取，并发上传不会基于同一份旧数据同时通过检查
+        if user is not None:
+            reserved = conn.execute(
+                'SELECT COALESCE(SUM(bytes), 0) FROM upload_reservations WHERE username = ?', (user['username'],)
+            ).fetchone()[0]
+            message = quota_error(user, reserved + size)
+            if message is not None:
+                raise UploadRejected(message, 503 if message == QUOTA_PENDING_MESSAGE else 413)
+        reserved_total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM upload_reservations').fetchone()[0]
+        if disk_free_bytes() - reserved_total - UPLOAD_DISK_HEADROOM < size:
+            raise UploadRejected('服务器磁盘空间不足', 507)
+        
+        conn.execute(
+            'INSERT INTO upload_reservations (id, username, bytes, pid, created_at) VALUES (?, ?, ?, ?, ?)',
+            (reservation_id, user['username'] if user else None, size, os.getpid(), time.time())
+        )
+    try:
+        yield
+    finally:
+        get_db().execute('DELETE FROM upload_reservations WHERE id = ?', (reservation_id,))
+
+# 指标：每个进程在内存中累计，定期写入 METRICS_FOLDER/<pid>.json，/metrics 汇总所有进程（Prometheus 文本格式）。
+# 已退出进程的计数器和直方图并入 retired.json，工作进程被 gunicorn 回收后计数不会倒退。
+
+METRIC_TYPES = {
+    # 名称: (类型, 说明)
+    'netdisk_http_requests_total': ('counter', '按路由、方法和状态码统计的请求数'),
+    'netdisk_http_request_duration_seconds': ('histogram', '请求耗时，计到响应体发送完毕'),
+    'netdisk_http_requests_in_flight': ('gauge', '正在处理的请求数'),
+    'netdisk_upload_bytes_total': ('counter', '读取的请求体字节数'),
+    'netdisk_download_bytes_total': ('counter', '发送的响应体字节数'),
+    'netdisk_transfers_in_flight': ('gauge', '进行中的上传/下载传输数'),
+    'netdisk_bandwidth_wait_seconds_total': ('counter', '传输因带宽限制而等待的累计时间'),
+    'netdisk_admission_in_use': ('gauge', '各准入池中正在处理的请求数'),
+    'netdisk_admission_capacity': ('gauge', '各准入池的并发上限'),
+    'netdisk_admission_rejected_total': ('counter', '因准入池已满（pool）或用户并发超限（user）被拒绝的请求数'),
+    'netdisk_zip_build_seconds': ('histogram', '生成 zip 压缩包的耗时'),
+    'netdisk_function_duration_seconds': ('histogram', '目录遍历、汇总扫描等存储操作的耗时'),
+    'netdisk_cache_requests_total': ('counter', '缓存查询次数，result 为 hit 或 miss'),
+    'netdisk_worker_busy_seconds_total': ('counter', '进程中有请求在处理的累计时间'),
+    'netdisk_worker_uptime_seconds_total': ('counter', '进程累计运行时间，busy 与其增长率之比即忙碌率'),
+    'netdisk_workers': ('gauge', '存活的进程数'),
+}
+
+class MetricsRegistry:
+    """本进程的指标，键为 (名称, 标签元组)；直方图的值为 [各桶计数..., +Inf 桶计数, 总和, 次数]"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.started = time.time()
+        self.in_flight = 0
+        self.busy = 0.0
+        self.busy_since = None
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    def request_started(self):
+        with self.lock:
+            if self.in_flight == 0:
+                self.busy_since = time.time()
+            self.in_flight += 1
+    
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.busy += time.time() - self.busy_since
+                self.busy_since = None
+    
+    def snapshot(self):
+        """当前进程的全部指标：[(名称, 标签字典, 值)]"""
+        now = time.time()
+        with self.lock:
+            busy = self.busy + (now - self.busy_since if self.busy_since else 0)
+            items = [(name, dict(labels), value) for (name, labels), value in self.values.items()]
+            items.append(('netdisk_http_requests_in_flight', {}, self.in_flight))
+        items.append(('netdisk_worker_busy_seconds_total', {}, busy))
+        items.append(('netdisk_worker_uptime_seconds_total', {}, now - self.started))
+        return items
+    
+    def flush(self):
+        """写入本进程的指标快照（先写临时文件再替换，汇总时不会读到一半）"""
+        if not os.path.isdir(METRICS_FOLDER):
+            return  # 工作目录已被删除（如基准测试结束后清理临时目录）
+        target = os.path.join(METRICS_FOLDER, f'{os.getpid()}.json')
+        with open(target + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(target + '.tmp', target)
+
+metrics = MetricsRegistry()
+
+def timed(func):
+    """装饰器：记录函数耗时到 netdisk_function_duration_seconds"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe('netdisk_function_duration_seconds', time.perf_counter() - started, function=func.__name__)
+    return wrapper
+
+def merge_metrics(totals, items, include_gauges=True):
+    """把一个进程的指标累加到 totals：{(名称, 标签元组): 值}"""
+    for name, labels, value in items:
+        if not include_gauges and METRIC_TYPES[name][0] == 'gauge':
+            continue
+        key = (name, tuple(sorted(labels.items())))
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            totals[key] = [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = current + value
+
+def collect_metrics():
+    """汇总所有进程的指标；顺便把已退出进程的快照并入 retired.json"""
+    metrics.flush()
+    retired_path = os.path.join(METRICS_FOLDER, 'retired.json')
+    with open(os.path.join(LOCKS_FOLDER, 'metrics.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(retired_path) as f:
+                retired = json.load(f)
+        except (OSError, ValueError):
+            retired = []
+        totals, live, dead = {}, 0, []
+        for name in os.listdir(METRICS_FOLDER):
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(METRICS_FOLDER, name)) as f:
+                    items = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if process_alive(int(pid)):
+                merge_metrics(totals, items)
+                live += 1
+            else:
+                dead.append((name, items))
+        if dead:
+            # 计数器和直方图保留，仪表随进程一起消失
+            merged = {}
+            merge_metrics(merged, retired)
+            for name, items in dead:
+                merge_metrics(merged, items, include_gauges=False)
+            retired = [(name, dict(labels), value) for (name, labels), value in merged.items()]
+            with open(retired_path + '.tmp', 'w') as f:
+                json.dump(retired, f)
+            os.replace(retired_path + '.tmp', retired_path)
+            for name, _ in dead:
+                os.remove(os.path.join(METRICS_FOLDER, name))
+    merge_metrics(totals, retired)
+    totals[('netdisk_workers', ())] = live
+    for pool, capacity in ADMISSION_POOLS.items():
+        if capacity is not None:
+            totals[('netdisk_admission_capacity', (('pool', pool),))] = capacity
+    return totals
+
+def format_labels(labels, extra=()):
+    """格式化标签，值中的反斜杠、引号和换行需要转义"""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render_metrics(totals):
+    """按 Prometheus 文本格式输出"""
+    lines = []
+    for name, (kind, help_text) in METRIC_TYPES.items():
+        series = sorted((labels, value) for (metric, labels), value in totals.items() if metric == name)
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 BANDWIDTH_BURST 秒的量；令牌不足时等待到补足为止"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * BANDWIDTH_BURST
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate * BANDWIDTH_BURST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+    
+    def consume(self, n):
+        """取走 n 个令牌（允许透支，下次补足），返回等待的秒数"""
+        self.refill()
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0
+        wait = -self.tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+def bandwidth_limited(direction):
+    """该方向是否设置了任何带宽上限"""
+    return any(limit is not None for limit in (
+        BANDWIDTH_GLOBAL.get(direction), BANDWIDTH_PER_USER.get(direction),
+        BANDWIDTH_PER_SHARE if direction == 'download' else None))
+
+def bandwidth_priority(environ):
+    """按路由确定传输的优先级"""
+    return BANDWIDTH_ROUTE_PRIORITY.get(environ.get('netdisk.route'), 'bulk')
+
+def bandwidth_shaped(environ, direction):
+    """该请求这个方向的数据是否需要限速（不论大小）"""
+    return bandwidth_limited(direction) and BANDWIDTH_PRIORITIES.get(bandwidth_priority(environ)) is not None
+
+def bandwidth_allocation(transfer_id, direction):
+    """该传输当前可用的带宽（字节/秒），None 表示不限速。
+    每个上限按优先级权重分给所有进程中共用该上限的活跃传输（长时间没有进展的不参与分配）"""
+    rows = get_db().execute(
+        'SELECT id, username, client, share_id, priority FROM transfers WHERE direction = ? AND (id = ? OR updated_at > ?)',
+        (direction, transfer_id, time.time() - TRANSFER_UPDATE_INTERVAL * 10)
+    ).fetchall()
+    me = next((row for row in rows if row['id'] == transfer_id), None)
+    weight = BANDWIDTH_PRIORITIES.get(me['priority']) if me is not None else None
+    if weight is None:
+        return None
+    owner = me['username'] or me['client']
+    rate = None
+    for limit, shares_limit in (
+            (BANDWIDTH_GLOBAL.get(direction), lambda row: True),
+            (BANDWIDTH_PER_USER.get(direction), lambda row: (row['username'] or row['client']) == owner),
+            (BANDWIDTH_PER_SHARE if direction == 'download' and me['share_id'] else None,
+             lambda row: row['share_id'] == me['share_id'])):
+        if limit is None:
+            continue
+        total = sum(BANDWIDTH_PRIORITIES.get(row['priority']) or 0 for row in rows if shares_limit(row))
+        allocated = limit * weight / total
+        rate = allocated if rate is None else min(rate, allocated)
+    return rate
+
+class TransferTracker:
+    """一次进行中的上传或下载：进度按 TRANSFER_UPDATE_INTERVAL 节流写入 transfers 表，供各进程查询。
+    设置了带宽上限时，每次更新进度都重新计算本传输分得的带宽，并用令牌桶限制读写速度"""
+    
+    def __init__(self, environ, direction, name, total):
+        self.id = uuid.uuid4().hex
+        self.direction = direction
+        self.priority = bandwidth_priority(environ)
+        self.done = 0
+        self.rate = 0.0
+        self.reported = 0
+        self.updated = time.time()
+        self.bucket = None
+        ref = environ.get('HTTP_X_TRANSFER_ID', '')
+        get_db().execute(
+            'INSERT INTO transfers (id, ref, username, direction, name, route, client, total, done, rate, pid, started_at, updated_at, '
+            'share_id, priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0, ?, ?, ?, ?, ?)',
+            (self.id, ref[:64] or None, environ.get('netdisk.user'), direction, name[:255],
+             environ.get('netdisk.route', 'unmatched'), environ.get('netdisk.client'), total,
+             os.getpid(), self.updated, self.updated, environ.get('netdisk.share'), self.priority)
+        )
+        metrics.inc('netdisk_transfers_in_flight', direction=direction)
+        self.shaped = bandwidth_shaped(environ, direction)
+        if self.shaped:
+            self.reshape()
+    
+    def reshape(self):
+        """重新计算分得的带宽并调整令牌桶"""
+        try:
+            rate = bandwidth_allocation(self.id, self.direction)
+        except sqlite3.OperationalError:
+            return  # 数据库繁忙时沿用当前限速
+        if rate is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate)
+        else:
+            self.bucket.set_rate(rate)
+    
+    def throttle(self, n):
+        """按分得的带宽等待"""
+        if self.bucket is not None:
+            waited = self.bucket.consume(n)
+            if waited:
+                metrics.inc('netdisk_bandwidth_wait_seconds_total', waited, direction=self.direction, priority=self.priority)
+    
+    def advance(self, n):
+        self.done += n
+        self.throttle(n)
+        now = time.time()
+        if now - self.updated < TRANSFER_UPDATE_INTERVAL:
+            return
+        # 速率取指数加权平均，偶发的停顿不会让剩余时间大幅跳动
+        instant = (self.done - self.reported) / (now - self.updated)
+        self.rate = instant if not self.reported else 0.7 * self.rate + 0.3 * instant
+        self.reported, self.updated = self.done, now
+        try:
+            get_db().execute(
+                'UPDATE transfers SET done = ?, rate = ?, updated_at = ? WHERE id = ?',
+                (self.done, self.rate, now, self.id)
+            )
+        except sqlite3.OperationalError:
+            pass  # 数据库繁忙时跳过本次更新，不影响传输本身
+        if self.shaped:
+            self.reshape()
+    
+    def unmetered(self):
+        """由 sendfile 发送、无法统计逐字节进度的下载"""
+        try:
+            get_db().execute('UPDATE transfers SET metered = 0 WHERE id = ?', (self.id,))
+        except sqlite3.OperationalError:
+            pass  # 数据库繁忙时进度显示为字节数，不影响下载本身
+    
+    def finish(self):
+        metrics.inc('netdisk_transfers_in_flight', -1, direction=self.direction)
+        get_db().execute('DELETE FROM transfers WHERE id = ?', (self.id,))
+
+def start_transfer(environ, direction, name, total):
+    """登记传输，数据库写锁繁忙时返回 None：请求照常进行，只是不显示进度、不参与带宽分配。
+    登记发生在发送响应头或首次读取请求体时，只等待 TRANSFER_DB_TIMEOUT 秒，不让传输本身卡在数据库上"""
+    try:
+        with db_busy_timeout(TRANSFER_DB_TIMEOUT):
+            return TransferTracker(environ, direction, name, total)
+    except sqlite3.OperationalError:
+        return None
+
+def attachment_name(headers):
+    """从 Content-Disposition 中取出下载文件名"""
+    disposition = next((v for k, v in headers if k.lower() == 'content-disposition'), '')
+    match = re.search(r"filename\*=UTF-8''([^;]+)", disposition)
+    if match:
+        return unquote(match.group(1))
+    match = re.search(r'filename="?([^";]+)"?', disposition)
+    return match.group(1) if match else None
+
+class CountingInput:
+    """包装 wsgi.input，统计实际读取的请求体字节数；较大或需要限速的请求体在首次读取时登记为上传传输"""
+    
+    def __init__(self, stream, environ):
+        self.stream = stream
+        self.environ = environ
+        self.bytes = 0
+        self.tracker = None
+        self.trackable = True
+    
+    def counted(self, size):
+        self.bytes += size
+        if self.trackable and size:
+            # 首次读取时视图函数已开始执行，路由、用户等信息已就绪，才能判断是否限速；登记失败也不再重试
+            self.trackable = False
+            if int(self.environ.get('CONTENT_LENGTH') or 0) < TRANSFER_MIN_SIZE and not bandwidth_shaped(self.environ, 'upload'):
+                return
+            self.tracker = start_transfer(
+                self.environ, 'upload', unquote(self.environ.get('HTTP_X_TRANSFER_NAME', '')) or self.environ['PATH_INFO'],
+                int(self.environ.get('CONTENT_LENGTH') or 0) or None
+            )
+        if self.tracker is not None:
+            self.tracker.advance(size)
+    
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.counted(len(data))
+        return data
+    
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.counted(len(data))
+        return data
+    
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.counted(sum(len(line) for line in lines))
+        return lines
+    
+    def __iter__(self):
+        for line in self.stream:
+            self.counted(len(line))
+            yield line
+
+class MetricsMiddleware:
+    """WSGI 中间件：请求耗时计到响应体发送完毕，字节数按实际读写计算，较大或需要限速的上传下载登记为传输。
+    send_file 返回的 wsgi.file_wrapper 不做包装（否则 gunicorn 无法使用 sendfile），按 Content-Length 计数，
+    登记的传输只有总大小、没有逐字节进度；只有需要限速的下载才改为分块发送"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        environ['wsgi.input'] = body_in = CountingInput(environ['wsgi.input'], environ)
+        response = {'status': '500', 'length': None, 'tracker': None}
+        metrics.request_started()
+        
+        def start(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['length'] = next((int(v) for k, v in headers if k.lower() == 'content-length'), None)
+            content_type = next((v for k, v in headers if k.lower() == 'content-type'), '')
+            length = response['length']
+            if length != 0 and bandwidth_shaped(environ, 'download') or response['status'] in ('200', '206') and (
+                    (length or 0) >= TRANSFER_MIN_SIZE or (length is None and content_type.startswith('application/zip'))):
+                name = attachment_name(headers) or environ['PATH_INFO']
+                response['tracker'] = start_transfer(environ, 'download', name, length)
+            return start_response(status, headers, exc_info)
+        
+        def finish(sent):
+            # 先释放准入槽：后面的剖析保存和传输记录会读写数据库和文件，出错时槽也不能一直被占着
+            release_admission(environ)
+            route = environ.get('netdisk.route', 'unmatched')
+            try:
+                if 'netdisk.profiler' in environ:
+                    save_profile(environ, response['status'], time.perf_counter() - started)
+                for tracker in (body_in.tracker, response['tracker']):
+                    if tracker is not None:
+                        tracker.finish()
+            finally:
+                metrics.request_finished()
+                metrics.inc('netdisk_http_requests_total', route=route, method=environ['REQUEST_METHOD'], status=response['status'])
+                metrics.observe('netdisk_http_request_duration_seconds', time.perf_counter() - started, route=route)
+                metrics.inc('netdisk_upload_bytes_total', body_in.bytes, route=route)
+                metrics.inc('netdisk_download_bytes_total', sent, route=route)
+        
+        try:
+            body = self.wsgi_app(environ, start)
+        except BaseException:
+            finish(0)
+            raise
+        
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            if response['tracker'] is None or not response['tracker'].shaped:
+                if response['tracker'] is not None:
+                    response['tracker'].unmetered()
+                close = getattr(body, 'close', None)
+                def close_wrapper():
+                    try:
+                        if close is not None:
+                            close()
+                    finally:
+                        finish(response['length'] or 0)
+                body.close = close_wrapper
+                return body
+            # 需要限速时才改为分块读取；gunicorn 的 FileWrapper 为 filelike，werkzeug 的为 file
+            filelike = getattr(body, 'filelike', None) or getattr(body, 'file', None)
+            if filelike is not None:
+                return MeteredBody(body, finish, response['tracker'], iter(lambda: filelike.read(STREAM_CHUNK_SIZE), b''))
+        return MeteredBody(body, finish, response['tracker'])
+
+class MeteredBody:
+    """包装响应体迭代器，统计发送的字节数并更新下载进度，关闭时记录请求"""
+    
+    def __init__(self, body, on_close, tracker=None, chunks=None):
+        self.body = body
+        self.on_close = on_close
+        self.tracker = tracker
+        self.chunks = body if chunks is None else chunks
+        self.sent = 0
+    
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.sent += len(chunk)
+            if self.tracker is not None:
+                self.tracker.advance(len(chunk))
+            yield chunk
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.sent)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+@app.before_request
+def record_route():
+    """记录匹配到的路由模板（作为指标的 route 标签，避免按实际路径产生大量序列）以及传输记录所需的用户和客户端"""
+    if request.url_rule is not None:
+        request.environ['netdisk.route'] = request.url_rule.rule
+    request.environ['netdisk.user'] = session.get('username')
+    request.environ['netdisk.client'] = get_client_ip()
+    if request.view_args and 'share_id' in request.view_args:
+        request.environ['netdisk.share'] = request.view_args['share_id']
+
+# 准入控制：每个池在 LOCKS_FOLDER/admission 下有与上限同样多的槽文件，请求用非阻塞 flock 占住其中一个，
+# 响应体发送完毕时释放。锁在进程退出（包括被杀）时由内核释放，不会因工作进程崩溃而泄漏名额。
+
+def acquire_slot(name, capacity):
+    """占用 name 池中的一个槽，返回文件描述符；已满返回 None。
+    同一进程的不同线程也要各自打开槽文件（flock 按打开的文件区分持有者）"""
+    start = random.randrange(capacity)
+    for i in range(capacity):
+        fd = os.open(os.path.join(LOCKS_FOLDER, 'admission', f'{name}.{(start + i) % capacity}'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+def admission_pool(route):
+    """路由所属的准入池，None 表示不受限制"""
+    if route is None or route in ADMISSION_EXEMPT_ROUTES:
+        return None
+    if route in ADMISSION_HEAVY_ROUTES:
+        return 'heavy'
+    return 'events' if route in ADMISSION_EVENT_ROUTES else 'light'
+
+def release_admission(environ):
+    """释放请求占用的槽（关闭文件描述符即释放 flock）"""
+    for pool, fd in environ.pop('netdisk.admission', ()):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+        if pool is not None:
+            metrics.inc('netdisk_admission_in_use', -1, pool=pool)
+
+def admission_rejected(pool, status, message):
+    """快速拒绝：带 Retry-After；浏览器直接打开的下载链接返回自动重试的页面，其余返回 JSON"""
+    retry = ADMISSION_RETRY_AFTER.get(pool, 1)
+    metrics.inc('netdisk_admission_rejected_total', pool=pool, reason='user' if status == 429 else 'pool')
+    if request.accept_mimetypes.best == 'text/html':
+        response = Response(f'<meta charset="utf-8"><meta http-equiv="refresh" content="{retry}">'
+                            f'<p>{message}，{retry} 秒后自动重试。</p>', status, mimetype='text/html')
+    else:
+        response = jsonify({'success': False, 'message': message})
+        response.status_code = status
+    response.headers['Retry-After'] = str(retry)
+    return response
+
+@app.before_request
+def admit_request():
+    """按路由类别占用准入池的槽，池满或用户并发超限时立即拒绝"""
+    pool = admission_pool(request.environ.get('netdisk.route'))
+    capacity = ADMISSION_POOLS.get(pool)
+    if capacity is None:
+        return None
+    held = request.environ.setdefault('netdisk.admission', [])
+    username = session.get('username')
+    user_limit = ADMISSION_USER_LIMITS.get(pool)
+    if username and user_limit is not None and request.environ.get('netdisk.route') not in ADMISSION_USER_EXEMPT_ROUTES:
+        fd = acquire_slot(f'user-{username}.{pool}', user_limit)
+        if fd is None:
+            return admission_rejected(pool, 429, '同时进行的传输过多，请等待当前传输完成后重试')
+        held.append((None, fd))
+    fd = acquire_slot(pool, capacity)
+    if fd is None:
+        return admission_rejected(pool, 503, '服务器繁忙，请稍后重试')
+    held.append((pool, fd))
+    metrics.inc('netdisk_admission_in_use', pool=pool)
+    return None
+
+# 按请求的性能剖析：管理员在请求中带 X-Profile: 1 头或 _profile=1 参数时，用 cProfile 剖析该请求
+# （包括流式发送的响应体，如边读边压缩的 zip）。未带标记的请求只多一次头部/参数检查。
+
+@app.before_request
+def start_profile():
+    """请求带剖析标记且为管理员时开始剖析"""
+    if request.headers.get('X-Profile') != '1' and request.args.get('_profile') != '1':
+        return
+    if 'user_id' not in session or current_user() is None or not current_user()['is_admin']:
+        return
+    profiler = cProfile.Profile()
+    request.environ['netdisk.profiler'] = profiler
+    request.environ['netdisk.profile_id'] = uuid.uuid4().hex
+    profiler.enable()
+
+@app.after_request
+def add_profile_header(response):
+    """在响应头中返回剖析结果的ID，用于下载"""
+    profile_id = request.environ.get('netdisk.profile_id')
+    if profile_id:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+def save_profile(environ, status, duration):
+    """请求结束（响应体发送完毕）时停止剖析并保存，只保留最近 PROFILE_KEEP 个"""
+    profiler = environ.pop('netdisk.profiler')
+    profiler.disable()
+    profile_id = environ['netdisk.profile_id']
+    profiler.dump_stats(os.path.join(PROFILES_FOLDER, f'{profile_id}.prof'))
+    path = environ.get('PATH_INFO', '')
+    if environ.get('QUERY_STRING'):
+        path += '?' + environ['QUERY_STRING']
+    conn = get_db()
+    conn.execute(
+        'INSERT INTO profiles (id, username, method, path, status, duration, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (profile_id, environ.get('netdisk.user'), environ['REQUEST_METHOD'], path, status, duration, time.time())
+    )
+    expired = conn.execute(
+        'SELECT id FROM profiles ORDER BY created_at DESC LIMIT -1 OFFSET ?', (PROFILE_KEEP,)
+    ).fetchall()
+    for row in expired:
+        conn.execute('DELETE FROM profiles WHERE id = ?', (row['id'],))
+        try:
+            os.remove(os.path.join(PROFILES_FOLDER, f'{row["id"]}.prof'))
+        except OSError:
+            pass
+
+def metrics_flush_loop():
+    """定期写入本进程的指标快照，进程正常退出时再写一次"""
+    atexit.register(metrics.flush)
+    while True:
+        try:
+            metrics.flush()
+        except OSError:
+            pass
+        time.sleep(METRICS_FLUSH_INTERVAL)
+
 def get_file_info(filepath):
     """获取文件信息"""
     stat = os.stat(filepath)
@@ -112,6 +1373,7 @@ def get_file_info(filepath):
         'is_dir': os.path.isdir(filepath)
     }
 
+@timed
 def get_directory_size(path):
     """计算目录总大小"""
     total_size = 0
@@ -127,6 +1389,1682 @@ def get_directory_size(path):
         pass
     return total_size
 
+# 存储层：逻辑路径与物理存储之间的映射
+
+def normalize_path(*parts, root=''):
+    """将路径片段规范化为 root 下的逻辑路径（如 'a/b'），越界或在存储根目录下指向保留目录时返回None"""
+    segments = []
+    for part in parts:
+        if not part:
+            continue
+        for seg in part.replace('\\', '/').split('/'):
+            if seg in ('', '.'):
+                continue
+            if seg == '..':
+                return None
+            segments.append(seg)
+    if not root and segments and segments[0] in (TRASH_DIR, USERS_DIR, INCOMING_DIR):
+        return None
+    if root:
+        segments.insert(0, root)
+    return '/'.join(segments)
+
+def split_path(path):
+    """拆分逻辑路径为 (父目录, 名称)"""
+    if '/' in path:
+        parent, name = path.rsplit('/', 1)
+        return parent, name
+    return '', path
+
+def local_path(path):
+    """平铺布局下逻辑路径对应的物理路径"""
+    return os.path.join(UPLOAD_FOLDER, *path.split('/')) if path else UPLOAD_FOLDER
+
+def object_path(object_id):
+    """分片布局下对象的物理路径：objects/ab/cd/abcd..."""
+    return os.path.join(OBJECTS_FOLDER, object_id[:2], object_id[2:4], object_id)
+
+def subtree_range(path):
+    """逻辑路径下所有后代的主键范围（'/' 的下一个字符是 '0'），可直接走主键索引"""
+    if not path:
+        return '', '\U0010ffff'
+    return path + '/', path + '0'
+
+# 分片布局下节点自身及其所有后代的递归查询（参数为节点ID，根目录为 0），
+# rel 为相对该节点的路径（节点自身为 ''）；根目录本身没有对应的行
+SUBTREE_CTE = (
+    'WITH RECURSIVE subtree(id, rel) AS ('
+    "SELECT ?, '' UNION ALL "
+    "SELECT nodes.id, ltrim(subtree.rel || '/' || nodes.name, '/') FROM nodes JOIN subtree ON nodes.parent = subtree.id) "
+)
+
+def entry_to_info(row):
+    """元数据行转换为文件信息"""
+    return {
+        'name': row['name'],
+        'size': row['size'],
+        'modified': datetime.fromtimestamp(row['mtime']).strftime('%Y-%m-%d %H:%M:%S'),
+        'is_dir': bool(row['is_dir'])
+    }
+
+def resolve_nodes(path):
+    """沿逻辑路径逐级查找分片布局下的元数据行，返回找到的各级行（遇到不存在的一级即停止）"""
+    conn = get_db()
+    rows, parent = [], 0
+    for name in path.split('/') if path else []:
+        row = conn.execute('SELECT * FROM nodes WHERE parent = ? AND name = ?', (parent, name)).fetchone()
+        if row is None:
+            break
+        rows.append(row)
+        parent = row['id']
+    return rows
+
+def object_logical_path(object_id):
+    """分片布局下对象所在的逻辑路径（沿父节点上溯），对象已不在目录树中时返回None"""
+    conn = get_db()
+    row = conn.execute('SELECT parent, name FROM nodes WHERE object_id = ?', (object_id,)).fetchone()
+    names = []
+    while row is not None:
+        names.append(row['name'])
+        if row['parent'] == 0:
+            return '/'.join(reversed(names))
+        row = conn.execute('SELECT parent, name FROM nodes WHERE id = ?', (row['parent'],)).fetchone()
+    return None
+
+def get_entry(path):
+    """查询分片布局下的元数据行"""
+    rows = resolve_nodes(path)
+    return rows[-1] if path and len(rows) == path.count('/') + 1 else None
+
+def node_id(path):
+    """分片布局下逻辑路径的节点ID（根目录为 0），不存在时返回None"""
+    if not path:
+        return 0
+    row = get_entry(path)
+    return row['id'] if row else None
+
+def storage_stat(path):
+    """获取逻辑路径的文件信息，不存在时返回None"""
+    if STORAGE_LAYOUT == 'sharded':
+        if path == '':
+            return {'name': '', 'size': 0, 'modified': '', 'is_dir': True}
+        row = get_entry(path)
+        return entry_to_info(row) if row else None
+    try:
+        return get_file_info(local_path(path))
+    except (OSError, IOError):
+        return None
+
+def storage_exists(path):
+    """逻辑路径是否存在"""
+    return storage_stat(path) is not None
+
+def storage_is_dir(path):
+    """逻辑路径是否为目录"""
+    info = storage_stat(path)
+    return bool(info and info['is_dir'])
+
+@timed
+def storage_list(path):
+    """列出目录内容"""
+    if STORAGE_LAYOUT == 'sharded':
+        parent = node_id(path)
+        if parent is None:
+            return []
+        rows = get_db().execute('SELECT * FROM nodes WHERE parent = ?', (parent,)).fetchall()
+        return [entry_to_info(row) for row in rows]
+
+    files = []
+    # scandir 复用目录项中的类型信息，避免对每一项重复 lookup
+    with os.scandir(local_path(path)) as entries:
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                files.append({
+                    'name': entry.name,
+                    'size': stat.st_size,
+                    'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+                    'is_dir': entry.is_dir()
+                })
+            except (OSError, IOError):
+                continue  # 跳过无法访问的文件
+    return files
+
+def storage_makedirs(path):
+    """创建目录（含所有上级目录），新建的目录写入空的目录汇总；分片布局下返回该目录的节点ID"""
+    created, node = [], None
+    if STORAGE_LAYOUT != 'sharded':
+        missing = path
+        while missing and not os.path.isdir(local_path(missing)):
+            created.append(missing)
+            missing = split_path(missing)[0]
+        os.makedirs(local_path(path), exist_ok=True)
+    else:
+        now = datetime.now().timestamp()
+        names = path.split('/') if path else []
+        with db_transaction() as conn:
+            existing = resolve_nodes(path)
+            node = existing[-1]['id'] if existing else 0
+            for name in names[len(existing):]:
+                node = conn.execute(
+                    'INSERT INTO nodes (parent, name, is_dir, size, mtime) VALUES (?, ?, 1, 0, ?)',
+                    (node, name, now)
+                ).lastrowid
+                created.append(f'@{node}')
+    if created:
+        get_db().executemany(
+            'INSERT OR IGNORE INTO dir_stats (path, size, files, updated_at) VALUES (?, 0, 0, ?)',
+            [(key, time.time()) for key in created]
+        )
+    return node
+
+def storage_save(file, path):
+    """保存上传的文件到逻辑路径"""
+    parent, name = split_path(path)
+    if STORAGE_LAYOUT != 'sharded':
+        storage_makedirs(parent)
+        physical = local_path(path)
+        old = storage_stat(path)
+        digest = write_with_checksum(file.stream, physical)
+        record_checksum(path, physical, CHECKSUM_ALGORITHM, digest)
+        size = os.path.getsize(physical)
+        update_dir_stats(path, size - (old['size'] if old else 0), 0 if old else 1)
+        return
+
+    object_id = uuid.uuid4().hex
+    physical = object_path(object_id)
+    os.makedirs(os.path.dirname(physical), exist_ok=True)
+    digest = write_with_checksum(file.stream, physical)
+    stat = os.stat(physical)
+
+    with db_transaction() as conn:
+        parent_id = storage_makedirs(parent)
+        old = conn.execute('SELECT * FROM nodes WHERE parent = ? AND name = ?', (parent_id, name)).fetchone()
+        conn.execute(
+            'INSERT INTO nodes (parent, name, is_dir, size, mtime, object_id) VALUES (?, ?, 0, ?, ?, ?) '
+            'ON CONFLICT (parent, name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+            'object_id = excluded.object_id',
+            (parent_id, name, stat.st_size, stat.st_mtime, object_id)
+        )
+        if old is not None and old['object_id']:
+            forget_object_checksums([old['object_id']])
+        record_checksum(path, physical, CHECKSUM_ALGORITHM, digest)
+        update_dir_stats(path, stat.st_size - (old['size'] if old else 0), 0 if old else 1)
+    if old is not None and old['object_id']:
+        try:
+            os.remove(object_path(old['object_id']))
+        except OSError:
+            pass
+
+def storage_file_path(path):
+    """获取文件内容的物理路径（用于读取/发送），不是文件时返回None"""
+    if STORAGE_LAYOUT == 'sharded':
+        row = get_entry(path)
+        if row is None or row['is_dir']:
+            return None
+        return object_path(row['object_id'])
+    physical = local_path(path)
+    return physical if os.path.isfile(physical) else None
+
+def storage_walk(path):
+    """遍历目录下的所有文件，生成 (相对路径, 物理路径)"""
+    if STORAGE_LAYOUT == 'sharded':
+        rows = get_db().execute(
+            SUBTREE_CTE + "SELECT rel, object_id FROM subtree JOIN nodes USING (id) WHERE is_dir = 0 AND rel != '' ORDER BY rel",
+            (node_id(path),)
+        ).fetchall()
+        for row in rows:
+            yield row['rel'], object_path(row['object_id'])
+        return
+
+    root_path = local_path(path)
+    for root, dirs, files in os.walk(root_path):
+        for file in files:
+            file_full_path = os.path.join(root, file)
+            yield os.path.relpath(file_full_path, root_path), file_full_path
+
+def storage_tree_size(path):
+    """逻辑路径下的文件总大小（读取目录汇总）"""
+    return tree_totals(path)[0]
+
+@timed
+def scan_tree_totals(path):
+    """实际统计逻辑路径下的 (文件总大小, 文件数)"""
+    if STORAGE_LAYOUT == 'sharded':
+        row = get_db().execute(
+            SUBTREE_CTE + "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM subtree JOIN nodes USING (id) WHERE is_dir = 0 AND rel != ''",
+            (node_id(path),)
+        ).fetchone()
+        return row[0], row[1]
+    size, files = 0, 0
+    for root, dirs, filenames in os.walk(local_path(path)):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except (OSError, IOError):
+                continue
+            files += 1
+    return size, files
+
+def storage_remove(path):
+    """删除文件或目录"""
+    forget_checksums(path)
+    size, files = tree_totals(path)
+    if STORAGE_LAYOUT != 'sharded':
+        physical = local_path(path)
+        if os.path.isdir(physical):
+            shutil.rmtree(physical)
+        else:
+            os.remove(physical)
+        remove_dir_stats(path, size, files)
+        return
+
+    with db_transaction() as conn:
+        node = node_id(path)
+        rows = conn.execute(
+            SUBTREE_CTE + 'SELECT object_id FROM subtree JOIN nodes USING (id) WHERE object_id IS NOT NULL', (node,)
+        ).fetchall()
+        # 子目录的汇总记录按节点ID查找，要在删除节点之前清除
+        remove_dir_stats(path, size, files)
+        conn.execute(SUBTREE_CTE + 'DELETE FROM nodes WHERE id IN (SELECT id FROM subtree)', (node,))
+    for row in rows:
+        try:
+            os.remove(object_path(row['object_id']))
+        except OSError:
+            pass
+
+def storage_remove_throttled(path, batch_size=TRASH_PURGE_BATCH, pause=TRASH_PURGE_PAUSE):
+    """分批删除文件或目录，每批之间停顿，避免长时间占满磁盘IO"""
+    forget_checksums(path)
+    size, file_count = tree_totals(path)
+    if STORAGE_LAYOUT != 'sharded':
+        physical = local_path(path)
+        if not os.path.isdir(physical):
+            try:
+                os.remove(physical)
+            except FileNotFoundError:
+                pass
+            remove_dir_stats(path, size, file_count)
+            return
+        removed = 0
+        for root, dirs, files in os.walk(physical, topdown=False):
+            for file in files:
+                try:
+                    os.remove(os.path.join(root, file))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                if removed % batch_size == 0:
+                    time.sleep(pause)
+            os.rmdir(root)
+        remove_dir_stats(path, size, file_count)
+        return
+
+    conn = get_db()
+    # 由深到浅删除（子节点的 rel 以父节点的 rel 为前缀，倒序排在前面），中途不会留下失去上级的节点
+    descendants = conn.execute(
+        SUBTREE_CTE + "SELECT id, is_dir, object_id FROM subtree JOIN nodes USING (id) WHERE rel != '' ORDER BY rel DESC",
+        (node_id(path),)
+    ).fetchall()
+    for i in range(0, len(descendants), batch_size):
+        rows = descendants[i:i + batch_size]
+        with db_transaction():
+            conn.executemany('DELETE FROM nodes WHERE id = ?', [(row['id'],) for row in rows])
+            conn.executemany('DELETE FROM dir_stats WHERE path = ?', [(f'@{row["id"]}',) for row in rows if row['is_dir']])
+        for row in rows:
+            if row['object_id']:
+                try:
+                    os.remove(object_path(row['object_id']))
+                except OSError:
+                    pass
+        time.sleep(pause)
+    
+    with db_transaction():
+        row = get_entry(path)
+        remove_dir_stats(path, size, file_count)
+        if row is not None:
+            conn.execute('DELETE FROM nodes WHERE id = ?', (row['id'],))
+    if row is not None and row['object_id']:
+        try:
+            os.remove(object_path(row['object_id']))
+        except OSError:
+            pass
+
+def storage_rename(old, new):
+    """重命名/移动文件或目录（分片布局下只修改元数据）"""
+    size, files = tree_totals(old)
+    if STORAGE_LAYOUT != 'sharded':
+        storage_makedirs(split_path(new)[0])
+        try:
+            # 同一文件系统内只修改目录项
+            os.rename(local_path(old), local_path(new))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(local_path(old), local_path(new))
+        move_checksums(old, new)
+        move_dir_stats(old, new, size, files)
+        return
+
+    # 后代只记录父节点ID，校验和与目录汇总也不以逻辑路径为键，只需修改这一行
+    new_parent, new_name = split_path(new)
+    with db_transaction() as conn:
+        node = node_id(old)
+        conn.execute(
+            'UPDATE nodes SET parent = ?, name = ? WHERE id = ?',
+            (storage_makedirs(new_parent), new_name, node)
+        )
+        move_dir_stats(old, new, size, files)
+
+def clone_file(src, dst):
+    """复制文件内容：依次尝试 reflink（FICLONE）、copy_file_range、分块复制，返回所用方式"""
+    with open(src, 'rb') as fsrc, atomic_create(dst) as fd, open(fd, 'wb', closefd=False) as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            method = None
+        
+        if method is None and hasattr(os, 'copy_file_range'):
+            # 内核内复制，数据不经过用户态；跨文件系统、不支持或提前结束（复制不完整）时清空目标后回退
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    method = 'copy_file_range'
+            except OSError:
+                pass
+            if method is None:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        
+        if method is None:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+            method = 'chunked'
+    shutil.copystat(src, dst)
+    return method
+
+def link_or_clone(src, dst):
+    """分片布局下对象不可变，复制时优先建立硬链接（不复制数据）"""
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        return clone_file(src, dst)
+
+def storage_copy(src, dst, checkpoint=None):
+    """复制文件或目录，每复制一个文件调用一次 checkpoint（用于上报进度和响应取消）"""
+    if STORAGE_LAYOUT != 'sharded':
+        storage_makedirs(split_path(dst)[0])
+        source = local_path(src)
+        if not os.path.isdir(source):
+            clone_file(source, local_path(dst))
+            copy_checksums(src, dst)
+            copy_dir_stats(src, dst)
+            return
+        for root, dirs, files in os.walk(source):
+            target_root = os.path.join(local_path(dst), os.path.relpath(root, source))
+            os.makedirs(target_root, exist_ok=True)
+            for file in files:
+                clone_file(os.path.join(root, file), os.path.join(target_root, file))
+                if checkpoint:
+                    checkpoint()
+        copy_checksums(src, dst)
+        copy_dir_stats(src, dst)
+        return
+
+    # 按相对路径排序，上级目录总在其后代之前
+    rows = get_db().execute(
+        SUBTREE_CTE + 'SELECT nodes.*, rel FROM subtree JOIN nodes USING (id) ORDER BY rel',
+        (node_id(src),)
+    ).fetchall()
+    objects = {}
+    for row in rows:
+        if not row['is_dir']:
+            object_id = uuid.uuid4().hex
+            physical = object_path(object_id)
+            os.makedirs(os.path.dirname(physical), exist_ok=True)
+            link_or_clone(object_path(row['object_id']), physical)
+            objects[row['object_id']] = object_id
+            if checkpoint:
+                checkpoint()
+    dst_parent, dst_name = split_path(dst)
+    with db_transaction() as conn:
+        ids = {rows[0]['parent']: storage_makedirs(dst_parent)}
+        for row in rows:
+            ids[row['id']] = conn.execute(
+                'INSERT INTO nodes (parent, name, is_dir, size, mtime, object_id) VALUES (?, ?, ?, ?, ?, ?)',
+                (ids[row['parent']], row['name'] if row['rel'] else dst_name,
+                 row['is_dir'], row['size'], row['mtime'], objects.get(row['object_id']))
+            ).lastrowid
+        copy_checksums(src, dst, objects)
+        copy_dir_stats(src, dst, {f'@{row["id"]}': f'@{ids[row["id"]]}' for row in rows if row['is_dir']})
+
+# 内容校验和：上传时边写边算，随重命名/复制/删除同步维护，由后台线程定期复验。
+# 复制保留了 mtime（copystat/硬链接），因此校验和可以直接随行复制。
+
+def new_hasher(algorithm):
+    """创建指定算法的增量哈希对象"""
+    if algorithm == 'blake3':
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+# 上传写入：已知大小时预分配空间减少碎片，写入过程中分段回写使磁盘吞吐平稳，完成时按持久性设置落盘
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+@functools.lru_cache(maxsize=None)
+def libc_function(name):
+    """按名称获取 libc 函数，系统不提供时返回None"""
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    return getattr(ctypes.CDLL(libc_name, use_errno=True), name, None)
+
+def sync_file_range(fd, offset, nbytes, flags):
+    """调用 Linux 的 sync_file_range，其他系统上不做任何事"""
+    func = libc_function('sync_file_range')
+    if func is None:
+        return
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    func(fd, offset, nbytes, flags)
+
+def fsync_dir(path):
+    """fsync 目录，使其中新建或改名的目录项落盘"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def incoming_folder():
+    """临时文件目录：位于存储目录内，与最终位置在同一文件系统，rename 才是原子的"""
+    return os.path.join(OBJECTS_FOLDER if STORAGE_LAYOUT == 'sharded' else UPLOAD_FOLDER, INCOMING_DIR)
+
+@contextmanager
+def atomic_create(physical):
+    """原子地创建或替换文件：with 块内向返回的文件描述符写入，正常结束后才 rename 到 physical，
+    读者不会看到写了一半的文件，出错时丢弃。
+    优先使用 O_TMPFILE 匿名文件（进程崩溃时由内核回收），写完后链接为临时文件名再 rename；
+    文件系统不支持时直接创建以进程号开头的临时文件，进程异常退出后由 sweep_incoming 清理"""
+    folder = incoming_folder()
+    os.makedirs(folder, exist_ok=True)
+    temp = os.path.join(folder, f'{os.getpid()}-{uuid.uuid4().hex}')
+    fd = None
+    if hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd'):
+        try:
+            fd = os.open(folder, os.O_TMPFILE | os.O_WRONLY, 0o666)
+        except OSError:
+            pass
+    named = fd is None
+    if named:
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        yield fd
+        if not named:
+            # 经 /proc/self/fd 建立链接须跟随符号链接，指定 dst_dir_fd 才会调用 linkat(AT_SYMLINK_FOLLOW)
+            dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.link(f'/proc/self/fd/{fd}', os.path.basename(temp), dst_dir_fd=dir_fd)
+            finally:
+                os.close(dir_fd)
+            named = True
+        os.rename(temp, physical)
+        named = False
+    finally:
+        os.close(fd)
+        if named:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+    if UPLOAD_DURABILITY == 'fsync-dir':
+        fsync_dir(os.path.dirname(os.path.abspath(physical)))
+
+def sweep_incoming():
+    """清理已退出进程遗留的临时文件（上传或复制中途崩溃、被 gunicorn 超时杀掉时产生）"""
+    folder = incoming_folder()
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return
+    for name in names:
+        pid = name.split('-', 1)[0]
+        if pid.isdigit() and process_alive(int(pid)):
+            continue
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+
+def upload_stream_size(stream):
+    """上传数据流的剩余长度（已缓存在内存或临时文件中时可得），未知时返回None"""
+    try:
+        position = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def write_upload(stream, physical, hasher=None):
+    """将上传数据流写入文件，hasher 不为None时同时计算校验和，返回写入的字节数"""
+    size = upload_stream_size(stream)
+    with atomic_create(physical) as fd:
+        if size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                # 空间不足时直接失败；文件系统不支持预分配时照常写入
+                if e.errno == errno.ENOSPC:
+                    raise
+        
+        written = started = 0
+        with open(fd, 'wb', buffering=UPLOAD_WRITE_BUFFER, closefd=False) as f:
+            while True:
+                chunk = stream.read(UPLOAD_WRITE_BUFFER)
+                if not chunk:
+                    break
+                if hasher is not None:
+                    hasher.update(chunk)
+                f.write(chunk)
+                written += len(chunk)
+                if written - started >= UPLOAD_FLUSH_BYTES:
+                    # 启动本段的回写，并等待上一段写完，使脏页始终不超过两段
+                    f.flush()
+                    sync_file_range(fd, started, written - started, SYNC_FILE_RANGE_WRITE)
+                    if started:
+                        sync_file_range(fd, 0, started, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                    started = written
+        
+        if size and written < size:
+            os.ftruncate(fd, written)
+        if UPLOAD_DURABILITY != 'none':
+            os.fsync(fd)
+    return written
+
+def write_with_checksum(stream, physical):
+    """将上传数据流写入文件，同时计算校验和（不额外读一遍磁盘），返回十六进制摘要"""
+    hasher = new_hasher(CHECKSUM_ALGORITHM)
+    write_upload(stream, physical, hasher)
+    return hasher.hexdigest()
+
+def checksum_file(physical, algorithm, rate=None):
+    """流式计算文件的校验和，rate 为读取速率上限（字节/秒）"""
+    hasher = new_hasher(algorithm)
+    started, done = time.time(), 0
+    with open(physical, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_BUFFER_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            done += len(chunk)
+            if rate:
+                delay = done / rate - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+    return hasher.hexdigest()
+
+def checksum_key(path, physical):
+    """校验和记录的键：平铺布局下为逻辑路径，分片布局下为对象ID（对象内容不可变，重命名/移动时记录不变）"""
+    return os.path.basename(physical) if STORAGE_LAYOUT == 'sharded' else path
+
+def checksum_physical(key):
+    """校验和记录对应文件的物理路径，文件已不存在时返回None"""
+    if STORAGE_LAYOUT == 'sharded':
+        physical = object_path(key)
+        return physical if os.path.isfile(physical) else None
+    return storage_file_path(key)
+
+def record_checksum(path, physical, algorithm, digest):
+    """记录文件的校验和及计算时的文件状态"""
+    stat = os.stat(physical)
+    get_db().execute(
+        'INSERT OR REPLACE INTO checksums (path, algorithm, digest, size, mtime_ns, verified_at, status) '
+        "VALUES (?, ?, ?, ?, ?, ?, 'ok')",
+        (checksum_key(path, physical), algorithm, digest, stat.st_size, stat.st_mtime_ns, time.time())
+    )
+
+def get_checksum(path, physical):
+    """获取与当前文件内容对应的校验和记录，文件在记录之后被修改过时返回None"""
+    row = get_db().execute('SELECT * FROM checksums WHERE path = ?', (checksum_key(path, physical),)).fetchone()
+    if row is None:
+        return None
+    stat = os.stat(physical)
+    if row['size'] != stat.st_size or row['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    return row
+
+def forget_checksums(path):
+    """删除文件或目录下所有文件的校验和记录"""
+    if STORAGE_LAYOUT == 'sharded':
+        rows = get_db().execute(
+            SUBTREE_CTE + 'SELECT object_id FROM subtree JOIN nodes USING (id) WHERE object_id IS NOT NULL',
+            (node_id(path),)
+        ).fetchall()
+        forget_object_checksums([row['object_id'] for row in rows])
+        return
+    low, high = subtree_range(path)
+    get_db().execute('DELETE FROM checksums WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+
+def forget_object_checksums(object_ids):
+    """删除分片布局下对象的校验和记录"""
+    get_db().executemany('DELETE FROM checksums WHERE path = ?', [(object_id,) for object_id in object_ids])
+
+def move_checksums(old, new):
+    """重命名/移动后更新校验和记录的路径"""
+    low, high = subtree_range(old)
+    with db_transaction() as conn:
+        if not conn.execute(
+            'SELECT 1 FROM checksums WHERE path = ? OR (path >= ? AND path < ?) LIMIT 1', (old, low, high)
+        ).fetchone():
+            return  # 没有记录（或文件监视已先行处理）
+        forget_checksums(new)
+        conn.execute(
+            'UPDATE checksums SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+            (new, len(old) + 1, old, low, high)
+        )
+
+def copy_checksums(src, dst, objects=None):
+    """复制后为目标复制一份校验和记录；分片布局下 objects 为 {源对象ID: 目标对象ID}"""
+    if objects is not None:
+        get_db().executemany(
+            'INSERT OR REPLACE INTO checksums (path, algorithm, digest, size, mtime_ns, verified_at, status) '
+            'SELECT ?, algorithm, digest, size, mtime_ns, verified_at, status FROM checksums WHERE path = ?',
+            [(target, source) for source, target in objects.items()]
+        )
+        return
+    low, high = subtree_range(src)
+    get_db().execute(
+        'INSERT OR REPLACE INTO checksums (path, algorithm, digest, size, mtime_ns, verified_at, status) '
+        'SELECT ? || substr(path, ?), algorithm, digest, size, mtime_ns, verified_at, status FROM checksums '
+        'WHERE path = ? OR (path >= ? AND path < ?)',
+        (dst, len(src) + 1, src, low, high)
+    )
+
+def digest_headers(response, row):
+    """在下载响应上附加 Digest/Repr-Digest 头"""
+    encoded = base64.b64encode(bytes.fromhex(row['digest'])).decode()
+    name = 'sha-256' if row['algorithm'] == 'sha256' else row['algorithm']
+    response.headers['Digest'] = f'{name}={encoded}'
+    response.headers['Repr-Digest'] = f'{name}=:{encoded}:'
+    return response
+
+def send_stored_file(path, download_name):
+    """以附件方式发送存储中的文件；已有校验和时用它作为强 ETag 并附加 Digest 头"""
+    physical = os.path.abspath(storage_file_path(path))
+    row = get_checksum(path, physical)
+    if row is None:
+        return send_file(physical, as_attachment=True, download_name=download_name)
+    response = send_file(physical, as_attachment=True, download_name=download_name, etag=row['digest'])
+    return digest_headers(response, row)
+
+# 目录汇总：每个目录（含子目录）的文件总大小和文件数。
+# 新建目录时写入空记录，上传/删除/重命名/移动/复制时沿祖先链增量更新；
+# 没有记录的目录视为大小未知（请求中不做全量统计），由后台对账补齐，并修正并发统计或存储外修改造成的偏差。
+
+def ancestor_dirs(path):
+    """逻辑路径的所有上级目录，从根目录 '' 开始"""
+    parts = path.split('/')[:-1] if path else []
+    return [''] + ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+def dir_stats_key(path):
+    """目录汇总记录的键：平铺布局下为逻辑路径；分片布局下为 '@节点ID'（重命名/移动时不变），目录不存在时为None"""
+    if STORAGE_LAYOUT != 'sharded' or not path:
+        return path
+    node = node_id(path)
+    return f'@{node}' if node is not None else None
+
+def ancestor_keys(path):
+    """逻辑路径所有上级目录的汇总记录键，从根目录 '' 开始"""
+    if STORAGE_LAYOUT != 'sharded':
+        return ancestor_dirs(path)
+    return [''] + [f'@{row["id"]}' for row in resolve_nodes(split_path(path)[0])]
+
+def update_dir_stats(path, size_delta, files_delta):
+    """路径下的内容变化后，更新其所有上级目录的汇总（只更新已有记录）；
+    变化量未知（size_delta 为 None）时删除这些记录，等后台对账重新统计"""
+    ancestors = ancestor_keys(path)
+    if size_delta is None or files_delta is None:
+        get_db().execute(
+            f'DELETE FROM dir_stats WHERE path IN ({",".join("?" * len(ancestors))})', ancestors
+        )
+        return
+    if not size_delta and not files_delta:
+        return
+    get_db().execute(
+        f'UPDATE dir_stats SET size = size + ?, files = files + ?, updated_at = ? '
+        f'WHERE path IN ({",".join("?" * len(ancestors))})',
+        (size_delta, files_delta, time.time(), *ancestors)
+    )
+
+def tree_totals(path, scan=False):
+    """逻辑路径下的 (文件总大小, 文件数)：文件直接取大小，目录读取汇总记录。
+    目录没有记录时返回 (None, None)；scan=True（仅限后台任务）时实际统计并写入记录"""
+    info = storage_stat(path) if path else {'is_dir': True}
+    if info is None:
+        return 0, 0
+    if not info['is_dir']:
+        return info['size'], 1
+    conn = get_db()
+    key = dir_stats_key(path)
+    row = conn.execute('SELECT size, files FROM dir_stats WHERE path = ?', (key,)).fetchone()
+    metrics.inc('netdisk_cache_requests_total', cache='dir_stats', result='hit' if row is not None else 'miss')
+    if row is not None:
+        return row['size'], row['files']
+    if not scan:
+        return None, None
+    size, files = scan_tree_totals(path)
+    conn.execute(
+        'INSERT OR IGNORE INTO dir_stats (path, size, files, updated_at) VALUES (?, ?, ?, ?)',
+        (key, size, files, time.time())
+    )
+    return size, files
+
+def remove_dir_stats(path, size, files):
+    """删除后扣减上级目录的汇总（size 为 None 时使其失效），并删除该目录及子目录的记录"""
+    with db_transaction() as conn:
+        update_dir_stats(path, None if size is None else -size, None if files is None else -files)
+        if STORAGE_LAYOUT == 'sharded':
+            conn.execute(
+                SUBTREE_CTE + "DELETE FROM dir_stats WHERE path IN (SELECT '@' || id FROM subtree)", (node_id(path),)
+            )
+            return
+        low, high = subtree_range(path)
+        conn.execute('DELETE FROM dir_stats WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+
+def move_dir_stats(old, new, size, files):
+    """重命名/移动后在新旧祖先链上转移汇总，并改写子目录记录的路径（分片布局下记录键不变）"""
+    low, high = subtree_range(old)
+    with db_transaction() as conn:
+        if size is None:
+            update_dir_stats(old, None, None)
+            update_dir_stats(new, None, None)
+        else:
+            update_dir_stats(old, -size, -files)
+            update_dir_stats(new, size, files)
+        if STORAGE_LAYOUT == 'sharded':
+            return
+        conn.execute(
+            'UPDATE dir_stats SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+            (new, len(old) + 1, old, low, high)
+        )
+
+def copy_dir_stats(src, dst, keys=None):
+    """复制后为目标累加汇总，并复制子目录的记录；分片布局下 keys 为 {源目录记录键: 目标目录记录键}"""
+    size, files = tree_totals(src)
+    low, high = subtree_range(src)
+    with db_transaction() as conn:
+        update_dir_stats(dst, size, files)
+        if keys is not None:
+            conn.executemany(
+                'INSERT OR REPLACE INTO dir_stats (path, size, files, updated_at) '
+                'SELECT ?, size, files, ? FROM dir_stats WHERE path = ?',
+                [(target, time.time(), source) for source, target in keys.items()]
+            )
+            return
+        conn.execute(
+            'INSERT OR REPLACE INTO dir_stats (path, size, files, updated_at) '
+            'SELECT ? || substr(path, ?), size, files, ? FROM dir_stats WHERE path = ? OR (path >= ? AND path < ?)',
+            (dst, len(src) + 1, time.time(), src, low, high)
+        )
+
+def scan_all_dir_stats():
+    """一次遍历统计所有目录的汇总，返回 {目录汇总记录键: [大小, 文件数]}"""
+    totals = {'': [0, 0]}
+    if STORAGE_LAYOUT == 'sharded':
+        parents, files = {}, []
+        for row in get_db().execute('SELECT id, parent, is_dir, size FROM nodes'):
+            if row['is_dir']:
+                parents[row['id']] = row['parent']
+                totals[f'@{row["id"]}'] = [0, 0]
+            else:
+                files.append((row['parent'], row['size']))
+        for parent, size in files:
+            keys = ['']
+            while parent in parents:
+                keys.append(f'@{parent}')
+                parent = parents[parent]
+            if parent != 0:
+                continue  # 上级目录已被删除（正在分批清除）
+            for key in keys:
+                totals[key][0] += size
+                totals[key][1] += 1
+        return totals
+    
+    # 自底向上：子目录统计完成后累加到父目录
+    for root, dirs, filenames in os.walk(UPLOAD_FOLDER, topdown=False):
+        relpath = os.path.relpath(root, UPLOAD_FOLDER)
+        path = '' if relpath == '.' else relpath.replace(os.sep, '/')
+        total = totals.setdefault(path, [0, 0])
+        for filename in filenames:
+            try:
+                total[0] += os.path.getsize(os.path.join(root, filename))
+            except (OSError, IOError):
+                continue
+            total[1] += 1
+        if path:
+            parent = totals.setdefault(split_path(path)[0], [0, 0])
+            parent[0] += total[0]
+            parent[1] += total[1]
+    return totals
+
+def reconcile_dir_stats():
+    """全量对账：写入实际统计结果；统计期间被增量更新过的记录留到下一轮"""
+    started = time.time()
+    totals = scan_all_dir_stats()
+    conn = get_db()
+    items = list(totals.items())
+    for i in range(0, len(items), 1000):
+        with db_transaction():
+            conn.executemany(
+                'INSERT INTO dir_stats (path, size, files, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET size = excluded.size, files = excluded.files, '
+                'updated_at = excluded.updated_at WHERE dir_stats.updated_at < ?',
+                [(path, size, files, started, started) for path, (size, files) in items[i:i + 1000]]
+            )
+    # 统计时已不存在的目录
+    conn.execute('DELETE FROM dir_stats WHERE updated_at < ?', (started,))
+
+def recompute_dir_stats(path):
+    """按磁盘现状重算平铺布局下一个目录的汇总（子目录取其汇总记录），差值沿祖先链传播。
+    返回 False 表示该目录此前没有记录，需要由调用方重算其父目录。"""
+    size, files = 0, 0
+    with os.scandir(local_path(path)) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    child_size, child_files = tree_totals(f'{path}/{entry.name}' if path else entry.name, scan=True)
+                    size += child_size
+                    files += child_files
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat().st_size
+                    files += 1
+            except (OSError, IOError):
+                continue
+    
+    with db_transaction() as conn:
+        old = conn.execute('SELECT size, files FROM dir_stats WHERE path = ?', (path,)).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO dir_stats (path, size, files, updated_at) VALUES (?, ?, ?, ?)',
+            (path, size, files, time.time())
+        )
+        if old is None:
+            return False
+        if path:
+            update_dir_stats(path, size - old['size'], files - old['files'])
+    return True
+
+def forget_dir_stats(path):
+    """删除目录及子目录的汇总记录（不修改上级目录）"""
+    low, high = subtree_range(path)
+    get_db().execute('DELETE FROM dir_stats WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+
+def rename_dir_stats(old, new):
+    """改写目录及子目录汇总记录的路径（不修改上级目录）"""
+    low, high = subtree_range(old)
+    with db_transaction() as conn:
+        if not conn.execute(
+            'SELECT 1 FROM dir_stats WHERE path = ? OR (path >= ? AND path < ?) LIMIT 1', (old, low, high)
+        ).fetchone():
+            return  # 已由应用自身的重命名处理过
+        forget_dir_stats(new)
+        conn.execute(
+            'UPDATE dir_stats SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+            (new, len(old) + 1, old, low, high)
+        )
+
+# 文件监视：通过 inotify 感知 uploads/ 中绕过应用的增删改（如直接 rsync 进来的文件），
+# 合并一段时间内的事件后自底向上重算受影响目录的汇总，并同步校验和记录；事件队列溢出时全量对账。
+# 应用自身的操作也会产生事件，重算以磁盘现状为准，已由应用更新过的记录差值为0。
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class WatchUnavailable(Exception):
+    """inotify 不可用或监视数量超出系统限制"""
+
+class DirectoryWatcher:
+    """递归监视平铺存储目录树，事件以逻辑路径表示"""
+    
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise WatchUnavailable('找不到 libc')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise WatchUnavailable('系统不支持 inotify')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchUnavailable(os.strerror(ctypes.get_errno()))
+        self.paths = {}  # 监视描述符 -> 逻辑路径
+        self.wds = {}  # 逻辑路径 -> 监视描述符
+    
+    def close(self):
+        os.close(self.fd)
+    
+    def watch_tree(self, path):
+        """监视目录及其所有子目录"""
+        root_path = local_path(path)
+        for root, dirs, files in os.walk(root_path):
+            relpath = os.path.relpath(root, root_path)
+            logical = path if relpath == '.' else '/'.join(filter(None, [path, relpath.replace(os.sep, '/')]))
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    continue  # 遍历过程中被删除
+                raise WatchUnavailable(os.strerror(error))  # 通常是 max_user_watches 不足
+            self.paths[wd] = logical
+            self.wds[logical] = wd
+    
+    def unwatch_tree(self, path):
+        """停止监视目录及其所有子目录"""
+        prefix = path + '/'
+        for logical in [p for p in self.wds if p == path or p.startswith(prefix)]:
+            wd = self.wds.pop(logical)
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+    
+    def rename_tree(self, old, new):
+        """目录在监视范围内移动后，监视描述符不变，只更新路径映射"""
+        prefix = old + '/'
+        for logical in [p for p in self.wds if p == old or p.startswith(prefix)]:
+            wd = self.wds.pop(logical)
+            renamed = new + logical[len(old):]
+            self.wds[renamed] = wd
+            self.paths[wd] = renamed
+    
+    def read_events(self, timeout):
+        """等待并读取事件，返回 [(逻辑路径, 掩码, cookie)]；溢出时返回 [(None, IN_Q_OVERFLOW, 0)]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, IN_Q_OVERFLOW, 0))
+                continue
+            if mask & IN_IGNORED:
+                logical = self.paths.pop(wd, None)
+                if logical is not None and self.wds.get(logical) == wd:
+                    del self.wds[logical]
+                continue
+            parent = self.paths.get(wd)
+            if parent is None or not name:
+                continue
+            events.append((f'{parent}/{name}' if parent else name, mask, cookie))
+        return events
+
+def handle_removed_path(watcher, path, is_dir, moved_out):
+    """文件或目录被删除或移出监视范围（被删除目录的监视由内核自动移除）"""
+    forget_checksums(path)
+    if is_dir:
+        forget_dir_stats(path)
+        if moved_out:
+            watcher.unwatch_tree(path)
+
+def apply_dirty_dirs(dirty):
+    """自底向上重算受影响目录的汇总，没有记录的目录继续上溯到父目录"""
+    heap = [(-path.count('/') - bool(path), path) for path in dirty]
+    heapq.heapify(heap)
+    done = set()
+    while heap:
+        _, path = heapq.heappop(heap)
+        if path in done:
+            continue
+        done.add(path)
+        if path and not os.path.isdir(local_path(path)):
+            continue
+        if not recompute_dir_stats(path) and path:
+            parent = split_path(path)[0]
+            heapq.heappush(heap, (-parent.count('/') - bool(parent), parent))
+
+def watch_storage(watcher):
+    """监视主循环：合并事件，静默 WATCH_DEBOUNCE 秒或累计 WATCH_MAX_DELAY 秒后处理一批。
+    监视描述符的增减随事件立即进行（新目录中的后续事件才不会遗漏），记录的修改推迟到处理时，
+    此时应用自身的操作早已更新完记录，不会互相覆盖。"""
+    dirty = set()
+    changes = []  # 按事件顺序：('move', 原路径, 新路径, 是否目录) / ('remove', 路径, 是否目录, 是否移出)
+    moved_from = {}  # cookie -> (逻辑路径, 是否目录)，等待配对的 MOVED_TO
+    first_event = None
+    while True:
+        events = watcher.read_events(WATCH_DEBOUNCE)
+        for path, mask, cookie in events:
+            if mask & IN_Q_OVERFLOW:
+                # 事件丢失：重建监视并全量对账
+                watcher.unwatch_tree('')
+                watcher.watch_tree('')
+                reconcile_dir_stats()
+                dirty.clear()
+                changes.clear()
+                moved_from.clear()
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            dirty.add(split_path(path)[0])
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO:
+                source = moved_from.pop(cookie, None)
+                if source is not None:
+                    changes.append(('move', source[0], path, is_dir))
+                    if is_dir:
+                        watcher.rename_tree(source[0], path)
+                elif is_dir:
+                    watcher.watch_tree(path)  # 从外部移入的目录
+            elif mask & IN_CREATE and is_dir:
+                watcher.watch_tree(path)
+            elif mask & IN_DELETE:
+                changes.append(('remove', path, is_dir, False))
+        
+        if events and first_event is None:
+            first_event = time.time()
+        if first_event is None or (events and time.time() - first_event < WATCH_MAX_DELAY):
+            continue
+        # 未配对的 MOVED_FROM 表示移出了监视范围
+        changes.extend(('remove', path, is_dir, True) for path, is_dir in moved_from.values())
+        moved_from.clear()
+        for change in changes:
+            if change[0] == 'move':
+                _, old, new, is_dir = change
+                move_checksums(old, new)
+                if is_dir:
+                    rename_dir_stats(old, new)
+            else:
+                _, path, is_dir, moved_out = change
+                handle_removed_path(watcher, path, is_dir, moved_out)
+        changes.clear()
+        apply_dirty_dirs(dirty)
+        dirty.clear()
+        first_event = None
+
+def dir_stats_root_known():
+    """根目录是否有汇总记录（大小未知的删除、移动或复制会使其失效）"""
+    try:
+        return get_db().execute("SELECT 1 FROM dir_stats WHERE path = ''").fetchone() is not None
+    except sqlite3.Error:
+        return True
+
+def dir_stats_loop():
+    """目录汇总维护线程（全局只有一个进程执行）：启动时对账，之后由文件监视保持一致；
+    监视不可用时（分片布局、非 Linux、监视数量超限）退回为定期全量对账"""
+    if dir_stats_root_known():
+        time.sleep(30)  # 避开启动时的负载；根目录还没有汇总（新部署或升级）时立即对账，配额检查要等它完成
+    while True:
+        try:
+            if acquire_singleton('dir_stats'):
+                if not WATCHER_ENABLED or STORAGE_LAYOUT == 'sharded':
+                    reconcile_dir_stats()
+                else:
+                    watcher = DirectoryWatcher()
+                    try:
+                        # 先建立监视再对账，对账期间的修改不会遗漏
+                        watcher.watch_tree('')
+                        reconcile_dir_stats()
+                        watch_storage(watcher)
+                    finally:
+                        watcher.close()
+        except Exception:
+            pass
+        # 根目录汇总失效（大小未知的删除、移动或复制会使上级记录失效）时提前对账
+        deadline = time.time() + DIR_STATS_RECONCILE_INTERVAL.total_seconds()
+        while time.time() < deadline:
+            time.sleep(DIR_STATS_CHECK_INTERVAL)
+            if not dir_stats_root_known():
+                break
+
+class ZipStreamBuffer:
+    """供 zipfile 写入的非 seekable 缓冲区，写入的数据由生成器分块取走"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(items, chunk_size=1024 * 1024, on_progress=None):
+    """边读边压缩地生成zip数据流，items 为 (归档路径, 物理路径) 序列，内存占用与文件大小无关"""
+    import zipfile
+    
+    buffer = ZipStreamBuffer()
+    bytes_read = 0
+    started = time.perf_counter()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+        for arcname, physical in items:
+            try:
+                info = zipfile.ZipInfo.from_file(physical, arcname)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(physical, 'rb') as source, zipf.open(info, 'w', force_zip64=True) as target:
+                    while True:
+                        chunk = source.read(chunk_size)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        bytes_read += len(chunk)
+                        if on_progress:
+                            on_progress(bytes_read)
+                        if len(buffer.chunks) > 16:
+                            yield buffer.take()
+            except (OSError, IOError):
+                continue  # 跳过无法读取的文件
+            yield buffer.take()
+    yield buffer.take()
+    metrics.observe('netdisk_zip_build_seconds', time.perf_counter() - started)
+
+# 每个工作进程启动的后台线程：(线程函数, 线程数)
+BACKGROUND_TASKS = []
+_background_pid = None
+_background_lock = threading.Lock()
+
+def start_background_tasks():
+    """在当前进程中启动后台线程（gunicorn 预加载后 fork 出的每个工作进程各启动一次）"""
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        for target, count in BACKGROUND_TASKS:
+            for _ in range(count):
+                threading.Thread(target=target, daemon=True).start()
+
+@app.before_request
+def ensure_background_tasks():
+    """首个请求到达时启动本进程的后台线程"""
+    if _background_pid != os.getpid():
+        start_background_tasks()
+
+_singleton_locks = {}
+
+def acquire_singleton(name):
+    """尝试成为某项全局维护工作的唯一执行进程（持有文件锁直到进程退出）"""
+    if name in _singleton_locks:
+        return True
+    lock_file = open(os.path.join(LOCKS_FOLDER, f'{name}.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _singleton_locks[name] = lock_file
+    return True
+
+# 后台任务：请求处理函数只负责提交，耗时操作由各工作进程中的任务线程执行
+
+class JobCancelled(Exception):
+    """后台任务已被取消"""
+
+class JobContext:
+    """后台任务执行上下文：任务参数、进度上报与取消检查"""
+    def __init__(self, row):
+        self.id = row['id']
+        self.type = row['type']
+        self.params = json.loads(row['params'])
+        self.created_by = row['created_by']
+        self.last_report = 0
+
+    def progress(self, done, total=None, force=False):
+        """上报进度（最多每秒写一次库），并在任务被取消时抛出 JobCancelled；
+        force 用于开始和结束时的上报，总是写库且不检查取消（工作已完成时不应再作废）"""
+        now = time.time()
+        if not force and now - self.last_report < 1:
+            return
+        self.last_report = now
+        conn = get_db()
+        conn.execute(
+            'UPDATE jobs SET progress_done = ?, progress_total = COALESCE(?, progress_total) WHERE id = ?',
+            (done, total, self.id)
+        )
+        if force:
+            return
+        row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (self.id,)).fetchone()
+        if row is None or row['cancel_requested']:
+            raise JobCancelled()
+
+JOB_HANDLERS = {}
+
+def job_handler(job_type):
+    """注册后台任务类型的处理函数"""
+    def decorator(f):
+        JOB_HANDLERS[job_type] = f
+        return f
+    return decorator
+
+_job_wakeup = threading.Event()
+
+def submit_job(job_type, params, created_by=None):
+    """提交后台任务，立即返回任务ID"""
+    job_id = uuid.uuid4().hex
+    get_db().execute(
+        'INSERT INTO jobs (id, type, params, status, created_by, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (job_id, job_type, json.dumps(params, ensure_ascii=False), 'queued', created_by, time.time())
+    )
+    _job_wakeup.set()
+    return job_id
+
+def job_to_dict(row):
+    """任务行转换为接口返回格式"""
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'status': row['status'],
+        'progress': {'done': row['progress_done'], 'total': row['progress_total']},
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+        'created_at': datetime.fromtimestamp(row['created_at']).isoformat(),
+        'finished_at': datetime.fromtimestamp(row['finished_at']).isoformat() if row['finished_at'] else None
+    }
+
+def process_alive(pid):
+    """检查进程是否存活"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def requeue_orphaned_jobs():
+    """重新排队所属进程已退出（如被 gunicorn 回收）的运行中任务"""
+    rows = get_db().execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'").fetchall()
+    for row in rows:
+        if row['worker_pid'] and not process_alive(row['worker_pid']):
+            get_db().execute(
+                "UPDATE jobs SET status = 'queued', worker_pid = NULL WHERE id = ? AND status = 'running'",
+                (row['id'],)
+            )
+
+def claim_next_job():
+    """领取一个排队中的任务，受全局并发上限约束"""
+    conn = get_db()
+    if conn.execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1").fetchone() is None:
+        return None
+    with db_transaction() as conn:
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        if running >= JOB_MAX_RUNNING:
+            return None
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', worker_pid = ?, started_at = ? WHERE id = ?",
+            (os.getpid(), time.time(), row['id'])
+        )
+    return row
+
+def run_job(row):
+    """执行任务并记录结果"""
+    job = JobContext(row)
+    result, error = None, None
+    try:
+        handler = JOB_HANDLERS.get(job.type)
+        if handler is None:
+            raise ValueError(f'未知的任务类型: {job.type}')
+        result = handler(job)
+        status = 'completed'
+    except JobCancelled:
+        status = 'cancelled'
+    except Exception as e:
+        status = 'failed'
+        error = str(e)
+    get_db().execute(
+        'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?',
+        (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job.id)
+    )
+
+def clean_finished_jobs():
+    """清理过期的已结束任务及其压缩包"""
+    cutoff = (datetime.now() - JOB_RETENTION).timestamp()
+    rows = get_db().execute(
+        "SELECT id FROM jobs WHERE status IN ('completed', 'failed', 'cancelled') AND finished_at < ?",
+        (cutoff,)
+    ).fetchall()
+    for row in rows:
+        try:
+            os.remove(os.path.join(ARCHIVES_FOLDER, f'{row["id"]}.zip'))
+        except OSError:
+            pass
+        get_db().execute('DELETE FROM jobs WHERE id = ?', (row['id'],))
+
+def job_worker_loop():
+    """后台任务线程主循环"""
+    last_maintenance = 0
+    while True:
+        try:
+            if time.time() - last_maintenance > 30:
+                last_maintenance = time.time()
+                requeue_orphaned_jobs()
+                clean_finished_jobs()
+            row = claim_next_job()
+            if row is None:
+                _job_wakeup.wait(1)
+                _job_wakeup.clear()
+                continue
+            run_job(row)
+        except Exception:
+            time.sleep(1)
+
+BACKGROUND_TASKS.append((job_worker_loop, JOB_WORKERS))
+
+# 回收站：删除只是一次 rename，空间由后台线程分批释放
+
+def move_to_trash(path, deleted_by=None):
+    """将文件或目录移入回收站（与目录大小无关的一次 rename），返回回收站条目ID"""
+    info = storage_stat(path)
+    trash_id = uuid.uuid4().hex
+    storage_rename(path, f'{TRASH_DIR}/{trash_id}')
+    now = time.time()
+    get_db().execute(
+        'INSERT INTO trash (id, original_path, name, is_dir, size, deleted_by, deleted_at, purge_after) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (trash_id, path, info['name'], int(info['is_dir']), None if info['is_dir'] else info['size'],
+         deleted_by, now, now + TRASH_RETENTION.total_seconds())
+    )
+    return trash_id
+
+def restore_from_trash(trash_id):
+    """从回收站恢复到原位置，原位置已被占用时自动加序号，返回恢复后的路径"""
+    conn = get_db()
+    cursor = conn.execute("UPDATE trash SET status = 'restoring' WHERE id = ? AND status = 'trashed'", (trash_id,))
+    if cursor.rowcount == 0:
+        return None
+    row = conn.execute('SELECT * FROM trash WHERE id = ?', (trash_id,)).fetchone()
+    
+    target = row['original_path']
+    parent, name = split_path(target)
+    base, ext = os.path.splitext(name)
+    counter = 1
+    while storage_exists(target):
+        target = normalize_path(f'{base} ({counter}){ext}', root=parent)
+        counter += 1
+    
+    try:
+        storage_rename(f'{TRASH_DIR}/{trash_id}', target)
+    except Exception:
+        conn.execute("UPDATE trash SET status = 'trashed' WHERE id = ?", (trash_id,))
+        raise
+    conn.execute('DELETE FROM trash WHERE id = ?', (trash_id,))
+    return target
+
+def claim_trash_item():
+    """领取一个到期待清除的回收站条目，同一时间全局只清除一个。
+    检查进行中的清除和领取在同一个写事务中完成，两个进程不会同时看到"没有清除在进行"后各领一个"""
+    with db_transaction() as conn:
+        for row in conn.execute("SELECT id, purger_pid FROM trash WHERE status = 'purging'").fetchall():
+            if process_alive(row['purger_pid']):
+                return None
+            conn.execute("UPDATE trash SET status = 'trashed', purger_pid = NULL WHERE id = ?", (row['id'],))
+        
+        row = conn.execute(
+            "SELECT * FROM trash WHERE status = 'trashed' AND purge_after <= ? ORDER BY purge_after LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE trash SET status = 'purging', purger_pid = ? WHERE id = ?", (os.getpid(), row['id']))
+    return row
+
+def adopt_orphaned_trash():
+    """登记回收站目录中没有条目记录的内容（如移入后进程崩溃），让其按期清除"""
+    if not storage_is_dir(TRASH_DIR):
+        return
+    known = {row['id'] for row in get_db().execute('SELECT id FROM trash').fetchall()}
+    now = time.time()
+    for info in storage_list(TRASH_DIR):
+        if info['name'] not in known:
+            get_db().execute(
+                'INSERT OR IGNORE INTO trash (id, original_path, name, is_dir, size, deleted_at, purge_after) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (info['name'], info['name'], info['name'], int(info['is_dir']), None, now, now)
+            )
+
+def trash_purger_loop():
+    """回收站清除线程：分批删除到期条目的内容"""
+    last_adopt = 0
+    while True:
+        try:
+            if time.time() - last_adopt > 3600:
+                last_adopt = time.time()
+                adopt_orphaned_trash()
+            row = claim_trash_item()
+            if row is None:
+                time.sleep(5)
+                continue
+            storage_remove_throttled(f'{TRASH_DIR}/{row["id"]}')
+            get_db().execute('DELETE FROM trash WHERE id = ?', (row['id'],))
+        except Exception:
+            time.sleep(5)
+
+BACKGROUND_TASKS.append((trash_purger_loop, 1))
+BACKGROUND_TASKS.append((sweep_incoming, 1))
+BACKGROUND_TASKS.append((metrics_flush_loop, 1))
+BACKGROUND_TASKS.append((dir_stats_loop, 1))
+
+# 缩略图：按尺寸档位缓存在磁盘上，在子进程池中生成
+
+def render_thumbnail(source, target, size):
+    """生成 JPEG 缩略图（在子进程中执行，先写临时文件再原子替换）"""
+    if os.path.exists(target):
+        return target
+    tmp = f'{target}.{os.getpid()}.tmp'
+    with Image.open(source) as img:
+        img.draft('RGB', (size, size))  # JPEG 直接按比例缩小解码，不解出全尺寸像素
+        thumb = ImageOps.exif_transpose(img)
+        thumb.thumbnail((size, size))
+        if thumb.mode not in ('RGB', 'L'):
+            thumb = thumb.convert('RGB')
+        thumb.save(tmp, 'JPEG', quality=80, optimize=True)
+    os.replace(tmp, target)
+    return target
+
+_thumb_pool = None
+_thumb_pool_pid = None
+_thumb_pending = {}
+_thumb_lock = threading.Lock()
+
+def get_thumb_pool():
+    """获取本进程的缩略图子进程池。子进程用 spawn 启动：工作进程中有后台线程，fork 可能复制到被持有的锁而死锁"""
+    global _thumb_pool, _thumb_pool_pid
+    if _thumb_pool is None or _thumb_pool_pid != os.getpid():
+        _thumb_pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        _thumb_pool_pid = os.getpid()
+    return _thumb_pool
+
+def discard_thumb_pool(pool):
+    """子进程异常退出（如处理超大图片时被 OOM 杀死）后进程池不能再用，丢弃它，下次提交时重建"""
+    global _thumb_pool
+    if _thumb_pool is pool:
+        _thumb_pool = None
+    pool.shutdown(wait=False)
+
+def thumbnail_done(target, pool, future):
+    """生成结束：移出进行中列表，进程池已损坏时丢弃"""
+    _thumb_pending.pop(target, None)
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        discard_thumb_pool(pool)
+
+def thumb_bucket(size):
+    """将请求的尺寸向上取整到缓存档位"""
+    return next((s for s in THUMB_SIZES if s >= size), THUMB_SIZES[-1])
+
+def thumbnail_cache_path(physical, size):
+    """缓存路径：键取自内容指纹（设备、inode、大小、修改时间），重命名和移动后仍可命中"""
+    stat = os.stat(physical)
+    key = hashlib.sha1(f'{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    return os.path.join(THUMBNAILS_FOLDER, str(size), key[:2], f'{key}.jpg')
+
+def request_thumbnail(physical, size):
+    """提交缩略图生成（已缓存或正在生成时不重复提交），返回 (缓存路径, future 或 None)"""
+    target = thumbnail_cache_path(physical, size)
+    cached = os.path.exists(target)
+    metrics.inc('netdisk_cache_requests_total', cache='thumbnail', result='hit' if cached else 'miss')
+    if cached:
+        return target, None
+    with _thumb_lock:
+        future = _thumb_pending.get(target)
+        if future is None:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            pool = get_thumb_pool()
+            try:
+                future = pool.submit(render_thumbnail, physical, target, size)
+            except BrokenProcessPool:
+                discard_thumb_pool(pool)
+                pool = get_thumb_pool()
+                future = pool.submit(render_thumbnail, physical, target, size)
+            _thumb_pending[target] = future
+            future.add_done_callback(functools.partial(thumbnail_done, target, pool))
+    return target, future
+
+def thumbnail_source(path, filename):
+    """解析缩略图对应的原图物理路径，不支持时返回None"""
+    file_path = user_path(path, filename)
+    if not file_path or os.path.splitext(file_path)[1].lower() not in THUMB_EXTENSIONS:
+        return None
+    return storage_file_path(file_path)
+
+def evict_thumbnails():
+    """缓存超出上限时，按最近访问时间淘汰到上限的 90%"""
+    entries, total = [], 0
+    for root, dirs, files in os.walk(THUMBNAILS_FOLDER):
+        for file in files:
+            thumb_path = os.path.join(root, file)
+            try:
+                stat = os.stat(thumb_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, thumb_path))
+            total += stat.st_size
+    if total <= THUMB_CACHE_LIMIT:
+        return
+    entries.sort()
+    for mtime, size, thumb_path in entries:
+        if total <= THUMB_CACHE_LIMIT * 0.9:
+            break
+        try:
+            os.remove(thumb_path)
+            total -= size
+        except OSError:
+            pass
+
+def thumbnail_cache_loop():
+    """定期检查缩略图缓存大小（全局只有一个进程执行）"""
+    while True:
+        time.sleep(600)
+        try:
+            if acquire_singleton('thumbnails'):
+                evict_thumbnails()
+        except Exception:
+            pass
+
+BACKGROUND_TASKS.append((thumbnail_cache_loop, 1))
+
+# 完整性复验：限速重读文件并与记录的校验和比对，发现静默损坏（bit-rot）
+
+def verify_checksum(row):
+    """复验一条校验和记录，返回新状态（文件已删除时返回None）"""
+    path = row['path']
+    physical = checksum_physical(path)
+    if physical is None:
+        if STORAGE_LAYOUT == 'sharded':
+            forget_object_checksums([path])
+        else:
+            forget_checksums(path)
+        return None
+    before = os.stat(physical)
+    digest = checksum_file(physical, row['algorithm'], SCRUB_RATE)
+    after = os.stat(physical)
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+        return row['status']  # 复验过程中文件被改写，下一轮再验
+    
+    if (after.st_size, after.st_mtime_ns) != (row['size'], row['mtime_ns']):
+        # 文件经正常途径被修改过，按新内容重新记录
+        record_checksum(path, physical, row['algorithm'], digest)
+        return 'ok'
+    status = 'ok' if digest == row['digest'] else 'corrupt'
+    get_db().execute(
+        'UPDATE checksums SET verified_at = ?, status = ? WHERE path = ? AND mtime_ns = ?',
+        (time.time(), status, path, row['mtime_ns'])
+    )
+    return status
+
+def discover_unhashed_files():
+    """为还没有校验和记录的文件（功能上线前的文件等）补算校验和"""
+    conn = get_db()
+    for relpath, physical in storage_walk(''):
+        path = relpath.replace(os.sep, '/')
+        if path.startswith((TRASH_DIR + '/', INCOMING_DIR + '/')):
+            continue
+        if conn.execute('SELECT 1 FROM checksums WHERE path = ?', (checksum_key(path, physical),)).fetchone():
+            continue
+        try:
+            before = os.stat(physical)
+            digest = checksum_file(physical, CHECKSUM_ALGORITHM, SCRUB_RATE)
+            if os.stat(physical).st_mtime_ns == before.st_mtime_ns:
+                record_checksum(path, physical, CHECKSUM_ALGORITHM, digest)
+        except OSError:
+            continue
+
+def integrity_scrubber_loop():
+    """完整性复验线程（全局只有一个进程执行）"""
+    last_discovery = 0
+    while True:
+        time.sleep(60)
+        try:
+            if not acquire_singleton('scrubber'):
+                continue
+            rows = get_db().execute(
+                'SELECT * FROM checksums WHERE verified_at < ? ORDER BY verified_at LIMIT ?',
+                (time.time() - SCRUB_INTERVAL.total_seconds(), SCRUB_BATCH)
+            ).fetchall()
+            for row in rows:
+                try:
+                    verify_checksum(row)
+                except OSError:
+                    continue
+            if not rows and time.time() - last_discovery > SCRUB_DISCOVERY_INTERVAL.total_seconds():
+                last_discovery = time.time()
+                discover_unhashed_files()
+        except Exception:
+            pass
+
+BACKGROUND_TASKS.append((integrity_scrubber_loop, 1))
+
 def clean_expired_quick_transfers():
     """清理过期的快传文件（1小时后删除）"""
     try:
@@ -152,26 +3090,47 @@ def clean_expired_quick_transfers():
     except OSError:
         pass
 
-def add_to_recent_files(filename, file_path, action='upload'):
-    """添加到最近使用文件列表"""
-    global recent_files
+RECENT_ACTIONS = {'upload': '上传', 'download': '下载', 'share': '分享', 'rename': '重命名', 'delete': '删除',
+                  'move': '移动', 'copy': '复制'}
+
+def record_activity(action, file_path, info=None, renamed_from=None, username=None):
+    """记录用户对文件的操作：追加到活动日志，并更新最近文件（同一文件只保留最新一条）。
+    file_path 为逻辑路径；info 为 None 时查询当前状态（删除前须先传入）；renamed_from 为重命名或移动前的路径；
+    username 为 None 时为当前用户（后台任务须传入）。写锁被占用时只等待 ACTIVITY_DB_TIMEOUT 秒，记录失败不影响操作本身"""
     try:
-        file_info = {
-            'name': filename,
-            'path': file_path,
-            'action': action,
-            'timestamp': datetime.now().isoformat(),
-            'size': os.path.getsize(os.path.join(UPLOAD_FOLDER, file_path, filename)) if os.path.exists(os.path.join(UPLOAD_FOLDER, file_path, filename)) else 0
-        }
-        
-        # 移除重复项
-        recent_files = [f for f in recent_files if not (f['name'] == filename and f['path'] == file_path)]
-        
-        # 添加到开头
-        recent_files.insert(0, file_info)
-        
-        # 只保留最近50个
-        recent_files = recent_files[:50]
+        if username is None:
+            username = current_user()['username']
+        root = user_root(username)
+        if info is None:
+            info = storage_stat(file_path)
+        is_dir = bool(info and info['is_dir'])
+        size = ((tree_totals(file_path)[0] or 0) if is_dir else info['size']) if info else 0
+        parent, name = split_path(file_path)
+        path = display_path(parent, root)
+        now = time.time()
+        with db_busy_timeout(ACTIVITY_DB_TIMEOUT), db_transaction() as conn:
+            seq = conn.execute(
+                'INSERT INTO activity_log (username, action, path, name, is_dir, size, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (username, action, path, name, int(is_dir), size, now)
+            ).lastrowid
+            if renamed_from is not None:
+                old_parent, old_name = split_path(renamed_from)
+                conn.execute('DELETE FROM recent_files WHERE username = ? AND path = ? AND name = ?',
+                             (username, display_path(old_parent, root), old_name))
+            conn.execute(
+                'INSERT INTO recent_files (username, path, name, action, is_dir, size, seq, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(username, path, name) DO UPDATE SET action = excluded.action, is_dir = excluded.is_dir, '
+                'size = excluded.size, seq = excluded.seq, updated_at = excluded.updated_at',
+                (username, path, name, action, int(is_dir), size, seq, now)
+            )
+            # 只保留最新的 RECENT_FILES_LIMIT 条：按 (username, seq) 索引定位第 N+1 新的一条，删除它及更早的
+            conn.execute(
+                'DELETE FROM recent_files WHERE username = ? AND seq <= '
+                '(SELECT seq FROM recent_files WHERE username = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                (username, username, RECENT_FILES_LIMIT)
+            )
+            if seq % 1000 == 0:
+                conn.execute('DELETE FROM activity_log WHERE created_at < ?', (now - ACTIVITY_RETENTION.total_seconds(),))
     except Exception:
         pass
 
@@ -181,12 +3140,15 @@ def login():
     if request.method == 'POST':
         client_ip = get_client_ip()
         
-        # 检查IP是否被封禁
-        if is_ip_blocked(client_ip):
-            return jsonify({
+        # 检查IP及其网段是否被限制（在计算密码哈希之前）
+        retry_after = login_retry_after(client_ip)
+        if retry_after:
+            response = jsonify({
                 'success': False, 
-                'message': '登录失败次数过多，今天无法再次尝试登录'
+                'message': f'登录失败次数过多，请 {math.ceil(retry_after / 60)} 分钟后再试'
             })
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
         
         data = request.get_json()
         username = data.get('username', '').strip()
@@ -195,14 +3157,27 @@ def login():
         if not username or not password:
             return jsonify({'success': False, 'message': '用户名和密码不能为空'})
         
-        # 验证用户
-        if username in users and users[username]['password'] == hashlib.sha256(password.encode()).hexdigest():
+        # 验证用户：密码哈希占用较多 CPU 和内存，本进程同时计算的数量有上限
+        if not login_hash_slots.acquire(timeout=1):
+            response = jsonify({'success': False, 'message': '登录请求过多，请稍后再试'})
+            response.headers['Retry-After'] = '1'
+            return response, 429
+        try:
+            user = get_user(username)
+            valid = verify_password(user['password'] if user is not None else dummy_password_hash(), password)
+            valid = valid and user is not None
+            if valid and password_needs_upgrade(user['password']):
+                get_db().execute('UPDATE users SET password = ? WHERE username = ?', (hash_password(password), username))
+        finally:
+            login_hash_slots.release()
+        if valid:
+            session.clear()
             session['user_id'] = username
-            session['username'] = users[username]['username']
+            session['username'] = user['username']
+            session['sid'] = create_session(user['username'])
             return jsonify({'success': True, 'message': '登录成功'})
         else:
-            record_failed_login(client_ip)
-            remaining = 10 - failed_logins[client_ip]['count']
+            remaining = record_failed_login(client_ip)
             return jsonify({
                 'success': False, 
                 'message': f'用户名或密码错误，还可尝试 {remaining} 次'
@@ -367,6 +3342,8 @@ def login():
 @app.route('/logout')
 def logout():
     """退出登录"""
+    if session.get('sid'):
+        get_db().execute('DELETE FROM sessions WHERE id = ?', (session_digest(session['sid']),))
     session.clear()
     return redirect(url_for('login'))
 
@@ -852,6 +3829,15 @@ def index():
             background: #ebf8ff;
         }
         
+        .file-thumb {
+            width: 100%;
+            height: 96px;
+            object-fit: cover;
+            border-radius: 6px;
+            margin-bottom: 12px;
+            background: #f1f5f9;
+        }
+        
         .file-checkbox {
             margin-right: 12px;
         }
@@ -1278,6 +4264,16 @@ def index():
                     <i class="fas fa-bolt"></i>
                     <span>快传</span>
                 </button>
+                <button class="nav-item" data-page="trash">
+                    <i class="fas fa-trash-restore"></i>
+                    <span>回收站</span>
+                </button>
+                {% if is_admin %}
+                <button class="nav-item" data-page="users">
+                    <i class="fas fa-users-cog"></i>
+                    <span>用户管理</span>
+                </button>
+                {% endif %}
                 <button class="nav-item" id="transferBtn">
                     <i class="fas fa-exchange-alt"></i>
                     <span>传输列表</span>
@@ -1422,6 +4418,8 @@ def index():
         let selectedFiles = new Set();
         let currentView = 'list';
         let transferTasks = [];
+        let serverTransfers = [];  // 服务端推送的进行中传输（含其他标签页和设备）
+        let transferSource = null;
         let storageInfo = { used: 0, total: 100 * 1024 * 1024 * 1024 }; // 默认100GB
         
         // 页面加载时初始化
@@ -1430,12 +4428,20 @@ def index():
             loadStorageInfo();
             setupEventListeners();
             
-            // 定时刷新传输列表和存储信息
-            setInterval(updateTransferProgress, 1000);
+            // 订阅服务端传输进度，定时刷新存储信息
+            connectTransferStream();
             setInterval(loadStorageInfo, 30000);
+            // 其他标签页或设备发起的传输：页面可见时定时重新订阅（空闲时服务端直接返回 204，只是一次轻量请求）
+            setInterval(() => { if (!document.hidden) connectTransferStream(); }, 15000);
+            document.addEventListener('visibilitychange', () => { if (!document.hidden) connectTransferStream(); });
         });
         
         function setupEventListeners() {
+            // 点击下载链接后订阅传输进度
+            document.addEventListener('click', e => {
+                if (e.target.closest('a[href^="/download"]')) setTimeout(connectTransferStream, 1000);
+            });
+            
             // 文件选择事件
             document.getElementById('fileInput').addEventListener('change', handleFileSelect);
             document.getElementById('folderInput').addEventListener('change', handleFileSelect);
@@ -1523,6 +4529,24 @@ def index():
                 return;
             }
             
+            // 先向服务器预检配额和磁盘空间，避免传完才被拒绝
+            fetch('/upload/preflight', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({size: totalSize})
+            })
+            .then(response => response.json())
+            .then(result => {
+                if (result.success) {
+                    sendUpload(files, totalSize);
+                } else {
+                    showToast('上传失败: ' + result.message, 'error');
+                }
+            })
+            .catch(() => sendUpload(files, totalSize));
+        }
+        
+        function sendUpload(files, totalSize) {
             const formData = new FormData();
             const taskId = 'upload_' + Date.now();
             
@@ -1578,7 +4602,11 @@ def index():
                     }
                 } else {
                     task.status = 'error';
-                    showToast('上传失败，请重试', 'error');
+                    let message = '上传失败，请重试';
+                    try {
+                        message = '上传失败: ' + JSON.parse(xhr.responseText).message;
+                    } catch (e) {}
+                    showToast(message, 'error');
                 }
                 
                 updateTransferList();
@@ -1604,7 +4632,11 @@ def index():
             });
             
             xhr.open('POST', '/upload');
+            xhr.setRequestHeader('X-Upload-Size', totalSize);
+            xhr.setRequestHeader('X-Transfer-Id', taskId);
+            xhr.setRequestHeader('X-Transfer-Name', encodeURIComponent(task.name));
             xhr.send(formData);
+            connectTransferStream();
         }
         
         function loadFiles(path) {
@@ -1656,7 +4688,7 @@ def index():
                 fileItem.dataset.isdir = file.is_dir;
                 
                 const icon = getFileIcon(file);
-                const sizeText = file.is_dir ? '文件夹' : formatFileSize(file.size);
+                const sizeText = file.is_dir ? folderSizeText(file) : formatFileSize(file.size);
                 
                 fileItem.innerHTML = `
                     <input type="checkbox" class="file-checkbox" onchange="toggleFileSelection('${file.name}')">
@@ -1675,13 +4707,23 @@ def index():
                                     `<button class="dropdown-item" onclick="openFolder('${escapeHtml(file.name)}')">
                                         <i class="fas fa-folder-open"></i> 打开
                                     </button>` : 
-                                    `<a href="/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(file.name)}" class="dropdown-item">
+                                    `${getPreviewType(file) ? 
+                                        `<button class="dropdown-item" onclick="previewFile('${escapeHtml(file.name)}')">
+                                            <i class="fas fa-play-circle"></i> 预览
+                                        </button>` : ''}
+                                    <a href="/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(file.name)}" class="dropdown-item">
                                         <i class="fas fa-download"></i> 下载
                                     </a>`
                                 }
                                 <button class="dropdown-item" onclick="showRenameModal('${escapeHtml(file.name)}')">
                                     <i class="fas fa-edit"></i> 重命名
                                 </button>
+                                <button class="dropdown-item" onclick="showMoveCopyModal('${escapeHtml(file.name)}', 'move')">
+                                    <i class="fas fa-arrows-alt"></i> 移动到
+                                </button>
+                                <button class="dropdown-item" onclick="showMoveCopyModal('${escapeHtml(file.name)}', 'copy')">
+                                    <i class="fas fa-copy"></i> 复制到
+                                </button>
                                 <button class="dropdown-item" onclick="showFileDetails('${escapeHtml(file.name)}')">
                                     <i class="fas fa-info-circle"></i> 详情
                                 </button>
@@ -1711,42 +4753,233 @@ def index():
             fileGrid.className = 'file-grid';
             fileGrid.id = 'fileGrid';
             
-            files.forEach(file => {
-                const fileCard = document.createElement('div');
-                fileCard.className = 'file-card';
-                fileCard.dataset.filename = file.name;
-                fileCard.dataset.isdir = file.is_dir;
-                
-                const icon = getFileIcon(file);
-                const sizeText = file.is_dir ? '文件夹' : formatFileSize(file.size);
-                
-                fileCard.innerHTML = `
-                    <input type="checkbox" class="file-checkbox" onchange="toggleFileSelection('${file.name}')" style="position: absolute; top: 8px; right: 8px;">
-                    <div class="file-icon ${getFileIconClass(file)}" style="font-size: 32px; margin-bottom: 12px;">${icon}</div>
-                    <div class="file-name" style="margin-bottom: 8px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap;">${escapeHtml(file.name)}</div>
-                    <div class="file-meta" style="font-size: 12px; color: #718096;">${sizeText}</div>
-                `;
-                
-                // 双击打开文件夹或下载文件
-                fileCard.addEventListener('dblclick', () => {
-                    if (file.is_dir) {
-                        openFolder(file.name);
+            files.forEach(file => {
+                const fileCard = document.createElement('div');
+                fileCard.className = 'file-card';
+                fileCard.dataset.filename = file.name;
+                fileCard.dataset.isdir = file.is_dir;
+                
+                const icon = getFileIcon(file);
+                const sizeText = file.is_dir ? folderSizeText(file) : formatFileSize(file.size);
+                const thumb = hasThumbnail(file) ? 
+                    `<img class="file-thumb" alt="" data-src="/thumb?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(file.name)}&size=256" loading="lazy" onerror="this.nextElementSibling.style.display = ''; this.remove();">` : '';
+                
+                fileCard.innerHTML = `
+                    <input type="checkbox" class="file-checkbox" onchange="toggleFileSelection('${file.name}')" style="position: absolute; top: 8px; right: 8px;">
+                    ${thumb}
+                    <div class="file-icon ${getFileIconClass(file)}" style="font-size: 32px; margin-bottom: 12px;${thumb ? ' display: none;' : ''}">${icon}</div>
+                    <div class="file-name" style="margin-bottom: 8px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap;">${escapeHtml(file.name)}</div>
+                    <div class="file-meta" style="font-size: 12px; color: #718096;">${sizeText}</div>
+                `;
+                
+                // 双击打开文件夹、预览媒体或下载文件
+                fileCard.addEventListener('dblclick', () => {
+                    if (file.is_dir) {
+                        openFolder(file.name);
+                    } else if (getPreviewType(file)) {
+                        previewFile(file.name);
+                    } else {
+                        window.location.href = `/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(file.name)}`;
+                        setTimeout(connectTransferStream, 1000);
+                    }
+                });
+                
+                // 右键菜单
+                fileCard.addEventListener('contextmenu', (e) => {
+                    e.preventDefault();
+                    showContextMenu(e, file);
+                });
+                
+                fileGrid.appendChild(fileCard);
+            });
+            
+            container.innerHTML = '';
+            container.appendChild(fileGrid);
+            
+            // 先批量提交本页图片的缩略图生成，再开始加载
+            const images = files.filter(hasThumbnail).map(f => f.name);
+            const loadThumbs = () => fileGrid.querySelectorAll('img.file-thumb[data-src]').forEach(img => {
+                img.src = img.dataset.src;
+                img.removeAttribute('data-src');
+            });
+            if (images.length === 0) return;
+            fetch('/thumb/prefetch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ path: currentPath, files: images, size: 256 })
+            }).finally(loadThumbs);
+        }
+        
+        // 在线预览：视频/音频通过 /stream 按需加载，拖动进度只请求需要的字节范围
+        function getPreviewType(file) {
+            if (file.is_dir) return null;
+            const ext = file.name.split('.').pop().toLowerCase();
+            if (['mp4', 'm4v', 'mov', 'webm', 'mkv', 'ogv'].includes(ext)) return 'video';
+            if (['mp3', 'm4a', 'aac', 'wav', 'flac', 'ogg', 'opus'].includes(ext)) return 'audio';
+            if (['jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp'].includes(ext)) return 'image';
+            if (['txt', 'log', 'out', 'err', 'md', 'csv', 'tsv', 'json', 'jsonl', 'xml', 'yaml', 'yml', 'ini', 'conf', 'cfg',
+                 'py', 'js', 'ts', 'java', 'c', 'h', 'cpp', 'go', 'rs', 'sh', 'sql', 'html', 'css'].includes(ext)) return 'text';
+            return null;
+        }
+        
+        function previewFile(filename) {
+            const type = getPreviewType({ name: filename, is_dir: false });
+            if (type === 'text') {
+                viewTextFile(filename);
+                return;
+            }
+            const url = `/stream?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(filename)}`;
+            const players = {
+                video: `<video src="${url}" controls autoplay preload="metadata" style="width: 100%; max-height: 65vh; background: #000; border-radius: 6px;"></video>`,
+                audio: `<audio src="${url}" controls autoplay preload="metadata" style="width: 100%;"></audio>`,
+                image: `<img src="${url}" alt="" style="max-width: 100%; max-height: 65vh; display: block; margin: 0 auto;">`
+            };
+            
+            const modal = document.createElement('div');
+            modal.className = 'modal';
+            modal.innerHTML = `
+                <div class="modal-content" style="max-width: 960px;">
+                    <div class="modal-header">
+                        <h3 class="modal-title" style="word-break: break-all;">${escapeHtml(filename)}</h3>
+                        <button class="modal-close">×</button>
+                    </div>
+                    <div class="modal-body">${players[type]}</div>
+                    <div class="modal-footer">
+                        <a class="btn btn-secondary" href="/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(filename)}">
+                            <i class="fas fa-download"></i> 下载
+                        </a>
+                        <button class="btn btn-secondary modal-close-btn">关闭</button>
+                    </div>
+                </div>
+            `;
+            // 关闭时停止播放，释放连接
+            const close = () => {
+                const media = modal.querySelector('video, audio');
+                if (media) {
+                    media.pause();
+                    media.removeAttribute('src');
+                    media.load();
+                }
+                modal.remove();
+            };
+            modal.querySelector('.modal-close').addEventListener('click', close);
+            modal.querySelector('.modal-close-btn').addEventListener('click', close);
+            document.body.appendChild(modal);
+        }
+        
+        // 文本查看：按页从 /view-text 读取，大日志文件无需整体下载；“跟踪”模式轮询末尾新增内容
+        function viewTextFile(filename) {
+            const query = `path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(filename)}`;
+            const pageSize = 200;
+            let startLine = 0;
+            let followOffset = null;
+            let followTimer = null;
+            let generation = 0;  // 翻页或停止跟踪后丢弃仍在途中的轮询结果
+            
+            const modal = document.createElement('div');
+            modal.className = 'modal';
+            modal.innerHTML = `
+                <div class="modal-content" style="max-width: 1000px;">
+                    <div class="modal-header">
+                        <h3 class="modal-title" style="word-break: break-all;">${escapeHtml(filename)}</h3>
+                        <button class="modal-close">×</button>
+                    </div>
+                    <div class="modal-body">
+                        <pre class="text-view" style="height: 60vh; overflow: auto; background: #1a202c; color: #e2e8f0; padding: 12px; border-radius: 6px; font-size: 12px; white-space: pre-wrap; word-break: break-all;"></pre>
+                        <div class="text-view-status" style="color: #718096; font-size: 13px; margin-top: 8px;"></div>
+                    </div>
+                    <div class="modal-footer">
+                        <button class="btn btn-secondary" data-action="first">开头</button>
+                        <button class="btn btn-secondary" data-action="prev">上一页</button>
+                        <button class="btn btn-secondary" data-action="next">下一页</button>
+                        <button class="btn btn-secondary" data-action="tail">末尾</button>
+                        <button class="btn btn-primary" data-action="follow">跟踪</button>
+                    </div>
+                </div>
+            `;
+            const view = modal.querySelector('.text-view');
+            const status = modal.querySelector('.text-view-status');
+            const followButton = modal.querySelector('[data-action="follow"]');
+            
+            const stopFollow = () => {
+                generation++;
+                clearTimeout(followTimer);
+                followOffset = null;
+                followButton.textContent = '跟踪';
+            };
+            
+            const showPage = async (line) => {
+                stopFollow();
+                const data = await fetch(`/view-text?${query}&mode=lines&start=${line}&lines=${pageSize}`).then(r => r.json());
+                if (!data.success) {
+                    status.textContent = data.message;
+                    return;
+                }
+                startLine = line;
+                view.textContent = data.lines.join('\n');
+                view.scrollTop = 0;
+                const total = data.total_lines !== undefined ? ` / 共 ${data.total_lines} 行` : '';
+                status.textContent = `第 ${line + 1} - ${data.next_line} 行${total}（${formatFileSize(data.size)}）`;
+            };
+            
+            const poll = async (follow) => {
+                const current = generation;
+                const since = followOffset === null ? '' : `&since=${followOffset}`;
+                const data = await fetch(`/view-text?${query}&mode=tail&lines=${pageSize}${since}`).then(r => r.json());
+                if (current !== generation) return;
+                if (data.success) {
+                    const atBottom = view.scrollTop + view.clientHeight >= view.scrollHeight - 20;
+                    if (followOffset === null || data.reset) {
+                        view.textContent = data.lines.join('\n');
+                    } else if (data.lines.length) {
+                        view.textContent += (view.textContent ? '\n' : '') + data.lines.join('\n');
+                    }
+                    followOffset = data.next_offset;
+                    if (atBottom || data.reset) view.scrollTop = view.scrollHeight;
+                    status.textContent = `末尾（${formatFileSize(data.size)}）${follow ? ' · 跟踪中' : ''}`;
+                } else {
+                    status.textContent = data.message;
+                }
+                if (follow) {
+                    followTimer = setTimeout(() => poll(true), 2000);
+                }
+            };
+            
+            const showTail = () => {
+                stopFollow();
+                poll(false).then(() => { view.scrollTop = view.scrollHeight; });
+            };
+            
+            const close = () => {
+                stopFollow();
+                modal.remove();
+            };
+            modal.querySelector('.modal-close').addEventListener('click', close);
+            modal.querySelector('.modal-footer').addEventListener('click', (e) => {
+                const action = e.target.dataset.action;
+                if (action === 'first') showPage(0);
+                if (action === 'prev') showPage(Math.max(0, startLine - pageSize));
+                if (action === 'next') showPage(startLine + pageSize);
+                if (action === 'tail') showTail();
+                if (action === 'follow') {
+                    if (followButton.textContent === '停止跟踪') {
+                        stopFollow();
+                        status.textContent = '已停止跟踪';
                     } else {
-                        window.location.href = `/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(file.name)}`;
+                        stopFollow();
+                        followButton.textContent = '停止跟踪';
+                        poll(true).then(() => { view.scrollTop = view.scrollHeight; });
                     }
-                });
-                
-                // 右键菜单
-                fileCard.addEventListener('contextmenu', (e) => {
-                    e.preventDefault();
-                    showContextMenu(e, file);
-                });
-                
-                fileGrid.appendChild(fileCard);
+                }
             });
-            
-            container.innerHTML = '';
-            container.appendChild(fileGrid);
+            document.body.appendChild(modal);
+            showPage(0);
+        }
+        
+        function hasThumbnail(file) {
+            if (file.is_dir) return false;
+            const ext = file.name.split('.').pop().toLowerCase();
+            return ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp'].includes(ext);
         }
         
         function openFolder(folderName) {
@@ -1755,7 +4988,7 @@ def index():
         }
         
         function deleteFile(filename, isDir) {
-            if (!confirm(`确定要删除${isDir ? '文件夹' : '文件'} "${filename}" 吗？`)) {
+            if (!confirm(`确定要将${isDir ? '文件夹' : '文件'} "${filename}" 移入回收站吗？`)) {
                 return;
             }
             
@@ -1772,14 +5005,14 @@ def index():
             .then(response => response.json())
             .then(data => {
                 if (data.success) {
-                    showMessage('删除成功！', 'success');
+                    showToast(data.message, 'success');
                     loadFiles(currentPath);
                 } else {
-                    showMessage('删除失败: ' + data.message, 'error');
+                    showToast('删除失败: ' + data.message, 'error');
                 }
             })
             .catch(error => {
-                showMessage('删除失败，请重试', 'error');
+                showToast('删除失败，请重试', 'error');
                 console.error('Error:', error);
             });
         }
@@ -1799,8 +5032,15 @@ def index():
             }
         }
         
+        function folderSizeText(file) {
+            if (file.file_count === undefined) return '文件夹';
+            if (file.file_count === null) return '文件夹 · 大小统计中';
+            return `${formatFileSize(file.size)} · ${file.file_count} 个文件`;
+        }
+        
         function formatFileSize(bytes) {
             const sizes = ['B', 'KB', 'MB', 'GB', 'TB'];
+            if (bytes === null) return '统计中';
             if (bytes === 0) return '0 B';
             
             const i = Math.floor(Math.log(bytes) / Math.log(1024));
@@ -1977,7 +5217,19 @@ def index():
         function updateTransferList() {
             const container = document.getElementById('transferList');
             
-            if (transferTasks.length === 0) {
+            // 本页发起的任务补充服务端的速率和剩余时间；其余服务端传输来自其他标签页或设备
+            const tasks = transferTasks.map(task => Object.assign({}, task, {
+                server: serverTransfers.find(t => t.ref === task.id)
+            }));
+            serverTransfers.filter(t => !transferTasks.some(task => task.id === t.ref)).forEach(t => tasks.push({
+                id: t.id,
+                name: t.name,
+                progress: t.total && t.done !== null ? Math.min(100, Math.round(t.done / t.total * 100)) : 0,
+                status: t.direction === 'upload' ? 'uploading' : 'downloading',
+                server: t
+            }));
+            
+            if (tasks.length === 0) {
                 container.innerHTML = `
                     <div style="text-align: center; padding: 40px; color: #718096;">
                         <i class="fas fa-exchange-alt" style="font-size: 48px; margin-bottom: 16px;"></i>
@@ -1987,7 +5239,7 @@ def index():
                 return;
             }
             
-            container.innerHTML = transferTasks.map(task => `
+            container.innerHTML = tasks.map(task => `
                 <div class="transfer-item">
                     <div class="transfer-name">${escapeHtml(task.name)}</div>
                     <div class="transfer-progress">
@@ -1999,14 +5251,105 @@ def index():
                     <div style="font-size: 12px; color: #718096; margin-top: 4px;">
                         ${task.status === 'uploading' ? '上传中' : 
                           task.status === 'downloading' ? '下载中' : 
+                          task.status === 'queued' ? '排队中' : 
+                          task.status === 'running' ? '处理中' : 
+                          task.status === 'cancelled' ? '已取消' : 
                           task.status === 'completed' ? '已完成' : '错误'}
+                        ${task.jobId && (task.status === 'queued' || task.status === 'running') ? 
+                            `<a href="#" onclick="cancelJob('${task.jobId}'); return false;" style="margin-left: 8px; color: #e53e3e;">取消</a>` : ''}
+                        ${task.server ? `<span style="margin-left: 8px;">${transferRateText(task.server)}</span>` : ''}
                     </div>
                 </div>
             `).join('');
         }
         
-        function updateTransferProgress() {
-            // 这里可以添加实时进度更新逻辑
+        // 后台任务：轮询 /jobs/<id> 并在传输面板中显示进度
+        function trackJob(jobId, name, onDone) {
+            const task = {
+                id: 'job_' + jobId,
+                jobId: jobId,
+                type: 'job',
+                name: name,
+                progress: 0,
+                status: 'queued'
+            };
+            transferTasks.push(task);
+            updateTransferList();
+            document.getElementById('transferPanel').classList.add('show');
+            
+            const poll = () => {
+                fetch(`/jobs/${jobId}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        if (!data.success) {
+                            task.status = 'error';
+                            updateTransferList();
+                            return;
+                        }
+                        const job = data.job;
+                        task.status = job.status === 'failed' ? 'error' : job.status;
+                        if (job.progress.total > 0) {
+                            task.progress = Math.min(100, Math.round(job.progress.done / job.progress.total * 100));
+                        }
+                        if (job.status === 'completed') task.progress = 100;
+                        updateTransferList();
+                        
+                        if (job.status === 'queued' || job.status === 'running') {
+                            setTimeout(poll, 1000);
+                            return;
+                        }
+                        if (job.status === 'failed') {
+                            showToast(`${name} 处理失败: ${job.error}`, 'error');
+                        }
+                        if (onDone) onDone(job);
+                        setTimeout(() => {
+                            const index = transferTasks.indexOf(task);
+                            if (index !== -1) {
+                                transferTasks.splice(index, 1);
+                                updateTransferList();
+                            }
+                        }, 3000);
+                    })
+                    .catch(() => setTimeout(poll, 3000));
+            };
+            poll();
+        }
+        
+        function cancelJob(jobId) {
+            fetch(`/jobs/${jobId}/cancel`, { method: 'POST' })
+                .then(response => response.json())
+                .then(data => showToast(data.message, data.success ? 'info' : 'error'))
+                .catch(() => showToast('取消失败，请重试', 'error'));
+        }
+        
+        // 服务端通过 SSE 推送传输进度；没有传输时关闭连接（服务端返回 204 时浏览器也不再重连），
+        // 本页发起上传或下载时立即重新订阅，页面可见时每 15 秒检查一次其他标签页或设备的传输
+        function connectTransferStream() {
+            if (transferSource && transferSource.readyState !== EventSource.CLOSED) return;
+            transferSource = new EventSource('/transfers/stream');
+            transferSource.onmessage = function(e) {
+                serverTransfers = JSON.parse(e.data).transfers;
+                updateTransferList();
+                // 传输已全部结束：关闭连接，发起新的上传或下载时再订阅
+                if (serverTransfers.length === 0) transferSource.close();
+            };
+            // 推送名额已满（429/503）时浏览器不会自动重连：本页还有上传进行中就稍后再试
+            transferSource.onerror = function() {
+                if (transferSource.readyState === EventSource.CLOSED && transferTasks.some(task => task.status === 'uploading')) {
+                    setTimeout(connectTransferStream, 5000);
+                }
+            };
+        }
+        
+        function transferRateText(transfer) {
+            if (transfer.done === null) return formatFileSize(transfer.total) + ' · 发送中';
+            let text = formatFileSize(Math.round(transfer.rate)) + '/s';
+            if (transfer.eta !== null) {
+                const eta = Math.round(transfer.eta);
+                text += ' · 剩余 ' + (eta >= 60 ? `${Math.floor(eta / 60)}分${eta % 60}秒` : `${eta}秒`);
+            }
+            if (transfer.stalled) text += ' · 已停滞';
+            return text;
         }
         
         // 存储信息
@@ -2066,40 +5409,95 @@ def index():
         function downloadSelected() {
             if (selectedFiles.size === 0) return;
             
-            selectedFiles.forEach(filename => {
-                const url = `/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(filename)}`;
+            if (selectedFiles.size === 1) {
+                const filename = Array.from(selectedFiles)[0];
+                const item = document.querySelector(`[data-filename="${CSS.escape(filename)}"]`);
+                if (item && item.dataset.isdir === 'true') {
+                    // 文件夹在后台打包，完成后再下载
+                    fetch('/jobs', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ type: 'archive', path: currentPath, files: [filename] })
+                    })
+                    .then(response => response.json())
+                    .then(data => {
+                        if (!data.success) {
+                            showToast('打包失败: ' + data.message, 'error');
+                            return;
+                        }
+                        trackJob(data.job_id, filename + '.zip', job => {
+                            if (job.status === 'completed') {
+                                window.location.href = `/jobs/${job.id}/download`;
+                                setTimeout(connectTransferStream, 1000);
+                            }
+                        });
+                    })
+                    .catch(() => showToast('打包失败，请重试', 'error'));
+                    return;
+                }
                 const a = document.createElement('a');
-                a.href = url;
+                a.href = `/download?path=${encodeURIComponent(currentPath)}&filename=${encodeURIComponent(filename)}`;
                 a.download = filename;
                 document.body.appendChild(a);
                 a.click();
                 document.body.removeChild(a);
+                return;
+            }
+            
+            // 多选时由服务器打包成一个zip流式下载
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/batch-download';
+            form.style.display = 'none';
+            const fields = [['path', currentPath]].concat(Array.from(selectedFiles).map(f => ['files', f]));
+            fields.forEach(([name, value]) => {
+                const input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = name;
+                input.value = value;
+                form.appendChild(input);
             });
+            document.body.appendChild(form);
+            form.submit();
+            document.body.removeChild(form);
+            setTimeout(connectTransferStream, 1000);
+            showToast(`正在打包下载 ${selectedFiles.size} 个项目`, 'info');
         }
         
         function deleteSelected() {
             if (selectedFiles.size === 0) return;
             
-            if (!confirm(`确定要删除选中的 ${selectedFiles.size} 个项目吗？`)) {
+            if (!confirm(`确定要将选中的 ${selectedFiles.size} 个项目移入回收站吗？`)) {
                 return;
             }
             
-            const promises = Array.from(selectedFiles).map(filename => {
-                return fetch('/delete', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        path: currentPath,
-                        filename: filename
-                    })
-                });
-            });
-            
-            Promise.all(promises).then(() => {
+            fetch('/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    action: 'delete',
+                    path: currentPath,
+                    files: Array.from(selectedFiles),
+                    async: true
+                })
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    showToast('删除失败: ' + data.message, 'error');
+                    return;
+                }
+                const count = selectedFiles.size;
                 selectedFiles.clear();
-                loadFiles(currentPath);
-                showToast('删除成功！', 'success');
-            }).catch(() => {
+                trackJob(data.job_id, `删除 ${count} 个项目`, job => {
+                    loadFiles(currentPath);
+                    if (job.status === 'completed') {
+                        const failed = job.result.results.filter(r => !r.success).length;
+                        showToast(failed ? `删除完成，${failed} 项失败` : '已移入回收站', failed ? 'error' : 'success');
+                    }
+                });
+            })
+            .catch(() => {
                 showToast('删除失败，请重试', 'error');
             });
         }
@@ -2238,6 +5636,12 @@ def index():
                     case 'quick-transfer':
                         showQuickTransferPage();
                         break;
+                    case 'trash':
+                        showTrashPage();
+                        break;
+                    case 'users':
+                        showUsersPage();
+                        break;
                     default:
                         showFilesPage();
                 }
@@ -2263,16 +5667,24 @@ def index():
         }
         
         function showRecentPage() {
-            const container = document.getElementById('fileContainer');
             // 隐藏上传区域和工具栏
             document.querySelector('.upload-zone').style.display = 'none';
             document.querySelector('.toolbar').style.display = 'none';
             
-            fetch('/recent-files')
+            loadRecentFiles(null);
+        }
+        
+        const RECENT_ACTION_LABELS = { upload: '上传', download: '下载', share: '分享', rename: '重命名', delete: '删除', move: '移动', copy: '复制' };
+        
+        // 最近文件按时间倒序分页加载，before 为上一页返回的 next_before（null 表示第一页）
+        function loadRecentFiles(before) {
+            const container = document.getElementById('fileContainer');
+            const url = before === null ? '/recent-files' : `/recent-files?before=${before}`;
+            fetch(url)
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
-                        displayRecentFiles(data.files);
+                        displayRecentFiles(data.files, data.next_before, before !== null);
                     } else {
                         container.innerHTML = '<div style="text-align: center; padding: 60px; color: #718096;">加载最近文件失败</div>';
                     }
@@ -2282,10 +5694,10 @@ def index():
                 });
         }
         
-        function displayRecentFiles(files) {
+        function displayRecentFiles(files, nextBefore, append) {
             const container = document.getElementById('fileContainer');
             
-            if (files.length === 0) {
+            if (files.length === 0 && !append) {
                 container.innerHTML = `
                     <div style="text-align: center; padding: 60px; color: #718096;">
                         <i class="fas fa-clock" style="font-size: 48px; margin-bottom: 16px; display: block;"></i>
@@ -2295,34 +5707,47 @@ def index():
                 return;
             }
             
-            const fileList = document.createElement('div');
-            fileList.className = 'file-list';
+            let fileList = append ? container.querySelector('.file-list') : null;
+            if (!fileList) {
+                fileList = document.createElement('div');
+                fileList.className = 'file-list';
+                container.innerHTML = '';
+                container.appendChild(fileList);
+            }
+            const previousMore = container.querySelector('.recent-more');
+            if (previousMore) previousMore.remove();
             
             files.forEach(file => {
                 const timeAgo = getTimeAgo(file.timestamp);
                 const fileItem = document.createElement('div');
                 fileItem.className = 'file-item';
+                const location = file.path ? ` • /${escapeHtml(file.path)}` : '';
+                const actions = file.action === 'delete' ? '' : `
+                        <a href="/download?path=${encodeURIComponent(file.path)}&filename=${encodeURIComponent(file.name)}" class="btn btn-secondary">
+                            <i class="fas fa-download"></i> 下载
+                        </a>`;
                 
                 fileItem.innerHTML = `
-                    <div class="file-icon default">
-                        <i class="fas fa-file"></i>
-                    </div>
+                    <div class="file-icon ${getFileIconClass(file)}">${getFileIcon(file)}</div>
                     <div class="file-info">
                         <div class="file-name">${escapeHtml(file.name)}</div>
-                        <div class="file-meta">${formatFileSize(file.size)} • ${timeAgo} • ${file.action === 'upload' ? '上传' : '下载'}</div>
+                        <div class="file-meta">${formatFileSize(file.size)}${location} • ${timeAgo} • ${RECENT_ACTION_LABELS[file.action] || file.action}</div>
                     </div>
-                    <div class="file-actions">
-                        <a href="/download?path=${encodeURIComponent(file.path)}&filename=${encodeURIComponent(file.name)}" class="btn btn-secondary">
-                            <i class="fas fa-download"></i> 下载
-                        </a>
+                    <div class="file-actions">${actions}
                     </div>
                 `;
                 
                 fileList.appendChild(fileItem);
             });
             
-            container.innerHTML = '';
-            container.appendChild(fileList);
+            if (nextBefore !== null) {
+                const more = document.createElement('div');
+                more.className = 'recent-more';
+                more.style.cssText = 'text-align: center; padding: 16px;';
+                more.innerHTML = '<button class="btn btn-secondary">加载更多</button>';
+                more.querySelector('button').addEventListener('click', () => loadRecentFiles(nextBefore));
+                container.appendChild(more);
+            }
         }
         
         function showSharedPage() {
@@ -2450,6 +5875,261 @@ def index():
             loadQuickTransferFiles();
         }
         
+        function showTrashPage() {
+            const container = document.getElementById('fileContainer');
+            document.querySelector('.upload-zone').style.display = 'none';
+            document.querySelector('.toolbar').style.display = 'none';
+            
+            fetch('/trash')
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        displayTrash(data.items);
+                    } else {
+                        container.innerHTML = '<div style="text-align: center; padding: 60px; color: #718096;">加载回收站失败</div>';
+                    }
+                })
+                .catch(() => {
+                    container.innerHTML = '<div style="text-align: center; padding: 60px; color: #718096;">加载回收站失败</div>';
+                });
+        }
+        
+        function displayTrash(items) {
+            const container = document.getElementById('fileContainer');
+            
+            if (items.length === 0) {
+                container.innerHTML = `
+                    <div style="text-align: center; padding: 60px; color: #718096;">
+                        <i class="fas fa-trash" style="font-size: 48px; margin-bottom: 16px; display: block;"></i>
+                        回收站为空
+                    </div>
+                `;
+                return;
+            }
+            
+            const trashList = document.createElement('div');
+            trashList.className = 'file-list';
+            
+            const header = document.createElement('div');
+            header.className = 'file-item';
+            header.innerHTML = `
+                <div class="file-info">
+                    <div class="file-meta">共 ${items.length} 项，到期后自动彻底删除</div>
+                </div>
+                <div class="file-actions">
+                    <button class="btn btn-danger" onclick="emptyTrash(null)">
+                        <i class="fas fa-trash"></i> 清空回收站
+                    </button>
+                </div>
+            `;
+            trashList.appendChild(header);
+            
+            items.forEach(item => {
+                const trashItem = document.createElement('div');
+                trashItem.className = 'file-item';
+                trashItem.innerHTML = `
+                    <div class="file-icon ${getFileIconClass(item)}">${getFileIcon(item)}</div>
+                    <div class="file-info">
+                        <div class="file-name">${escapeHtml(item.name)}</div>
+                        <div class="file-meta">${item.is_dir ? '文件夹' : formatFileSize(item.size || 0)} • 原位置: /${escapeHtml(item.original_path)} • ${getTimeAgo(item.deleted_at)}删除</div>
+                    </div>
+                    <div class="file-actions">
+                        <button class="btn btn-secondary" onclick="restoreTrash('${item.id}')">
+                            <i class="fas fa-undo"></i> 恢复
+                        </button>
+                        <button class="btn btn-danger" onclick="emptyTrash(['${item.id}'])">
+                            <i class="fas fa-times"></i> 彻底删除
+                        </button>
+                    </div>
+                `;
+                trashList.appendChild(trashItem);
+            });
+            
+            container.innerHTML = '';
+            container.appendChild(trashList);
+        }
+        
+        // 用户管理（仅管理员）
+        function showUsersPage() {
+            const container = document.getElementById('fileContainer');
+            document.querySelector('.upload-zone').style.display = 'none';
+            document.querySelector('.toolbar').style.display = 'none';
+            
+            fetch('/admin/users')
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        displayUsers(data.users);
+                    } else {
+                        container.innerHTML = `<div style="text-align: center; padding: 60px; color: #718096;">${escapeHtml(data.message)}</div>`;
+                    }
+                })
+                .catch(() => {
+                    container.innerHTML = '<div style="text-align: center; padding: 60px; color: #718096;">加载用户列表失败</div>';
+                });
+        }
+        
+        function displayUsers(users) {
+            const container = document.getElementById('fileContainer');
+            const userList = document.createElement('div');
+            userList.className = 'file-list';
+            
+            const header = document.createElement('div');
+            header.className = 'file-item';
+            header.innerHTML = `
+                <div class="file-info">
+                    <div class="file-meta">共 ${users.length} 个用户，每个用户只能访问自己的空间</div>
+                </div>
+                <div class="file-actions">
+                    <button class="btn btn-primary" onclick="showCreateUserModal()">
+                        <i class="fas fa-user-plus"></i> 新建用户
+                    </button>
+                </div>
+            `;
+            userList.appendChild(header);
+            
+            users.forEach(user => {
+                const percent = user.quota ? Math.min(100, user.used / user.quota * 100).toFixed(1) : 0;
+                const item = document.createElement('div');
+                item.className = 'file-item';
+                item.innerHTML = `
+                    <div class="file-icon"><i class="fas ${user.is_admin ? 'fa-user-shield' : 'fa-user'}"></i></div>
+                    <div class="file-info">
+                        <div class="file-name">${escapeHtml(user.username)}${user.is_admin ? '（管理员）' : ''}${user.disabled ? '（已停用）' : ''}</div>
+                        <div class="file-meta">已用 ${formatFileSize(user.used)} / ${formatFileSize(user.quota)}（${percent}%）</div>
+                    </div>
+                    <div class="file-actions">
+                        <button class="btn btn-secondary" onclick="updateUser('${escapeHtml(user.username)}', 'quota', ${user.quota})">
+                            <i class="fas fa-hdd"></i> 配额
+                        </button>
+                        <button class="btn btn-secondary" onclick="updateUser('${escapeHtml(user.username)}', 'password')">
+                            <i class="fas fa-key"></i> 重置密码
+                        </button>
+                        ${user.is_admin ? '' : `
+                        <button class="btn ${user.disabled ? 'btn-secondary' : 'btn-danger'}" onclick="updateUser('${escapeHtml(user.username)}', 'disabled', ${!user.disabled})">
+                            <i class="fas ${user.disabled ? 'fa-user-check' : 'fa-user-slash'}"></i> ${user.disabled ? '启用' : '停用'}
+                        </button>`}
+                    </div>
+                `;
+                userList.appendChild(item);
+            });
+            
+            container.innerHTML = '';
+            container.appendChild(userList);
+        }
+        
+        function showCreateUserModal() {
+            const modal = document.createElement('div');
+            modal.className = 'modal';
+            modal.innerHTML = `
+                <div class="modal-content">
+                    <div class="modal-header">
+                        <h3 class="modal-title">新建用户</h3>
+                        <button class="modal-close" onclick="this.closest('.modal').remove()">×</button>
+                    </div>
+                    <div class="modal-body">
+                        <div class="form-group">
+                            <label class="form-label">用户名：</label>
+                            <input type="text" class="form-input" id="newUsername">
+                        </div>
+                        <div class="form-group">
+                            <label class="form-label">密码：</label>
+                            <input type="password" class="form-input" id="newUserPassword">
+                        </div>
+                        <div class="form-group">
+                            <label class="form-label">配额（GB）：</label>
+                            <input type="number" class="form-input" id="newUserQuota" value="20" min="1">
+                        </div>
+                    </div>
+                    <div class="modal-footer">
+                        <button class="btn btn-primary" onclick="createUser()">创建</button>
+                        <button class="btn btn-secondary" onclick="this.closest('.modal').remove()">取消</button>
+                    </div>
+                </div>
+            `;
+            document.body.appendChild(modal);
+            document.getElementById('newUsername').focus();
+        }
+        
+        function createUser() {
+            const username = document.getElementById('newUsername').value.trim();
+            const password = document.getElementById('newUserPassword').value;
+            const quota = Math.round(parseFloat(document.getElementById('newUserQuota').value) * 1024 * 1024 * 1024);
+            
+            fetch('/admin/users', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ username, password, quota })
+            })
+            .then(response => response.json())
+            .then(data => {
+                showToast(data.message, data.success ? 'success' : 'error');
+                if (data.success) {
+                    document.querySelector('.modal').remove();
+                    showUsersPage();
+                }
+            })
+            .catch(() => showToast('创建用户失败，请重试', 'error'));
+        }
+        
+        function updateUser(username, field, value) {
+            const body = {};
+            if (field === 'quota') {
+                const input = prompt('新的配额（GB）：', (value / 1024 / 1024 / 1024).toFixed(0));
+                if (!input) return;
+                body.quota = Math.round(parseFloat(input) * 1024 * 1024 * 1024);
+            } else if (field === 'password') {
+                const input = prompt(`为 ${username} 设置新密码：`);
+                if (!input) return;
+                body.password = input;
+            } else {
+                body.disabled = value;
+            }
+            
+            fetch(`/admin/users/${encodeURIComponent(username)}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(body)
+            })
+            .then(response => response.json())
+            .then(data => {
+                showToast(data.message, data.success ? 'success' : 'error');
+                showUsersPage();
+            })
+            .catch(() => showToast('操作失败，请重试', 'error'));
+        }
+        
+        function restoreTrash(trashId) {
+            fetch('/trash/restore', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ids: [trashId] })
+            })
+            .then(response => response.json())
+            .then(data => {
+                showToast(data.message, data.success ? 'success' : 'error');
+                showTrashPage();
+            })
+            .catch(() => showToast('恢复失败，请重试', 'error'));
+        }
+        
+        function emptyTrash(ids) {
+            if (!confirm(ids ? '确定要彻底删除该项吗？此操作不可恢复' : '确定要清空回收站吗？此操作不可恢复')) return;
+            
+            fetch('/trash/empty', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(ids ? { ids: ids } : {})
+            })
+            .then(response => response.json())
+            .then(data => {
+                showToast(data.message, data.success ? 'success' : 'error');
+                showTrashPage();
+                loadStorageInfo();
+            })
+            .catch(() => showToast('删除失败，请重试', 'error'));
+        }
+        
         // 辅助函数
         function getTimeAgo(timestamp) {
             const now = new Date();
@@ -2640,6 +6320,7 @@ def index():
         
         function downloadQuickFile(filename) {
             window.location.href = `/quick-transfer-download?filename=${encodeURIComponent(filename)}`;
+            setTimeout(connectTransferStream, 1000);
         }
         
         // 重命名功能
@@ -2709,6 +6390,67 @@ def index():
             });
         }
         
+        // 移动 / 复制
+        function showMoveCopyModal(filename, action) {
+            const title = action === 'move' ? '移动到' : '复制到';
+            const modal = document.createElement('div');
+            modal.className = 'modal';
+            modal.innerHTML = `
+                <div class="modal-content">
+                    <div class="modal-header">
+                        <h3 class="modal-title">${title}</h3>
+                        <button class="modal-close" onclick="this.closest('.modal').remove()">×</button>
+                    </div>
+                    <div class="modal-body">
+                        <div class="form-group">
+                            <label class="form-label">目标文件夹（相对根目录，留空表示根目录）：</label>
+                            <input type="text" class="form-input" id="targetPathInput" value="${escapeHtml(currentPath)}">
+                        </div>
+                    </div>
+                    <div class="modal-footer">
+                        <button class="btn btn-primary" onclick="performMoveCopy('${escapeHtml(filename)}', '${action}')">确定</button>
+                        <button class="btn btn-secondary" onclick="this.closest('.modal').remove()">取消</button>
+                    </div>
+                </div>
+            `;
+            document.body.appendChild(modal);
+            document.getElementById('targetPathInput').focus();
+        }
+        
+        function performMoveCopy(filename, action) {
+            const targetPath = document.getElementById('targetPathInput').value.trim();
+            const actionText = action === 'move' ? '移动' : '复制';
+            document.querySelector('.modal').remove();
+            
+            fetch('/' + action, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    path: currentPath,
+                    filename: filename,
+                    target_path: targetPath
+                })
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success && data.job_id) {
+                    trackJob(data.job_id, `${actionText} ${filename}`, job => {
+                        loadFiles(currentPath);
+                        const item = job.result && job.result.results[0];
+                        if (item) showToast(item.message, item.success ? 'success' : 'error');
+                    });
+                } else if (data.success) {
+                    showToast(data.message, 'success');
+                    loadFiles(currentPath);
+                } else {
+                    showToast(`${actionText}失败: ` + data.message, 'error');
+                }
+            })
+            .catch(() => {
+                showToast(`${actionText}失败，请重试`, 'error');
+            });
+        }
+        
         // 文件详情
         function showFileDetails(filename) {
             fetch(`/files?path=${encodeURIComponent(currentPath)}`)
@@ -2770,12 +6512,20 @@ def index():
 </body>
 </html>
     """
-    return render_template_string(html_template, session=session)
+    return render_template_string(html_template, session=session, is_admin=bool(current_user()['is_admin']))
 
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_files():
-    """处理文件上传"""
+    """处理文件上传：先预检并预留空间，再读取请求体"""
+    try:
+        with reserve_upload_space(current_user(), declared_upload_size()):
+            return receive_upload()
+    except UploadRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
+
+def receive_upload():
+    """读取并保存上传的文件"""
     try:
         if 'files' not in request.files:
             return jsonify({'success': False, 'message': '没有找到文件'})
@@ -2798,19 +6548,19 @@ def upload_files():
                     relative_path = paths[i]
                     # 确保路径安全
                     relative_path = relative_path.replace('..', '').strip('/')
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], target_path, relative_path)
+                    file_path = user_path(target_path, relative_path)
                 else:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], target_path, filename)
+                    file_path = user_path(target_path, filename)
                 
-                # 创建目录（如果不存在）
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                if not file_path:
+                    return jsonify({'success': False, 'message': '无效的路径'})
                 
-                # 保存文件
-                file.save(file_path)
+                # 保存文件（自动创建上级目录）
+                storage_save(file, file_path)
                 uploaded_files.append(filename)
                 
-                # 添加到最近使用文件
-                add_to_recent_files(filename, target_path)
+                # 添加到最近使用文件（文件夹上传时文件位于相对路径下）
+                record_activity('upload', file_path)
         
         return jsonify({
             'success': True, 
@@ -2821,32 +6571,50 @@ def upload_files():
     except Exception as e:
         return jsonify({'success': False, 'message': f'上传失败: {str(e)}'})
 
+@app.route('/upload/preflight', methods=['POST'])
+@login_required
+def upload_preflight():
+    """上传前询问：按声明的总大小检查配额和磁盘空间，避免发送注定失败的请求体"""
+    data = request.get_json(silent=True)
+    try:
+        size = int(data.get('size', 0))
+    except (AttributeError, TypeError, ValueError):
+        size = -1
+    if size < 0:
+        return jsonify({'success': False, 'message': '无效的文件大小'})
+    user = current_user()
+    reserved = get_db().execute(
+        'SELECT COALESCE(SUM(bytes), 0) FROM upload_reservations WHERE username = ?', (user['username'],)
+    ).fetchone()[0]
+    message = quota_error(user, reserved + size)
+    if message is not None:
+        return jsonify({'success': False, 'message': message})
+    if disk_free_bytes() - UPLOAD_DISK_HEADROOM < size:
+        return jsonify({'success': False, 'message': '服务器磁盘空间不足'})
+    return jsonify({'success': True})
+
 @app.route('/files')
 @login_required
 def list_files():
     """获取文件列表"""
     try:
-        path = request.args.get('path', '')
-        full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+        path = user_path(request.args.get('path', ''))
         
         # 安全检查，防止路径遍历攻击
-        full_path = os.path.abspath(full_path)
-        upload_path = os.path.abspath(app.config['UPLOAD_FOLDER'])
-        
-        if not full_path.startswith(upload_path):
+        if path is None:
             return jsonify({'success': False, 'message': '无效的路径'})
         
-        if not os.path.exists(full_path):
-            os.makedirs(full_path, exist_ok=True)
+        if not storage_exists(path):
+            storage_makedirs(path)
         
-        files = []
-        for item in os.listdir(full_path):
-            item_path = os.path.join(full_path, item)
-            try:
-                file_info = get_file_info(item_path)
-                files.append(file_info)
-            except (OSError, IOError):
-                continue  # 跳过无法访问的文件
+        files = storage_list(path)
+        if path == '':
+            files = [f for f in files if f['name'] not in (TRASH_DIR, USERS_DIR, INCOMING_DIR)]
+        
+        # 文件夹大小取自目录汇总
+        for f in files:
+            if f['is_dir']:
+                f['size'], f['file_count'] = tree_totals(normalize_path(f['name'], root=path))
         
         # 排序：文件夹在前，然后按名称排序
         files.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
@@ -2867,19 +6635,18 @@ def download_file():
         if not filename:
             return jsonify({'success': False, 'message': '文件名不能为空'})
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], path, filename)
+        file_path = user_path(path, filename)
         
         # 安全检查
-        file_path = os.path.abspath(file_path)
-        upload_path = os.path.abspath(app.config['UPLOAD_FOLDER'])
-        
-        if not file_path.startswith(upload_path):
+        if not file_path:
             return jsonify({'success': False, 'message': '无效的文件路径'})
         
-        if not os.path.exists(file_path):
+        info = storage_stat(file_path)
+        if info is None:
             return jsonify({'success': False, 'message': '文件不存在'})
+        record_activity('download', file_path, info)
         
-        if os.path.isdir(file_path):
+        if info['is_dir']:
             # 如果是文件夹，创建zip压缩包
             import zipfile
             import tempfile
@@ -2888,12 +6655,9 @@ def download_file():
             zip_path = os.path.join(temp_dir, f'{filename}.zip')
             
             with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(file_path):
-                    for file in files:
-                        file_full_path = os.path.join(root, file)
-                        # 计算相对路径，保持文件夹结构
-                        arcname = os.path.relpath(file_full_path, file_path)
-                        zipf.write(file_full_path, arcname)
+                # 相对路径保持文件夹结构
+                for arcname, file_full_path in storage_walk(file_path):
+                    zipf.write(file_full_path, arcname)
             
             # 发送文件后删除临时文件
             def remove_temp_file(response):
@@ -2908,7 +6672,7 @@ def download_file():
             response.call_on_close(lambda: remove_temp_file)
             return response
         else:
-            return send_file(file_path, as_attachment=True, download_name=filename)
+            return send_stored_file(file_path, filename)
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'下载失败: {str(e)}'})
@@ -2925,24 +6689,21 @@ def delete_file():
         if not filename:
             return jsonify({'success': False, 'message': '文件名不能为空'})
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], path, filename)
+        file_path = user_path(path, filename)
         
         # 安全检查
-        file_path = os.path.abspath(file_path)
-        upload_path = os.path.abspath(app.config['UPLOAD_FOLDER'])
-        
-        if not file_path.startswith(upload_path):
+        if not file_path:
             return jsonify({'success': False, 'message': '无效的文件路径'})
         
-        if not os.path.exists(file_path):
+        info = storage_stat(file_path)
+        if info is None:
             return jsonify({'success': False, 'message': '文件不存在'})
         
-        if os.path.isdir(file_path):
-            shutil.rmtree(file_path)
-        else:
-            os.remove(file_path)
+        # 移入回收站只是一次 rename，空间由后台分批释放
+        move_to_trash(file_path, session.get('username'))
+        record_activity('delete', file_path, info)
         
-        return jsonify({'success': True, 'message': '删除成功'})
+        return jsonify({'success': True, 'message': '已移入回收站'})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'删除失败: {str(e)}'})
@@ -2955,14 +6716,20 @@ def storage_info():
         # 清理过期的快传文件
         clean_expired_quick_transfers()
         
-        used_space = get_directory_size(UPLOAD_FOLDER) + get_directory_size(QUICK_TRANSFER_FOLDER)
+        user = current_user()
+        used_space = user_usage(user)
+        if user['is_admin'] and used_space is not None:
+            used_space += get_directory_size(QUICK_TRANSFER_FOLDER)
+        # 回收站中的内容在清除前仍占用磁盘，单独列出（不计入配额）
+        trash_space = sum(tree_totals(f'{TRASH_DIR}/{trash_id}')[0] or 0 for trash_id in get_user_trash_ids(None))
         
         return jsonify({
             'success': True,
             'storage': {
                 'used': used_space,
-                'total': TOTAL_STORAGE,
-                'available': TOTAL_STORAGE - used_space
+                'trash': trash_space,
+                'total': user['quota'],
+                'available': None if used_space is None else max(0, user['quota'] - used_space)
             }
         })
     except Exception as e:
@@ -2984,12 +6751,15 @@ def create_share():
         share_id = str(uuid.uuid4())
         
         # 存储分享信息
-        shares_data[share_id] = {
-            'path': path,
-            'files': files,
-            'created_at': datetime.now().isoformat(),
-            'created_by': session.get('username', '未知用户')
-        }
+        get_db().execute(
+            'INSERT INTO shares (id, path, root, files, created_by, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (share_id, path, user_root(), json.dumps(files, ensure_ascii=False),
+             session.get('username', '未知用户'), time.time())
+        )
+        for filename in files:
+            file_path = user_path(path, filename)
+            if file_path:
+                record_activity('share', file_path)
         
         return jsonify({
             'success': True,
@@ -3002,7 +6772,8 @@ def create_share():
 @app.route('/share/<share_id>')
 def view_share(share_id):
     """查看分享页面"""
-    if share_id not in shares_data:
+    share_info = get_share(share_id)
+    if share_info is None:
         return render_template_string("""
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -3026,20 +6797,19 @@ def view_share(share_id):
 </html>
         """), 404
     
-    share_info = shares_data[share_id]
-    
     def generate_file_list_html():
         html = ""
         for filename in share_info['files']:
-            file_path = os.path.join(UPLOAD_FOLDER, share_info['path'], filename)
-            if os.path.exists(file_path):
-                is_dir = os.path.isdir(file_path)
+            file_path = normalize_path(share_info['path'], filename, root=share_info['root'])
+            info = storage_stat(file_path) if file_path else None
+            if info:
+                is_dir = info['is_dir']
                 icon = '<i class="fas fa-folder"></i>' if is_dir else '<i class="fas fa-file"></i>'
                 
                 if is_dir:
                     size_text = '文件夹'
                 else:
-                    size_bytes = os.path.getsize(file_path)
+                    size_bytes = info['size']
                     if size_bytes < 1024:
                         size_text = f'{size_bytes} B'
                     elif size_bytes < 1024 * 1024:
@@ -3160,42 +6930,41 @@ def view_share(share_id):
 @app.route('/share/<share_id>/download')
 def download_shared_file(share_id):
     """下载分享的文件"""
-    if share_id not in shares_data:
+    share_info = get_share(share_id)
+    if share_info is None:
         return "分享链接不存在或已过期", 404
     
-    share_info = shares_data[share_id]
     filename = request.args.get('filename', '')
     
     if filename not in share_info['files']:
         return "文件不在分享列表中", 403
     
     try:
-        file_path = os.path.join(UPLOAD_FOLDER, share_info['path'], filename)
+        file_path = normalize_path(share_info['path'], filename, root=share_info['root'])
+        info = storage_stat(file_path) if file_path else None
         
-        if not os.path.exists(file_path):
+        if info is None:
             return "文件不存在", 404
         
-        if os.path.isdir(file_path):
+        if info['is_dir']:
             # 如果是文件夹，创建zip压缩包
             import zipfile
             import tempfile
             
             temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
             with zipfile.ZipFile(temp_file.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(file_path):
-                    for file in files:
-                        file_full_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_full_path, file_path)
-                        zipf.write(file_full_path, arcname)
+                for arcname, file_full_path in storage_walk(file_path):
+                    zipf.write(file_full_path, arcname)
             
             return send_file(temp_file.name, as_attachment=True, download_name=f'{filename}.zip')
         else:
-            return send_file(file_path, as_attachment=True, download_name=filename)
+            return send_stored_file(file_path, filename)
             
     except Exception as e:
         return f"下载失败: {str(e)}", 500
 
 @app.route('/rename', methods=['POST'])
+@login_required
 def rename_file():
     """重命名文件或文件夹"""
     try:
@@ -3207,38 +6976,985 @@ def rename_file():
         if not old_name or not new_name:
             return jsonify({'success': False, 'message': '文件名不能为空'})
         
-        old_path = os.path.join(UPLOAD_FOLDER, path, old_name)
-        new_path = os.path.join(UPLOAD_FOLDER, path, secure_filename(new_name))
+        old_path = user_path(path, old_name)
+        new_path = user_path(path, secure_filename(new_name))
         
         # 安全检查
-        old_path = os.path.abspath(old_path)
-        new_path = os.path.abspath(new_path)
-        upload_path = os.path.abspath(UPLOAD_FOLDER)
-        
-        if not old_path.startswith(upload_path) or not new_path.startswith(upload_path):
+        if not old_path or not new_path:
             return jsonify({'success': False, 'message': '无效的文件路径'})
         
-        if not os.path.exists(old_path):
+        if not storage_exists(old_path):
             return jsonify({'success': False, 'message': '文件不存在'})
         
-        if os.path.exists(new_path):
+        if storage_exists(new_path):
             return jsonify({'success': False, 'message': '目标文件名已存在'})
         
-        os.rename(old_path, new_path)
+        storage_rename(old_path, new_path)
+        record_activity('rename', new_path, renamed_from=old_path)
         
         return jsonify({'success': True, 'message': '重命名成功'})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'重命名失败: {str(e)}'})
 
+BATCH_ACTIONS = {'delete': '删除', 'move': '移动', 'copy': '复制'}
+
+def run_batch_item(action, source, target_dir, checkpoint=None, owner=None):
+    """执行单个批量操作项，返回 (是否成功, 消息)"""
+    if not storage_exists(source):
+        return False, '文件不存在'
+    
+    if action == 'delete':
+        info = storage_stat(source)
+        move_to_trash(source, owner)
+        record_activity('delete', source, info, username=owner)
+        return True, '已移入回收站'
+    
+    if target_dir is None:
+        return False, '无效的目标路径'
+    destination = normalize_path(split_path(source)[1], root=target_dir)
+    if destination == source or destination.startswith(source + '/'):
+        return False, '不能移动或复制到自身或其子目录'
+    if storage_exists(destination):
+        return False, '目标位置已存在同名文件'
+    if action == 'copy':
+        user = get_user(owner)
+        if user is None:
+            return False, '存储空间不足，超出配额'
+        # 源目录没有汇总时当场统计：复制本身就要遍历整个源目录，统计不会增加量级
+        message = quota_error(user, tree_totals(source, scan=True)[0])
+        if message is not None:
+            return False, message
+    
+    if action == 'move':
+        storage_rename(source, destination)
+        record_activity('move', destination, renamed_from=source, username=owner)
+    else:
+        storage_copy(source, destination, checkpoint)
+        record_activity('copy', destination, username=owner)
+    return True, f'{BATCH_ACTIONS[action]}成功'
+
+@app.route('/batch', methods=['POST'])
+@login_required
+def batch_operation():
+    """批量删除/移动/复制，一次请求处理所有选中项并返回逐项结果"""
+    try:
+        data = request.get_json()
+        action = data.get('action', '')
+        path = data.get('path', '')
+        files = data.get('files', [])
+        target_dir = user_path(data.get('target_path', ''))
+        
+        if action not in BATCH_ACTIONS:
+            return jsonify({'success': False, 'message': '不支持的操作'})
+        if not files:
+            return jsonify({'success': False, 'message': '没有选择文件'})
+        
+        # 异步模式：作为一个后台任务执行，通过 /jobs/<id> 查询逐项结果
+        if data.get('async'):
+            job_id = submit_job(action, {
+                'path': path,
+                'files': files,
+                'target_path': data.get('target_path', '')
+            }, session.get('username'))
+            return jsonify({'success': True, 'message': '已提交后台任务', 'job_id': job_id})
+        
+        results = []
+        for filename in files:
+            source = user_path(path, filename)
+            try:
+                if not source:
+                    success, message = False, '无效的文件路径'
+                else:
+                    success, message = run_batch_item(action, source, target_dir, owner=session.get('username'))
+            except Exception as e:
+                success, message = False, str(e)
+            results.append({'name': filename, 'success': success, 'message': message})
+        
+        succeeded = sum(1 for r in results if r['success'])
+        return jsonify({
+            'success': succeeded == len(results),
+            'message': f'{BATCH_ACTIONS[action]}完成：成功 {succeeded} 项，失败 {len(results) - succeeded} 项',
+            'results': results
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'批量操作失败: {str(e)}'})
+
+def collect_archive_items(path, files, root):
+    """收集用户空间内选中项的 (归档路径, 物理路径) 列表，文件夹展开为其中所有文件"""
+    items = []
+    for filename in files:
+        source = normalize_path(path, filename, root=root)
+        info = storage_stat(source) if source else None
+        if info is None:
+            continue
+        if info['is_dir']:
+            for arcname, physical in storage_walk(source):
+                items.append((f'{info["name"]}/{arcname}', physical))
+        else:
+            items.append((info['name'], storage_file_path(source)))
+    return items
+
+def archive_name_for(path, files):
+    """打包下载的文件名：单个文件夹用其名称，否则用当前目录名"""
+    if len(files) == 1:
+        return f'{files[0]}.zip'
+    return f'{split_path(normalize_path(path) or "")[1] or "download"}.zip'
+
+@app.route('/batch-download', methods=['POST'])
+@login_required
+def batch_download():
+    """将多个选中的文件/文件夹打包为一个流式zip下载"""
+    path = request.form.get('path', '')
+    files = request.form.getlist('files')
+    
+    items = collect_archive_items(path, files, user_root())
+    if not items:
+        return "没有可下载的文件", 404
+    for filename in files:
+        source = user_path(path, filename)
+        if source:
+            record_activity('download', source)
+    
+    archive_name = archive_name_for(path, files)
+    response = Response(stream_zip(items), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f"attachment; filename=download.zip; filename*=UTF-8''{quote(archive_name)}"
+    return response
+
+@app.route('/move', methods=['POST'])
+@login_required
+def move_file():
+    """移动文件或文件夹到其他目录（同一文件系统内只修改目录项，分片布局下只修改元数据）"""
+    try:
+        data = request.get_json()
+        source = user_path(data.get('path', ''), data.get('filename', ''))
+        target_dir = user_path(data.get('target_path', ''))
+        
+        if not source or target_dir is None:
+            return jsonify({'success': False, 'message': '无效的文件路径'})
+        
+        success, message = run_batch_item('move', source, target_dir, owner=session.get('username'))
+        return jsonify({'success': success, 'message': message})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'移动失败: {str(e)}'})
+
+@app.route('/copy', methods=['POST'])
+@login_required
+def copy_file():
+    """复制文件或文件夹到其他目录，文件夹和大文件交给后台任务"""
+    try:
+        data = request.get_json()
+        path = data.get('path', '')
+        filename = data.get('filename', '')
+        source = user_path(path, filename)
+        target_dir = user_path(data.get('target_path', ''))
+        
+        if not source or target_dir is None:
+            return jsonify({'success': False, 'message': '无效的文件路径'})
+        
+        info = storage_stat(source)
+        if info is None:
+            return jsonify({'success': False, 'message': '文件不存在'})
+        
+        if info['is_dir'] or info['size'] > COPY_SYNC_LIMIT:
+            job_id = submit_job('copy', {
+                'path': path,
+                'files': [filename],
+                'target_path': data.get('target_path', '')
+            }, session.get('username'))
+            return jsonify({'success': True, 'message': '已开始后台复制', 'job_id': job_id})
+        
+        success, message = run_batch_item('copy', source, target_dir, owner=session.get('username'))
+        return jsonify({'success': success, 'message': message})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'复制失败: {str(e)}'})
+
+@job_handler('delete')
+@job_handler('move')
+@job_handler('copy')
+def batch_job(job):
+    """批量删除/移动/复制任务"""
+    params = job.params
+    root = user_root(job.created_by)
+    target_dir = normalize_path(params.get('target_path', ''), root=root)
+    results = []
+    for i, filename in enumerate(params['files']):
+        job.progress(i, len(params['files']))
+        source = normalize_path(params['path'], filename, root=root)
+        try:
+            if not source:
+                success, message = False, '无效的文件路径'
+            else:
+                success, message = run_batch_item(job.type, source, target_dir,
+                                                  lambda: job.progress(i, len(params['files'])), job.created_by)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            success, message = False, str(e)
+        results.append({'name': filename, 'success': success, 'message': message})
+    job.progress(len(results), len(results), force=True)
+    return {'results': results}
+
+@job_handler('archive')
+def archive_job(job):
+    """打包任务：在后台生成zip，完成后通过 /jobs/<id>/download 下载"""
+    params = job.params
+    items = collect_archive_items(params['path'], params['files'], user_root(job.created_by))
+    total = 0
+    for arcname, physical in items:
+        try:
+            total += os.path.getsize(physical)
+        except OSError:
+            pass
+    job.progress(0, total, force=True)
+    
+    archive_path = os.path.join(ARCHIVES_FOLDER, f'{job.id}.zip')
+    try:
+        with open(archive_path, 'wb') as f:
+            for chunk in stream_zip(items, on_progress=job.progress):
+                f.write(chunk)
+    except BaseException:
+        try:
+            os.remove(archive_path)
+        except OSError:
+            pass
+        raise
+    job.progress(total, total, force=True)
+    return {
+        'name': archive_name_for(params['path'], params['files']),
+        'size': os.path.getsize(archive_path),
+        'files': len(items)
+    }
+
+def hash_file(physical, job=None, done=0):
+    """流式计算文件的 SHA-256，返回 (摘要, 累计读取字节数)"""
+    digest = hashlib.sha256()
+    with open(physical, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            done += len(chunk)
+            if job:
+                job.progress(done)
+    return digest.hexdigest(), done
+
+@job_handler('hash')
+def hash_job(job):
+    """计算选中文件（文件夹展开）的 SHA-256"""
+    params = job.params
+    items = collect_archive_items(params['path'], params['files'], user_root(job.created_by))
+    total = sum(os.path.getsize(physical) for _, physical in items if os.path.exists(physical))
+    job.progress(0, total, force=True)
+    
+    hashes, done = {}, 0
+    for arcname, physical in items:
+        try:
+            hashes[arcname], done = hash_file(physical, job, done)
+        except (OSError, IOError):
+            continue
+    job.progress(total, total, force=True)
+    return {'algorithm': 'sha256', 'hashes': hashes}
+
+@job_handler('rescan')
+def rescan_job(job):
+    """重新扫描目录树，统计文件数、目录数与总大小"""
+    root = user_root(job.created_by)
+    path = normalize_path(job.params.get('path', ''), root=root)
+    if path is None:
+        raise ValueError('无效的路径')
+    files, size = 0, 0
+    for arcname, physical in storage_walk(path):
+        try:
+            size += os.path.getsize(physical)
+        except OSError:
+            continue
+        files += 1
+        job.progress(files)
+    job.progress(files, files, force=True)
+    if storage_is_dir(path):
+        get_db().execute(
+            'INSERT OR REPLACE INTO dir_stats (path, size, files, updated_at) VALUES (?, ?, ?, ?)',
+            (dir_stats_key(path), size, files, time.time())
+        )
+    return {'path': display_path(path, root), 'files': files, 'size': size}
+
+USER_JOB_TYPES = {'delete', 'move', 'copy', 'archive', 'hash', 'rescan'}
+
+def get_user_job(job_id):
+    """获取当前用户可访问的任务"""
+    row = get_db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None or row['created_by'] != session.get('username'):
+        return None
+    return row
+
+@app.route('/jobs', methods=['GET', 'POST'])
+@login_required
+def jobs():
+    """提交后台任务 / 列出我的任务"""
+    try:
+        if request.method == 'GET':
+            rows = get_db().execute(
+                'SELECT * FROM jobs WHERE created_by = ? ORDER BY created_at DESC LIMIT 50',
+                (session.get('username'),)
+            ).fetchall()
+            return jsonify({'success': True, 'jobs': [job_to_dict(row) for row in rows]})
+        
+        data = request.get_json()
+        job_type = data.get('type', '')
+        if job_type not in USER_JOB_TYPES:
+            return jsonify({'success': False, 'message': '不支持的任务类型'})
+        if job_type != 'rescan' and not data.get('files'):
+            return jsonify({'success': False, 'message': '没有选择文件'})
+        
+        job_id = submit_job(job_type, {
+            'path': data.get('path', ''),
+            'files': data.get('files', []),
+            'target_path': data.get('target_path', '')
+        }, session.get('username'))
+        return jsonify({'success': True, 'job_id': job_id})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'提交任务失败: {str(e)}'})
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """查询任务进度与结果"""
+    row = get_user_job(job_id)
+    if row is None:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    return jsonify({'success': True, 'job': job_to_dict(row)})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    """取消任务：排队中的直接取消，运行中的在下次上报进度时停止"""
+    row = get_user_job(job_id)
+    if row is None:
+        return jsonify({'success': False, 'message': '任务不存在'})
+    conn = get_db()
+    conn.execute(
+        "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+        (time.time(), job_id)
+    )
+    conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+    return jsonify({'success': True, 'message': '已请求取消'})
+
+@app.route('/jobs/<job_id>/download')
+@login_required
+def download_job_archive(job_id):
+    """下载打包任务生成的压缩包"""
+    row = get_user_job(job_id)
+    if row is None or row['type'] != 'archive' or row['status'] != 'completed':
+        return "压缩包不存在或尚未完成", 404
+    result = json.loads(row['result'])
+    archive_path = os.path.abspath(os.path.join(ARCHIVES_FOLDER, f'{job_id}.zip'))
+    if not os.path.exists(archive_path):
+        return "压缩包已过期", 404
+    return send_file(archive_path, as_attachment=True, download_name=result['name'])
+
+# 媒体流：MP4 的 moov 原子在文件末尾时，浏览器要先取到末尾才能开始播放。
+# 这里不改写文件，而是在响应中把 moov 虚拟地前置（同时修正块偏移量），按字节范围提供。
+
+MP4_CONTAINER_ATOMS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+def read_atom_header(data, offset, end):
+    """解析原子头，返回 (类型, 总大小, 头长度)；数据损坏时返回None"""
+    if offset + 8 > end:
+        return None
+    size, kind = struct.unpack_from('>I4s', data, offset)
+    header_len = 8
+    if size == 1:
+        if offset + 16 > end:
+            return None
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header_len = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_len or offset + size > end:
+        return None
+    return kind, size, header_len
+
+def read_top_level_atoms(physical):
+    """读取 MP4 顶层原子列表 [(类型, 偏移, 大小)]"""
+    atoms = []
+    file_size = os.path.getsize(physical)
+    with open(physical, 'rb') as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, kind = struct.unpack_from('>I4s', header, 0)
+            if size == 1 and len(header) == 16:
+                size = struct.unpack_from('>Q', header, 8)[0]
+            elif size == 0:
+                size = file_size - offset
+            if size < 8 or offset + size > file_size:
+                break
+            atoms.append((kind, offset, size))
+            offset += size
+    return atoms
+
+def shift_chunk_offsets(moov, start, end, shift, limit):
+    """递归修正 stco/co64 中小于 limit 的块偏移量，stco 溢出 32 位或表的条目数超出原子大小（文件损坏）时返回 False"""
+    offset = start
+    while offset < end:
+        parsed = read_atom_header(moov, offset, end)
+        if parsed is None:
+            return False
+        kind, size, header_len = parsed
+        body = offset + header_len
+        if kind in MP4_CONTAINER_ATOMS:
+            if not shift_chunk_offsets(moov, body, offset + size, shift, limit):
+                return False
+        elif kind in (b'stco', b'co64'):
+            if size - header_len < 8:
+                return False
+            count = struct.unpack_from('>I', moov, body + 4)[0]
+            width = 4 if kind == b'stco' else 8
+            if 8 + count * width > size - header_len:
+                return False
+            fmt = f'>{count}I' if kind == b'stco' else f'>{count}Q'
+            values = [v + shift if v < limit else v for v in struct.unpack_from(fmt, moov, body + 8)]
+            if kind == b'stco' and values and max(values) > 0xFFFFFFFF:
+                return False
+            struct.pack_into(fmt, moov, body + 8, *values)
+        offset += size
+    return True
+
+def mp4_faststart_layout(physical, file_size):
+    """moov 位于 mdat 之后时，返回前置 moov 的虚拟布局 [(内存数据或None, 文件偏移, 长度)]，否则返回None"""
+    atoms = read_top_level_atoms(physical)
+    kinds = [atom[0] for atom in atoms]
+    if b'moov' not in kinds or b'mdat' not in kinds or kinds.index(b'moov') < kinds.index(b'mdat'):
+        return None
+    _, moov_offset, moov_size = atoms[kinds.index(b'moov')]
+    if moov_size > MP4_MAX_MOOV_SIZE or moov_offset + moov_size > file_size:
+        return None
+    
+    with open(physical, 'rb') as f:
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+    header_len = read_atom_header(moov, 0, len(moov))[2]
+    # moov 前置后，原来位于 moov 之前的数据（即 mdat）整体后移 moov_size
+    if not shift_chunk_offsets(moov, header_len, len(moov), moov_size, moov_offset):
+        return None
+    
+    head_end = atoms[0][2] if kinds[0] == b'ftyp' else 0
+    layout = [
+        (None, 0, head_end),
+        (bytes(moov), 0, moov_size),
+        (None, head_end, moov_offset - head_end),
+        (None, moov_offset + moov_size, file_size - moov_offset - moov_size)
+    ]
+    return [segment for segment in layout if segment[2] > 0]
+
+_mp4_layouts = OrderedDict()  # 物理路径 -> (mtime_ns, 文件大小, 布局, 内存数据字节数)
+_mp4_layouts_bytes = 0
+_mp4_layouts_lock = threading.Lock()
+
+def get_mp4_layout(physical, stat):
+    """取得 MP4 的前置布局并按文件缓存；文件被替换后重建，缓存按 moov 数据总字节数和文件数淘汰最久未用的"""
+    global _mp4_layouts_bytes
+    key = os.path.abspath(physical)
+    with _mp4_layouts_lock:
+        cached = _mp4_layouts.get(key)
+        hit = cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size)
+        metrics.inc('netdisk_cache_requests_total', cache='mp4_layout', result='hit' if hit else 'miss')
+        if hit:
+            _mp4_layouts.move_to_end(key)
+            return cached[2]
+    
+    layout = mp4_faststart_layout(key, stat.st_size)
+    size = sum(len(segment[0]) for segment in layout or () if segment[0] is not None)
+    if size > MP4_LAYOUT_CACHE_BYTES:
+        return layout
+    with _mp4_layouts_lock:
+        old = _mp4_layouts.pop(key, None)
+        if old is not None:
+            _mp4_layouts_bytes -= old[3]
+        _mp4_layouts[key] = (stat.st_mtime_ns, stat.st_size, layout, size)
+        _mp4_layouts_bytes += size
+        while _mp4_layouts_bytes > MP4_LAYOUT_CACHE_BYTES or len(_mp4_layouts) > MP4_LAYOUT_CACHE:
+            _mp4_layouts_bytes -= _mp4_layouts.popitem(last=False)[1][3]
+    return layout
+
+def serve_layout(physical, layout, mimetype, etag):
+    """按字节范围提供由内存数据和文件片段拼接而成的虚拟文件"""
+    total = sum(segment[2] for segment in layout)
+    start, stop, status = 0, total, 200
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(total)
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{total}'
+            return response
+        start, stop = byte_range
+        status = 206
+    
+    def generate():
+        position = 0
+        with open(physical, 'rb') as f:
+            for data, file_offset, length in layout:
+                seg_start, seg_stop = max(start, position), min(stop, position + length)
+                if seg_start < seg_stop:
+                    if data is not None:
+                        yield data[seg_start - position:seg_stop - position]
+                    else:
+                        f.seek(file_offset + seg_start - position)
+                        remaining = seg_stop - seg_start
+                        while remaining > 0:
+                            chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                return
+                            remaining -= len(chunk)
+                            yield chunk
+                position += length
+                if position >= stop:
+                    return
+    
+    response = Response(generate(), status=status, mimetype=mimetype, direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Content-Disposition'] = 'inline'
+    response.set_etag(etag)
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total}'
+    return response
+
+@app.route('/stream')
+@login_required
+def stream_file():
+    """在线播放/预览媒体文件，支持按字节范围拖动进度"""
+    file_path = user_path(request.args.get('path', ''), request.args.get('filename', ''))
+    if not file_path:
+        return "无效的文件路径", 400
+    
+    ext = os.path.splitext(file_path)[1].lower()
+    mimetype = STREAM_TYPES.get(ext)
+    if mimetype is None:
+        return "该文件类型不支持在线预览", 415
+    
+    physical = storage_file_path(file_path)
+    if physical is None:
+        return "文件不存在", 404
+    
+    if ext in MP4_EXTENSIONS:
+        stat = os.stat(physical)
+        layout = get_mp4_layout(physical, stat)
+        if layout is not None:
+            etag = hashlib.sha1(f'{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}:faststart'.encode()).hexdigest()
+            return serve_layout(physical, layout, mimetype, etag)
+    
+    # 其余情况由 send_file 处理 Range / If-Range / ETag
+    return send_file(os.path.abspath(physical), mimetype=mimetype, conditional=True)
+
+# 文本查看：对大文件只读取请求的行/字节窗口。
+# 行号定位依赖稀疏行偏移索引：每 TEXT_INDEX_BLOCK 字节记录一次此前的换行数，按需向后扩展并按文件缓存。
+
+class LineIndex:
+    """单个文件的稀疏行索引，block_lines[k] 为偏移 k*TEXT_INDEX_BLOCK 之前的换行数"""
+    
+    def __init__(self, inode):
+        self.inode = inode
+        self.block_lines = [0]
+        self.scanned = 0  # 已扫描到的字节偏移（总是块边界或文件末尾）
+        self.lines = 0  # 已扫描部分中的换行数
+        self.lock = threading.Lock()
+    
+    def extend(self, mm, size, until_line=None):
+        """扫描到文件末尾，或已扫描部分包含 until_line 为止"""
+        if self.scanned % TEXT_INDEX_BLOCK:
+            # 上次扫描停在文件末尾的半块处，回退到块边界重新统计
+            self.scanned -= self.scanned % TEXT_INDEX_BLOCK
+            self.lines = self.block_lines[-1]
+        while self.scanned < size and (until_line is None or self.lines < until_line):
+            end = min(self.scanned + TEXT_INDEX_BLOCK, size)
+            self.lines += mm[self.scanned:end].count(b'\n')
+            self.scanned = end
+            if end % TEXT_INDEX_BLOCK == 0:
+                self.block_lines.append(self.lines)
+    
+    def locate(self, mm, size, line):
+        """返回第 line 行（从0开始）的起始偏移，超出文件时返回None"""
+        if line == 0:
+            return 0
+        self.extend(mm, size, line)
+        # 找到最后一个“之前换行数 < line”的块，从块首向后数换行
+        block = bisect.bisect_left(self.block_lines, line) - 1
+        offset = block * TEXT_INDEX_BLOCK
+        for _ in range(line - self.block_lines[block]):
+            offset = mm.find(b'\n', offset, size) + 1
+            if offset == 0:
+                return None
+        return offset if offset < size else None
+
+_line_indexes = OrderedDict()
+_line_indexes_lock = threading.Lock()
+
+def get_line_index(physical, stat):
+    """取得文件的行索引；文件被替换或截断后重建，追加写入时沿用已扫描部分"""
+    key = os.path.abspath(physical)
+    with _line_indexes_lock:
+        index = _line_indexes.get(key)
+        hit = not (index is None or index.inode != stat.st_ino or index.scanned > stat.st_size)
+        metrics.inc('netdisk_cache_requests_total', cache='line_index', result='hit' if hit else 'miss')
+        if not hit:
+            index = LineIndex(stat.st_ino)
+            _line_indexes[key] = index
+        _line_indexes.move_to_end(key)
+        while len(_line_indexes) > TEXT_INDEX_CACHE:
+            _line_indexes.popitem(last=False)
+    return index
+
+def read_lines(mm, offset, size, max_lines):
+    """从 offset 起读取至多 max_lines 行（受 TEXT_MAX_BYTES 限制），返回 (行列表, 结束偏移)"""
+    limit = min(size, offset + TEXT_MAX_BYTES)
+    lines = []
+    while offset < limit and len(lines) < max_lines:
+        end = mm.find(b'\n', offset, limit)
+        if end == -1:
+            if limit < size and lines:
+                break  # 窗口内放不下完整的一行，留给下次请求
+            end = limit
+            lines.append(mm[offset:end])
+            offset = end
+            break
+        lines.append(mm[offset:end])
+        offset = end + 1
+    return [line.rstrip(b'\r').decode('utf-8', errors='replace') for line in lines], offset
+
+def tail_offset(mm, size, count):
+    """返回最后 count 行的起始偏移（至多回溯 TEXT_MAX_BYTES）"""
+    floor = max(0, size - TEXT_MAX_BYTES)
+    offset = size - 1 if size and mm[size - 1:size] == b'\n' else size
+    for _ in range(count):
+        offset = mm.rfind(b'\n', floor, offset)
+        if offset == -1:
+            return floor if floor == 0 else mm.find(b'\n', floor, size) + 1
+    return offset + 1
+
+@app.route('/view-text')
+@login_required
+def view_text():
+    """分页查看文本/日志文件：mode=lines 按行号，mode=bytes 按字节偏移，mode=tail 查看末尾并可用 since 轮询新增内容"""
+    file_path = user_path(request.args.get('path', ''), request.args.get('filename', ''))
+    if not file_path:
+        return jsonify({'success': False, 'message': '无效的文件路径'})
+    physical = storage_file_path(file_path)
+    if physical is None:
+        return jsonify({'success': False, 'message': '文件不存在'})
+    
+    mode = request.args.get('mode', 'lines')
+    count = max(1, min(request.args.get('lines', 200, type=int), TEXT_MAX_LINES))
+    with open(physical, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        result = {'success': True, 'size': size, 'mode': mode}
+        if size == 0:
+            result.update({'lines': [], 'offset': 0, 'next_offset': 0, 'eof': True})
+            return jsonify(result)
+        
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            if b'\0' in mm[:8192]:
+                return jsonify({'success': False, 'message': '该文件不是文本文件'})
+            
+            if mode == 'lines':
+                start_line = max(0, request.args.get('start', 0, type=int))
+                index = get_line_index(physical, stat)
+                with index.lock:
+                    offset = index.locate(mm, size, start_line)
+                if offset is None:
+                    return jsonify({'success': False, 'message': '超出文件行数'})
+                result['start_line'] = start_line
+            elif mode == 'bytes':
+                offset = max(0, min(request.args.get('offset', 0, type=int), size))
+                if offset > 0 and mm[offset - 1:offset] != b'\n':
+                    found = mm.find(b'\n', offset, size)
+                    offset = size if found == -1 else found + 1  # 对齐到下一行行首
+            elif mode == 'tail':
+                since = request.args.get('since', type=int)
+                if since is None:
+                    offset = tail_offset(mm, size, count)
+                elif since > size:
+                    # 文件被截断或轮转，从头开始
+                    offset = tail_offset(mm, size, count)
+                    result['reset'] = True
+                else:
+                    offset = since
+                    count = TEXT_MAX_LINES
+            else:
+                return jsonify({'success': False, 'message': '不支持的查看模式'})
+            
+            lines, next_offset = read_lines(mm, offset, size, count)
+            partial = next_offset == size and mm[size - 1:size] != b'\n'
+            # 跟踪时不返回尚未写完的最后一行，等写完后随下一次轮询返回
+            if mode == 'tail' and partial and lines and (since is not None or len(lines) > 1):
+                next_offset = mm.rfind(b'\n', offset, size) + 1 or offset
+                lines.pop()
+            if mode == 'lines':
+                result['next_line'] = start_line + len(lines)
+                if index.scanned >= size:
+                    result['total_lines'] = index.lines + (1 if mm[size - 1:size] != b'\n' else 0)
+    
+    result.update({
+        'lines': lines,
+        'offset': offset,
+        'next_offset': next_offset,
+        'eof': next_offset >= size
+    })
+    return jsonify(result)
+
+@app.route('/thumb')
+@login_required
+def thumbnail():
+    """获取图片缩略图，首次访问时生成并缓存"""
+    if Image is None:
+        return "缩略图不可用", 404
+    
+    physical = thumbnail_source(request.args.get('path', ''), request.args.get('filename', ''))
+    if physical is None:
+        return "不支持的文件", 404
+    
+    size = thumb_bucket(request.args.get('size', 256, type=int))
+    try:
+        target, future = request_thumbnail(physical, size)
+        if future is not None:
+            future.result(timeout=30)
+        elif time.time() - os.path.getmtime(target) > 3600:
+            os.utime(target)  # 记录访问时间，供淘汰使用（每小时最多更新一次）
+    except Exception:
+        return "缩略图生成失败", 404
+    
+    return send_file(os.path.abspath(target), mimetype='image/jpeg', max_age=86400)
+
+@app.route('/thumb/prefetch', methods=['POST'])
+@login_required
+def prefetch_thumbnails():
+    """为当前页可见的图片批量提交缩略图生成，立即返回"""
+    if Image is None:
+        return jsonify({'success': False, 'message': '缩略图不可用'})
+    try:
+        data = request.get_json()
+        size = thumb_bucket(int(data.get('size', 256)))
+        submitted = 0
+        for filename in data.get('files', [])[:THUMB_PREFETCH_LIMIT]:
+            physical = thumbnail_source(data.get('path', ''), filename)
+            if physical is None:
+                continue
+            target, future = request_thumbnail(physical, size)
+            if future is not None:
+                submitted += 1
+        return jsonify({'success': True, 'submitted': submitted})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'预取缩略图失败: {str(e)}'})
+
+@app.route('/trash')
+@login_required
+def list_trash():
+    """获取回收站列表"""
+    try:
+        rows = get_db().execute(
+            "SELECT * FROM trash WHERE status = 'trashed' AND deleted_by = ? AND purge_after > ? ORDER BY deleted_at DESC",
+            (session.get('username'), time.time())
+        ).fetchall()
+        root = user_root()
+        items = [{
+            'id': row['id'],
+            'name': row['name'],
+            'original_path': display_path(row['original_path'], root),
+            'is_dir': bool(row['is_dir']),
+            'size': row['size'],
+            'deleted_at': datetime.fromtimestamp(row['deleted_at']).isoformat(),
+            'purge_at': datetime.fromtimestamp(row['purge_after']).isoformat()
+        } for row in rows]
+        return jsonify({'success': True, 'items': items})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'获取回收站失败: {str(e)}'})
+
+def get_user_trash_ids(ids):
+    """过滤出属于当前用户的回收站条目ID；未指定时返回全部"""
+    rows = get_db().execute(
+        "SELECT id FROM trash WHERE status = 'trashed' AND deleted_by = ? AND purge_after > ?",
+        (session.get('username'), time.time())
+    ).fetchall()
+    owned = [row['id'] for row in rows]
+    return owned if ids is None else [i for i in ids if i in set(owned)]
+
+@app.route('/trash/restore', methods=['POST'])
+@login_required
+def restore_trash():
+    """从回收站恢复"""
+    try:
+        data = request.get_json()
+        restored = []
+        for trash_id in get_user_trash_ids(data.get('ids', [])):
+            target = restore_from_trash(trash_id)
+            if target:
+                restored.append(display_path(target, user_root()))
+        return jsonify({'success': True, 'message': f'已恢复 {len(restored)} 项', 'restored': restored})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'恢复失败: {str(e)}'})
+
+@app.route('/trash/empty', methods=['POST'])
+@login_required
+def empty_trash():
+    """彻底删除回收站中的条目（不指定 ids 时清空），空间由后台分批释放"""
+    try:
+        data = request.get_json(silent=True) or {}
+        ids = get_user_trash_ids(data.get('ids'))
+        get_db().executemany(
+            "UPDATE trash SET purge_after = 0 WHERE id = ? AND status = 'trashed'",
+            [(trash_id,) for trash_id in ids]
+        )
+        return jsonify({'success': True, 'message': f'已彻底删除 {len(ids)} 项，空间将在后台释放'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'清空回收站失败: {str(e)}'})
+
+@app.route('/integrity')
+@login_required
+@admin_required
+def integrity_status():
+    """完整性概况：已记录校验和的文件数、复验进度与发现损坏的文件"""
+    conn = get_db()
+    cutoff = time.time() - SCRUB_INTERVAL.total_seconds()
+    total, verified = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(verified_at >= ?), 0) FROM checksums', (cutoff,)
+    ).fetchone()
+    corrupt = []
+    for row in conn.execute(
+        "SELECT path, algorithm, digest, verified_at FROM checksums WHERE status = 'corrupt'"
+    ).fetchall():
+        path = object_logical_path(row['path']) if STORAGE_LAYOUT == 'sharded' else row['path']
+        if path is None or path.startswith(TRASH_DIR + '/'):
+            continue
+        corrupt.append({
+            'path': path,
+            'algorithm': row['algorithm'],
+            'digest': row['digest'],
+            'detected': datetime.fromtimestamp(row['verified_at']).strftime('%Y-%m-%d %H:%M:%S')
+        })
+    corrupt.sort(key=lambda item: item['path'])
+    return jsonify({
+        'success': True,
+        'algorithm': CHECKSUM_ALGORITHM,
+        'files': total,
+        'verified': verified,
+        'corrupt': corrupt
+    })
+
+def list_transfers(username=None):
+    """进行中的传输，username 为None时返回所有用户的；顺便清理已退出进程遗留的记录。
+    只为限速而登记的小传输不列出"""
+    conn = get_db()
+    for row in conn.execute('SELECT DISTINCT pid FROM transfers').fetchall():
+        if not process_alive(row['pid']):
+            conn.execute('DELETE FROM transfers WHERE pid = ?', (row['pid'],))
+    if username is None:
+        rows = conn.execute(
+            'SELECT * FROM transfers WHERE total IS NULL OR total >= ? ORDER BY started_at', (TRANSFER_MIN_SIZE,)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            'SELECT * FROM transfers WHERE username = ? AND (total IS NULL OR total >= ?) ORDER BY started_at',
+            (username, TRANSFER_MIN_SIZE)
+        ).fetchall()
+    now = time.time()
+    # done 为 None 表示由 sendfile 发送、没有逐字节进度
+    return [{
+        'id': row['id'],
+        'ref': row['ref'],
+        'username': row['username'],
+        'direction': row['direction'],
+        'name': row['name'],
+        'route': row['route'],
+        'client': row['client'],
+        'total': row['total'],
+        'done': row['done'] if row['metered'] else None,
+        'rate': row['rate'],
+        'eta': (row['total'] - row['done']) / row['rate'] if row['total'] and row['rate'] > 0 else None,
+        'stalled': bool(row['metered']) and now - row['updated_at'] > TRANSFER_UPDATE_INTERVAL * 10,
+        'started_at': datetime.fromtimestamp(row['started_at']).isoformat()
+    } for row in rows]
+
+def transfer_scope():
+    """查询范围：管理员带 all=1 时查看所有用户的传输"""
+    user = current_user()
+    if user['is_admin'] and request.args.get('all') == '1':
+        return None
+    return user['username']
+
+@app.route('/transfers')
+@login_required
+def get_transfers():
+    """进行中的上传和下载（所有工作进程、所有标签页和设备）"""
+    return jsonify({'success': True, 'transfers': list_transfers(transfer_scope())})
+
+@app.route('/transfers/stream')
+@login_required
+def transfer_stream():
+    """以 SSE 推送传输进度。连接超过 TRANSFER_STREAM_MAX 秒后结束，浏览器按 retry 间隔自动重连；
+    传输全部结束时推送空列表后结束，此时没有传输则返回 204，浏览器不再自动重连；
+    页面在发起新的传输时、以及可见期间每 15 秒重新订阅一次，空闲时每次只是一个立即返回的轻量请求"""
+    username = transfer_scope()
+    if not list_transfers(username):
+        return '', 204
+    
+    def generate():
+        yield 'retry: 5000\n\n'
+        deadline = time.time() + TRANSFER_STREAM_MAX
+        last = None
+        while True:
+            transfers = list_transfers(username)
+            payload = json.dumps({'transfers': transfers}, ensure_ascii=False)
+            if payload != last:
+                yield f'data: {payload}\n\n'
+                last = payload
+            if not transfers or time.time() > deadline:
+                return
+            time.sleep(TRANSFER_UPDATE_INTERVAL)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                     headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 抓取接口：汇总所有工作进程的指标"""
+    authorized = METRICS_TOKEN and request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}'
+    if not authorized:
+        user = current_user()
+        if user is None or not user['is_admin']:
+            return jsonify({'success': False, 'message': '需要管理员权限'}), 403
+    return Response(render_metrics(collect_metrics()), mimetype='text/plain; version=0.0.4')
+
 @app.route('/recent-files')
 @login_required
 def get_recent_files():
-    """获取最近使用的文件"""
+    """获取最近使用的文件，按时间倒序分页：limit 为每页条数，before 为上一页返回的 next_before"""
     try:
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        before = request.args.get('before', type=int)
+        rows = get_db().execute(
+            'SELECT * FROM recent_files WHERE username = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+            (current_user()['username'], before if before is not None else 2 ** 63 - 1, limit + 1)
+        ).fetchall()
+        files = [{
+            'name': row['name'],
+            'path': row['path'],
+            'action': row['action'],
+            'is_dir': bool(row['is_dir']),
+            'size': row['size'],
+            'timestamp': datetime.fromtimestamp(row['updated_at']).isoformat()
+        } for row in rows[:limit]]
         return jsonify({
             'success': True,
-            'files': recent_files[:20]  # 只返回最近20个
+            'files': files,
+            'next_before': rows[limit - 1]['seq'] if len(rows) > limit else None
         })
     except Exception as e:
         return jsonify({'success': False, 'message': f'获取最近文件失败: {str(e)}'})
@@ -3248,18 +7964,17 @@ def get_recent_files():
 def get_my_shares():
     """获取我的分享"""
     try:
-        shares_list = []
-        for share_id, share_info in shares_data.items():
-            shares_list.append({
-                'id': share_id,
-                'files': share_info['files'],
-                'path': share_info['path'],
-                'created_at': share_info['created_at'],
-                'url': f'/share/{share_id}'
-            })
-        
         # 按创建时间倒序排列
-        shares_list.sort(key=lambda x: x['created_at'], reverse=True)
+        rows = get_db().execute(
+            'SELECT * FROM shares WHERE created_by = ? ORDER BY created_at DESC', (session.get('username'),)
+        ).fetchall()
+        shares_list = [{
+            'id': row['id'],
+            'files': json.loads(row['files']),
+            'path': row['path'],
+            'created_at': datetime.fromtimestamp(row['created_at']).isoformat(),
+            'url': f'/share/{row["id"]}'
+        } for row in rows]
         
         return jsonify({
             'success': True,
@@ -3269,14 +7984,17 @@ def get_my_shares():
         return jsonify({'success': False, 'message': f'获取分享列表失败: {str(e)}'})
 
 @app.route('/revoke-share', methods=['POST'])
+@login_required
 def revoke_share():
     """撤销分享"""
     try:
         data = request.get_json()
         share_id = data.get('share_id', '')
         
-        if share_id in shares_data:
-            del shares_data[share_id]
+        cursor = get_db().execute(
+            'DELETE FROM shares WHERE id = ? AND created_by = ?', (share_id, session.get('username'))
+        )
+        if cursor.rowcount:
             return jsonify({'success': True, 'message': '分享已撤销'})
         else:
             return jsonify({'success': False, 'message': '分享不存在'})
@@ -3286,7 +8004,15 @@ def revoke_share():
 
 @app.route('/quick-transfer-upload', methods=['POST'])
 def quick_transfer_upload():
-    """快传文件上传"""
+    """快传文件上传（不计入用户配额，只检查磁盘空间）"""
+    try:
+        with reserve_upload_space(None, declared_upload_size()):
+            return receive_quick_transfer()
+    except UploadRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
+
+def receive_quick_transfer():
+    """读取并保存快传文件"""
     try:
         if 'files' not in request.files:
             return jsonify({'success': False, 'message': '没有找到文件'})
@@ -3314,7 +8040,7 @@ def quick_transfer_upload():
                     file_path = os.path.join(QUICK_TRANSFER_FOLDER, filename)
                 
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                file.save(file_path)
+                write_upload(file.stream, file_path)
                 
                 uploaded_files.append({
                     'name': filename,
@@ -3393,6 +8119,157 @@ def download_quick_transfer_file():
     except Exception as e:
         return jsonify({'success': False, 'message': f'下载失败: {str(e)}'})
 
+def user_to_dict(row):
+    """用户行转换为接口返回格式"""
+    return {
+        'username': row['username'],
+        'is_admin': bool(row['is_admin']),
+        'disabled': bool(row['disabled']),
+        'quota': row['quota'],
+        'used': user_usage(row),
+        'created_at': datetime.fromtimestamp(row['created_at']).isoformat()
+    }
+
+@app.route('/admin/users', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_users():
+    """列出所有用户 / 创建用户"""
+    try:
+        conn = get_db()
+        if request.method == 'GET':
+            rows = conn.execute('SELECT * FROM users ORDER BY created_at').fetchall()
+            return jsonify({'success': True, 'users': [user_to_dict(row) for row in rows]})
+        
+        data = request.get_json()
+        username = data.get('username', '').strip()
+        password = data.get('password', '').strip()
+        quota = int(data.get('quota') or DEFAULT_USER_QUOTA)
+        if not USERNAME_PATTERN.match(username):
+            return jsonify({'success': False, 'message': '用户名只能包含字母、数字、下划线、点和短横线'})
+        if not password:
+            return jsonify({'success': False, 'message': '密码不能为空'})
+        
+        root = f'{USERS_DIR}/{username}'
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO users (username, password, root, quota, created_at) VALUES (?, ?, ?, ?, ?)',
+            (username, hash_password(password), root, quota, time.time())
+        )
+        if cursor.rowcount == 0:
+            return jsonify({'success': False, 'message': '用户名已存在'})
+        storage_makedirs(root)
+        tree_totals(root, scan=True)  # 目录此前已存在时补上汇总，配额检查不必等待对账
+        return jsonify({'success': True, 'message': f'已创建用户 {username}'})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'操作失败: {str(e)}'})
+
+@app.route('/admin/users/<username>', methods=['POST'])
+@login_required
+@admin_required
+def admin_update_user(username):
+    """修改用户的配额、密码或停用状态"""
+    try:
+        data = request.get_json()
+        conn = get_db()
+        if conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone() is None:
+            return jsonify({'success': False, 'message': '用户不存在'})
+        if username == session.get('username') and data.get('disabled'):
+            return jsonify({'success': False, 'message': '不能停用自己'})
+        
+        with db_transaction():
+            if data.get('quota') is not None:
+                conn.execute('UPDATE users SET quota = ? WHERE username = ?', (int(data['quota']), username))
+            if data.get('password'):
+                conn.execute(
+                    'UPDATE users SET password = ? WHERE username = ?',
+                    (hash_password(data['password'].strip()), username)
+                )
+                # 改密码后其他设备上的会话失效（管理员改自己的密码时保留当前会话）
+                revoke_sessions(username, keep=current_user()['session_id'])
+            if data.get('disabled') is not None:
+                conn.execute('UPDATE users SET disabled = ? WHERE username = ?', (int(bool(data['disabled'])), username))
+                if data['disabled']:
+                    revoke_sessions(username)
+        return jsonify({'success': True, 'message': '已更新'})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'操作失败: {str(e)}'})
+
+@app.route('/admin/profiles')
+@login_required
+@admin_required
+def admin_profiles():
+    """列出保存的请求剖析结果"""
+    rows = get_db().execute('SELECT * FROM profiles ORDER BY created_at DESC').fetchall()
+    return jsonify({'success': True, 'profiles': [{
+        'id': row['id'],
+        'username': row['username'],
+        'method': row['method'],
+        'path': row['path'],
+        'status': row['status'],
+        'duration': row['duration'],
+        'created_at': datetime.fromtimestamp(row['created_at']).isoformat()
+    } for row in rows]})
+
+@app.route('/admin/profiles/<profile_id>')
+@login_required
+@admin_required
+def admin_profile(profile_id):
+    """下载剖析结果：默认为 pstats 文件（可用 snakeviz、flameprof 等查看），format=text 时返回按累计耗时排序的摘要"""
+    if not re.fullmatch(r'[0-9a-f]{32}', profile_id):
+        return jsonify({'success': False, 'message': '无效的剖析ID'})
+    prof_path = os.path.abspath(os.path.join(PROFILES_FOLDER, f'{profile_id}.prof'))
+    if not os.path.exists(prof_path):
+        return jsonify({'success': False, 'message': '剖析结果不存在'})
+    if request.args.get('format') == 'text':
+        output = io.StringIO()
+        stats = pstats.Stats(prof_path, stream=output)
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            sort = 'cumulative'
+        stats.sort_stats(sort).print_stats(request.args.get('limit', 50, type=int))
+        return Response(output.getvalue(), mimetype='text/plain')
+    return send_file(prof_path, as_attachment=True, download_name=f'{profile_id}.prof')
+
+@app.cli.command('migrate-storage')
+def migrate_storage():
+    """将平铺布局下 uploads/ 中的现有文件迁移到分片布局（需先设置 STORAGE_LAYOUT = 'sharded'）"""
+    if STORAGE_LAYOUT != 'sharded':
+        print('请先将 STORAGE_LAYOUT 设置为 sharded')
+        return
+    
+    migrated = 0
+    for root, dirs, files in os.walk(UPLOAD_FOLDER, topdown=False):
+        rel_root = os.path.relpath(root, UPLOAD_FOLDER).replace(os.sep, '/')
+        if rel_root == '.':
+            rel_root = ''
+        parent = storage_makedirs(rel_root)
+        for file in files:
+            source = os.path.join(root, file)
+            logical = f'{rel_root}/{file}' if rel_root else file
+            object_id = uuid.uuid4().hex
+            physical = object_path(object_id)
+            os.makedirs(os.path.dirname(physical), exist_ok=True)
+            stat = os.stat(source)
+            # 同一文件系统内 rename 只修改目录项，不复制数据
+            os.rename(source, physical)
+            get_db().execute(
+                'INSERT OR REPLACE INTO nodes (parent, name, is_dir, size, mtime, object_id) VALUES (?, ?, 0, ?, ?, ?)',
+                (parent, file, stat.st_size, stat.st_mtime, object_id)
+            )
+            # 分片布局下校验和按对象ID记录
+            get_db().execute('UPDATE checksums SET path = ? WHERE path = ?', (object_id, logical))
+            migrated += 1
+        if root != UPLOAD_FOLDER:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+    # 目录汇总改按节点ID记录，重新统计
+    reconcile_dir_stats()
+    print(f'迁移完成，共 {migrated} 个文件')
+
 if __name__ == '__main__':
     # 开发环境配置
     app.run(host='0.0.0.0', port=5000, debug=False)
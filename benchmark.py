@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+网盘系统 - 热点接口基准测试
+
+在临时目录中生成合成目录树（深层嵌套、超宽目录、大量小文件、少量大文件），
+分别通过 Flask 测试客户端（进程内，不含网络开销）和本机 gunicorn 实例测量
+文件列表、存储信息、上传、下载、文件夹打包、分享查看、快传等接口，
+输出吞吐量和延迟分位数，并与保存的基线比较。
+
+用法：
+    python benchmark.py                          # 测试客户端和 gunicorn 都测，与基线比较
+    python benchmark.py --mode client            # 只用测试客户端
+    python benchmark.py --scenarios files-wide download-huge
+    python benchmark.py --save-baseline          # 将本次结果保存为基线
+    python benchmark.py --scale medium --duration 10
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode, urlsplit
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmark_baseline.json')
+ADMIN_USERNAME = 'root'
+ADMIN_PASSWORD = 'qaz341212'  # init_db 创建的默认管理员
+
+# 合成数据规模
+SCALES = {
+    'small': {'deep_depth': 20, 'wide_files': 2000, 'small_dirs': 20, 'small_files': 50,
+              'huge_files': 2, 'huge_size': 32 * 1024 * 1024, 'upload_size': 4 * 1024 * 1024},
+    'medium': {'deep_depth': 50, 'wide_files': 20000, 'small_dirs': 100, 'small_files': 100,
+               'huge_files': 3, 'huge_size': 256 * 1024 * 1024, 'upload_size': 32 * 1024 * 1024},
+    'large': {'deep_depth': 100, 'wide_files': 100000, 'small_dirs': 500, 'small_files': 200,
+              'huge_files': 3, 'huge_size': 2 * 1024 * 1024 * 1024, 'upload_size': 256 * 1024 * 1024},
+}
+
+REGRESSION_THRESHOLD = 0.15  # 与基线相比延迟增加或吞吐下降超过该比例时视为退化
+REJECTED_STATUSES = (429, 503)  # 准入控制的快速拒绝，单独计数，不计入延迟
+RANDOM_BLOCK = os.urandom(1024 * 1024)
+
+
+class SyntheticStream:
+    """生成指定长度的伪随机内容（重复一个随机块），不占用与文件大小相当的内存"""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = RANDOM_BLOCK
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > len(self.block):
+            n = len(self.block)
+        n = min(n, self.remaining)
+        self.remaining -= n
+        return self.block[:n]
+
+    def tell(self):
+        return 0
+
+    def seek(self, offset, whence=0):
+        return self.remaining if whence == os.SEEK_END else 0
+
+
+def build_tree(app_module, scale):
+    """通过存储层生成合成目录树（与 STORAGE_LAYOUT 无关），返回各场景用到的路径"""
+    from werkzeug.datastructures import FileStorage
+
+    app_module.UPLOAD_DURABILITY = 'none'  # 生成数据时不必逐个落盘
+
+    def save(path, size):
+        app_module.storage_save(FileStorage(stream=SyntheticStream(size), filename=path.rsplit('/', 1)[-1]), path)
+
+    started = time.time()
+    deep = 'bench/deep/' + '/'.join(f'd{i}' for i in range(scale['deep_depth']))
+    for i in range(10):
+        save(f'{deep}/f{i}.txt', 1024)
+    for i in range(scale['wide_files']):
+        save(f'bench/wide/f{i:06d}.bin', 512)
+    for d in range(scale['small_dirs']):
+        for i in range(scale['small_files']):
+            save(f'bench/small/d{d}/f{i}.bin', 1024 + (i * 97) % 3072)
+    for i in range(scale['huge_files']):
+        save(f'bench/huge/huge{i}.bin', scale['huge_size'])
+    app_module.storage_makedirs('bench/up')
+
+    app_module.UPLOAD_DURABILITY = 'fsync'
+    print(f'生成合成数据用时 {time.time() - started:.1f}s')
+    return {'deep': deep}
+
+
+def encode_multipart(fields, files):
+    """编码 multipart/form-data 请求体，files 为 [(字段名, 文件名, 内容)]"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        parts.append(content)
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def define_scenarios(paths, scale):
+    """场景：名称 -> 每次请求的 (方法, URL, 请求体, 请求头, 响应校验)；请求体等在首次用到时生成"""
+    upload_body = encode_multipart([('path', 'bench/up')], [('files', 'large.bin', os.urandom(scale['upload_size']))])
+    small_body = encode_multipart([('path', 'bench/up')], [('files', 'small.bin', os.urandom(4096))])
+    quick_body = encode_multipart([('uploader', 'bench')], [('files', 'quick.bin', os.urandom(64 * 1024))])
+    zip_body = urlencode([('path', 'bench/small'), ('files', 'd0'), ('files', 'd1')]).encode()
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    return {
+        'files-wide': ('GET', '/files?path=bench/wide', None, {}, b'"success":true'),
+        'files-deep': ('GET', '/files?' + urlencode({'path': paths['deep']}), None, {}, b'"success":true'),
+        'storage-info': ('GET', '/storage-info', None, {}, b'"success":true'),
+        'upload-small': ('POST', '/upload', small_body[0], {'Content-Type': small_body[1]}, b'"success":true'),
+        'upload-large': ('POST', '/upload', upload_body[0], {'Content-Type': upload_body[1]}, b'"success":true'),
+        'download-small': ('GET', '/download?path=bench/small/d0&filename=f0.bin', None, {}, None),
+        'download-huge': ('GET', '/download?path=bench/huge&filename=huge0.bin', None, {}, None),
+        'folder-zip': ('POST', '/batch-download', zip_body, form, None),
+        'share-view': ('GET', '/share/{share_id}', None, {}, 'wide'.encode()),
+        'quick-transfer-upload': ('POST', '/quick-transfer-upload', quick_body[0], {'Content-Type': quick_body[1]},
+                                  b'"success":true'),
+        'quick-transfer-list': ('GET', '/quick-transfer-files', None, {}, b'"success":true'),
+    }
+
+
+class ResponseSample:
+    """统计响应体字节数，只保留开头和结尾各 64KB 用于校验（如 JSON 末尾的 "success":true）"""
+
+    LIMIT = 65536
+
+    def __init__(self):
+        self.size = 0
+        self.head = b''
+        self.tail = b''
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        if len(self.head) < self.LIMIT:
+            self.head += chunk[:self.LIMIT - len(self.head)]
+        self.tail = (self.tail + chunk)[-self.LIMIT:]
+
+    def text(self):
+        return self.head if self.size <= self.LIMIT else self.head + self.tail
+
+
+class TestClientDriver:
+    """进程内 Flask 测试客户端（只测应用本身的开销）"""
+
+    name = 'client'
+
+    def __init__(self, app_module):
+        self.app_module = app_module
+        self.local = threading.local()
+
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app_module.app.test_client()
+            client.post('/login', json={'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        return client
+
+    def request(self, method, url, body=None, headers=None):
+        """发送请求，返回 (状态码, 用于校验的响应体片段, 响应体字节数)"""
+        response = self.client().open(url, method=method, data=body, headers=headers or {}, buffered=False)
+        sample = ResponseSample()
+        try:
+            for chunk in response.response:
+                sample.add(chunk)
+        finally:
+            response.close()
+        return response.status_code, sample.text(), sample.size
+
+
+class HttpDriver:
+    """通过 HTTP 访问本机 gunicorn（每个线程一个长连接）"""
+
+    name = 'gunicorn'
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+        self.cookie = None
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=300)
+        return conn
+
+    def login(self, username=ADMIN_USERNAME, password=ADMIN_PASSWORD):
+        body = json.dumps({'username': username, 'password': password}).encode()
+        conn = self.connection()
+        conn.request('POST', '/login', body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        self.cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {}, Cookie=self.cookie)
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                sample = ResponseSample()
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    sample.add(chunk)
+                return response.status, sample.text(), sample.size
+            except (http.client.HTTPException, ConnectionError):
+                # 工作进程因 max_requests 被回收时长连接会断开，重连一次
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+
+def load_gunicorn_config():
+    """读取 gunicorn_config.py 中的工作进程数、类型和线程数（部署相关的绑定地址、用户、日志等不使用）"""
+    config = {}
+    with open(os.path.join(REPO_DIR, 'gunicorn_config.py'), encoding='utf-8') as f:
+        exec(f.read(), config)
+    return {'workers': config.get('workers', 4), 'worker_class': config.get('worker_class', 'sync'),
+            'threads': config.get('threads', 1), 'timeout': config.get('timeout', 120)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, workers=None, worker_class=None, threads=None, env=None):
+    """在 workdir 中启动 gunicorn，等待可以连接后返回 (进程, 端口)；env 为额外传给应用的环境变量。
+    与 gunicorn_config.py 一样通过 NETDISK_WORKER_SLOTS 告知应用并发处理能力，准入控制的上限随之变化"""
+    config = load_gunicorn_config()
+    port = free_port()
+    workers = workers or config['workers']
+    worker_class = worker_class or config['worker_class']
+    threads = threads or (config['threads'] if worker_class == config['worker_class'] else 1)
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--pythonpath', REPO_DIR, '--chdir', workdir,
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--worker-class', worker_class,
+        '--threads', str(threads),
+        '--timeout', str(config['timeout']),
+        '--log-level', 'warning',
+    ]
+    env = dict(os.environ, NETDISK_WORKER_SLOTS=str(workers * threads), **(env or {}))
+    process = subprocess.Popen(command, cwd=workdir, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn 启动失败')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('等待 gunicorn 启动超时')
+
+
+def percentile(sorted_values, p):
+    """最近秩法求分位数"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def scenario_concurrency(app_module, scenario, concurrency):
+    """场景实际使用的并发数：所有线程共用一个登录用户，heavy 池的路由超出每用户并发上限的请求只会被 429 拒绝，按上限收窄"""
+    pool = app_module.admission_pool(urlsplit(scenario[1]).path)
+    limit = app_module.ADMISSION_USER_LIMITS.get(pool)
+    return concurrency if limit is None else min(concurrency, limit)
+
+
+def run_scenario(driver, scenario, duration, concurrency, min_requests=5):
+    """并发执行场景直到达到持续时间（且至少 min_requests 次），返回统计结果"""
+    method, url, body, headers, expect = scenario
+    driver.request(method, url, body, headers)  # 预热
+    latencies, errors, rejected, transferred = [], [0], [0], [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker():
+        while time.time() < deadline or len(latencies) + rejected[0] < min_requests:
+            started = time.perf_counter()
+            try:
+                status, head, size = driver.request(method, url, body, headers)
+                ok = status == 200 and (expect is None or expect in head)
+            except Exception:
+                status, ok, size = 0, False, 0
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status in REJECTED_STATUSES:
+                    rejected[0] += 1
+                    continue
+                latencies.append(elapsed)
+                transferred[0] += size + len(body or b'')
+                if not ok:
+                    errors[0] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rejected': rejected[0],
+        'concurrency': concurrency,
+        'rps': len(latencies) / wall,
+        'mb_per_s': transferred[0] / wall / 1024 / 1024,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0) * 1000,
+    }
+
+
+def compare(result, baseline):
+    """与基线比较，返回 (说明文字, 是否退化)"""
+    if not baseline:
+        return '（无基线）', False
+    changes, regressed = [], False
+    for key, higher_is_worse in (('p50_ms', True), ('p99_ms', True), ('rps', False)):
+        if not baseline.get(key):
+            continue
+        delta = (result[key] - baseline[key]) / baseline[key]
+        worse = delta > REGRESSION_THRESHOLD if higher_is_worse else delta < -REGRESSION_THRESHOLD
+        regressed = regressed or worse
+        changes.append(f'{key} {delta:+.0%}{" !" if worse else ""}')
+    return ', '.join(changes), regressed
+
+
+def print_results(mode, results, baseline):
+    print(f'\n== {mode} ==')
+    print(f'{"场景":<24}{"请求":>7}{"错误":>6}{"拒绝":>6}{"req/s":>9}{"MB/s":>9}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}  与基线比较')
+    regressions = []
+    for name, result in results.items():
+        text, regressed = compare(result, baseline.get(mode, {}).get(name))
+        if regressed:
+            regressions.append(f'{mode}/{name}')
+        print(f'{name:<24}{result["requests"]:>7}{result["errors"]:>6}{result.get("rejected", 0):>6}{result["rps"]:>9.1f}{result["mb_per_s"]:>9.1f}'
+              f'{result["p50_ms"]:>9.1f}{result["p90_ms"]:>9.1f}{result["p99_ms"]:>9.1f}{result["max_ms"]:>9.1f}  {text}')
+    return regressions
+
+
+def prepare_shares(driver, scenarios):
+    """通过当前驱动创建分享，填入分享查看场景的 URL"""
+    if 'share-view' not in scenarios:
+        return
+    status, head, _ = driver.request('POST', '/create-share', json.dumps({'path': 'bench', 'files': ['wide']}).encode(),
+                                     {'Content-Type': 'application/json'})
+    share_id = json.loads(head)['share_id']
+    method, url, body, headers, expect = scenarios['share-view']
+    scenarios['share-view'] = (method, url.format(share_id=share_id), body, headers, expect)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='网盘系统热点接口基准测试')
+    parser.add_argument('--mode', choices=('client', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--scenarios', nargs='*', help='只运行指定场景')
+    parser.add_argument('--duration', type=float, default=5, help='每个场景的持续时间（秒）')
+    parser.add_argument('--concurrency', type=int, default=4, help='gunicorn 模式下的并发客户端线程数')
+    parser.add_argument('--workers', type=int, help='gunicorn 工作进程数（默认取 gunicorn_config.py）')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基线文件路径')
+    parser.add_argument('--save-baseline', action='store_true', help='将本次结果写入基线文件')
+    parser.add_argument('--fail-on-regression', action='store_true', help='有场景退化时以非零状态退出')
+    parser.add_argument('--keep', action='store_true', help='保留临时数据目录')
+    args = parser.parse_args()
+
+    config = load_gunicorn_config()
+    # 与 start_gunicorn 传给 gunicorn 实例的并发处理能力一致，进程内导入的应用算出的准入上限与之相同
+    os.environ['NETDISK_WORKER_SLOTS'] = str((args.workers or config['workers']) * config['threads'])
+    workdir = tempfile.mkdtemp(prefix='netdisk-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module  # 在临时目录中导入，数据库和存储目录都建在这里
+
+    scale = SCALES[args.scale]
+    paths = build_tree(app_module, scale)
+    all_scenarios = define_scenarios(paths, scale)
+    names = args.scenarios or list(all_scenarios)
+    unknown = [name for name in names if name not in all_scenarios]
+    if unknown:
+        parser.error(f'未知场景: {", ".join(unknown)}')
+
+    try:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+
+    results, regressions, failures, process = {}, [], [], None
+    try:
+        modes = ['client', 'gunicorn'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            if mode == 'client':
+                driver, concurrency = TestClientDriver(app_module), 1
+            else:
+                process, port = start_gunicorn(workdir, args.workers)
+                driver, concurrency = HttpDriver(port), args.concurrency
+                driver.login()
+            scenarios = {name: all_scenarios[name] for name in names}
+            prepare_shares(driver, scenarios)
+            results[mode] = {}
+            for name, scenario in scenarios.items():
+                results[mode][name] = run_scenario(driver, scenario, args.duration,
+                                                   scenario_concurrency(app_module, scenario, concurrency))
+            regressions += print_results(mode, results[mode], baseline)
+            narrowed = [f'{name} {result["concurrency"]}' for name, result in results[mode].items()
+                        if result['concurrency'] < concurrency]
+            if narrowed:
+                print(f'按每用户并发上限收窄了并发数的场景: {", ".join(narrowed)}')
+            failures += [f'{mode}/{name}' for name, result in results[mode].items() if result['errors']]
+            rejected = [f'{name} {result["rejected"]}' for name, result in results[mode].items() if result['rejected']]
+            if rejected:
+                # 客户端收到完整响应时服务端可能还没释放准入槽，并发数等于上限时偶有拒绝
+                print(f'被准入控制拒绝的请求（单独计数，不计入延迟和吞吐）: {", ".join(rejected)}')
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    meta = {'scale': args.scale, 'duration': args.duration, 'concurrency': args.concurrency,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if args.save_baseline:
+        # 有失败请求的结果测到的是错误处理的速度，不能作为基线
+        for mode, mode_results in results.items():
+            baseline.setdefault(mode, {}).update(
+                {name: result for name, result in mode_results.items() if not result['errors']}
+            )
+        baseline['meta'] = meta
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+        print(f'\n已保存基线: {args.baseline}')
+    elif baseline.get('meta') and baseline['meta'].get('scale') != args.scale:
+        print(f'\n注意：基线使用的规模为 {baseline["meta"]["scale"]}，与本次不同，比较结果仅供参考')
+
+    if regressions:
+        print(f'\n退化的场景: {", ".join(regressions)}')
+    if failures:
+        print(f'\n有请求失败的场景（结果无效，未写入基线）: {", ".join(failures)}')
+    if failures or (regressions and args.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
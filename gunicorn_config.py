@@ -6,8 +6,12 @@ bind = "0.0.0.0:5000"
 # 工作进程数量
 workers = 4
 
-# 工作类型
-worker_class = "sync"
+# 工作类型：gthread 每个进程用多个线程处理请求，长时间的下载、上传和进度推送不会占满所有工作进程
+worker_class = "gthread"
+threads = 4
+
+# 所有工作进程合计的并发处理能力，应用据此计算准入控制各池的上限（ADMISSION_POOLS）
+raw_env = [f"NETDISK_WORKER_SLOTS={workers * threads}"]
 
 # 超时设置
 timeout = 120
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+网盘系统 - 混合流量负载测试
+
+按 gunicorn_config.py 的配置（可用参数覆盖工作进程数和类型）在本机启动 gunicorn，
+用多个本地客户端进程模拟真实的混合流量：大量用户浏览 /files、少量大文件上传、
+分享链接被集中访问、快传频繁上传和查看。需要登录的客户端各自使用一个测试用户（由管理员创建，
+浏览用的目录树从合成数据复制到各用户空间），与真实流量一样受每用户并发上限的约束。负载按 --levels 逐级加倍，每级统计各类请求的
+吞吐量和尾延迟，并从 /metrics 读取工作进程忙碌率，报告饱和点和工作进程饥饿情况，
+用于在流量高峰前确定工作进程数和类型。
+
+用法：
+    python load_test.py                                   # 默认混合流量，负载 1/2/4/8 倍
+    python load_test.py --worker-class gthread --threads 8
+    python load_test.py --browsers 20 --uploaders 2 --levels 1 2 4 8 16 --step-duration 30
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import http.client
+import multiprocessing
+from urllib.parse import urlencode
+
+from benchmark import (SCALES, HttpDriver, build_tree, encode_multipart, load_gunicorn_config,
+                       percentile, start_gunicorn)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 各类客户端：(说明, 默认思考时间（秒）)
+PERSONAS = {
+    'browse': ('浏览文件列表', 0.5),
+    'upload': ('上传大文件', 1.0),
+    'share': ('访问分享链接', 0.0),
+    'quick': ('快传上传与查看', 0.2),
+}
+LOGIN_PERSONAS = ('browse', 'upload')  # 需要登录的客户端，每个客户端一个测试用户
+BROWSE_DIRS = ('wide', 'small', 'deep')  # 复制到测试用户空间的合成目录（大文件目录不复制）
+USER_PASSWORD = 'load-test-password'
+METRICS_FLUSH_INTERVAL = 0.5  # 测试期间工作进程写指标快照的间隔（秒），远小于统计窗口，忙碌率才按窗口计算
+
+SATURATION_GAIN = 1.1  # 负载加倍后吞吐增长低于该倍数视为已饱和
+STARVATION_BUSY = 0.9  # 工作进程忙碌率超过该值且浏览请求尾延迟显著上升时视为饥饿
+STARVATION_SLOWDOWN = 5  # 浏览请求 p99 相对最低负载级别放大的倍数
+REJECTED_STATUSES = (429, 503)  # 准入控制的快速拒绝
+
+
+def persona_requests(persona, rng, context):
+    """生成某类客户端一轮要发送的请求：[(类别, 方法, URL, 请求体, 请求头)]"""
+    if persona == 'browse':
+        if rng.random() < 0.2:
+            return [('browse', 'GET', '/storage-info', None, {})]
+        path = rng.choice(context['browse_paths'])
+        return [('browse', 'GET', '/files?' + urlencode({'path': path}), None, {})]
+    if persona == 'upload':
+        body, content_type = context['upload_body']
+        return [('upload', 'POST', '/upload', body, {'Content-Type': content_type})]
+    if persona == 'share':
+        return [('share', 'GET', f'/share/{context["share_id"]}', None, {})]
+    body, content_type = context['quick_body']
+    return [('quick', 'POST', '/quick-transfer-upload', body, {'Content-Type': content_type}),
+            ('quick', 'GET', '/quick-transfer-files', None, {})]
+
+
+def client_process(persona, port, cookie, context, think, seed, stop, results):
+    """客户端进程：循环发送请求直到 stop 被设置，每个请求的结果放入 results 队列；cookie 为该客户端用户的会话"""
+    rng = random.Random(seed)
+    driver = HttpDriver(port)
+    driver.cookie = cookie
+    if persona == 'upload':
+        context['upload_body'] = encode_multipart(
+            [('path', 'bench/up')], [('files', f'load-{seed}.bin', os.urandom(context['upload_size']))])
+    elif persona == 'quick':
+        context['quick_body'] = encode_multipart(
+            [('uploader', 'load')], [('files', f'quick-{seed}.bin', os.urandom(256 * 1024))])
+    while not stop.is_set():
+        for kind, method, url, body, headers in persona_requests(persona, rng, context):
+            started = time.time()
+            try:
+                status, _, size = driver.request(method, url, body, headers)
+            except Exception:
+                status, size = 0, 0
+            results.put((kind, started, time.time() - started, status, size))
+        if think:
+            stop.wait(rng.expovariate(1 / think))
+
+
+def scrape_busy(driver):
+    """读取 /metrics 中所有工作进程累计的忙碌时间和运行时间（完整读取响应，不经过 ResponseSample 截断）。
+    两次读取之间隔着整个统计窗口，长连接早已被 gunicorn 关闭，每次新建连接"""
+    conn = http.client.HTTPConnection('127.0.0.1', driver.port, timeout=60)
+    try:
+        conn.request('GET', '/metrics', headers={'Cookie': driver.cookie})
+        text = conn.getresponse().read().decode()
+    finally:
+        conn.close()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith(('netdisk_worker_busy_seconds_total ', 'netdisk_worker_uptime_seconds_total ')):
+            name, value = line.split()
+            values[name] = float(value)
+    return values.get('netdisk_worker_busy_seconds_total', 0), values.get('netdisk_worker_uptime_seconds_total', 0)
+
+
+def prepare_users(admin, counts):
+    """为每个需要登录的客户端创建测试用户并登录，返回 {类别: [会话 Cookie]}；
+    浏览用户的目录树在启动前已由 copy_browse_trees 复制到其空间"""
+    cookies = {}
+    for persona in LOGIN_PERSONAS:
+        cookies[persona] = []
+        for i in range(counts[persona]):
+            username = f'load-{persona}-{i}'
+            _, text, _ = admin.request('POST', '/admin/users', json.dumps(
+                {'username': username, 'password': USER_PASSWORD}).encode(), {'Content-Type': 'application/json'})
+            if b'"success":true' not in text:
+                raise RuntimeError(f'创建测试用户 {username} 失败: {text.decode()}')
+            driver = HttpDriver(admin.port)
+            driver.login(username, USER_PASSWORD)
+            cookies[persona].append(driver.cookie)
+    return cookies
+
+
+def copy_browse_trees(app_module, count):
+    """把合成目录复制到各浏览用户的空间（启动 gunicorn 之前通过存储层进行）"""
+    started = time.time()
+    for i in range(count):
+        for name in BROWSE_DIRS:
+            app_module.storage_copy(f'bench/{name}', f'{app_module.USERS_DIR}/load-browse-{i}/bench/{name}')
+    print(f'为 {count} 个浏览用户复制目录树用时 {time.time() - started:.1f}s')
+
+
+def run_level(ctx, port, cookies, context, counts, think_scale, duration, admin):
+    """以给定的各类客户端数运行一级负载，返回按类别汇总的结果和工作进程忙碌率"""
+    stop = ctx.Event()
+    results = ctx.Queue()
+    processes = []
+    seed = 0
+    for persona, count in counts.items():
+        for i in range(count):
+            seed += 1
+            cookie = cookies[persona][i] if persona in cookies else ''
+            process = ctx.Process(target=client_process, daemon=True, args=(
+                persona, port, cookie, dict(context), PERSONAS[persona][1] * think_scale, seed, stop, results))
+            process.start()
+            processes.append(process)
+
+    time.sleep(min(2.0, duration / 5))  # 等客户端进程启动完毕再开始计时
+    busy_before, uptime_before = scrape_busy(admin)
+    window_start = time.time()
+    time.sleep(duration)
+    window_end = time.time()
+    busy_after, uptime_after = scrape_busy(admin)
+    stop.set()
+
+    samples = []
+    deadline = time.time() + 30
+    while any(p.is_alive() for p in processes) or not results.empty():
+        try:
+            samples.append(results.get(timeout=0.5))
+        except Exception:
+            if time.time() > deadline:
+                break
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    by_kind = {}
+    for kind, started, latency, status, size in samples:
+        if window_start <= started < window_end:
+            by_kind.setdefault(kind, []).append((latency, status, size))
+    summary = {}
+    for kind, all_rows in by_kind.items():
+        # 准入控制快速拒绝（429/503）的请求单独计数，不计入吞吐和延迟
+        rows = [row for row in all_rows if row[1] not in REJECTED_STATUSES] or all_rows
+        latencies = sorted(row[0] for row in rows)
+        summary[kind] = {
+            'requests': len(all_rows),
+            'rejected': sum(1 for row in all_rows if row[1] in REJECTED_STATUSES),
+            'errors': sum(1 for row in all_rows if row[1] != 200 and row[1] not in REJECTED_STATUSES),
+            'rps': sum(1 for row in all_rows if row[1] == 200) / duration,
+            'mb_per_s': sum(row[2] for row in rows) / duration / 1024 / 1024,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+    uptime = uptime_after - uptime_before
+    busy_ratio = (busy_after - busy_before) / uptime if uptime > 0 else 0
+    return summary, busy_ratio
+
+
+def print_level(multiplier, counts, summary, busy_ratio):
+    clients = ', '.join(f'{persona} {count}' for persona, count in counts.items() if count)
+    total_rps = sum(item['rps'] for item in summary.values())
+    print(f'\n== 负载 x{multiplier}（{clients}）  总吞吐 {total_rps:.1f} req/s  工作进程忙碌率 {busy_ratio:.0%} ==')
+    print(f'{"类别":<10}{"请求":>8}{"拒绝":>7}{"错误":>7}{"req/s":>9}{"MB/s":>9}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}')
+    for kind, item in sorted(summary.items()):
+        print(f'{kind:<10}{item["requests"]:>8}{item["rejected"]:>7}{item["errors"]:>7}{item["rps"]:>9.1f}{item["mb_per_s"]:>9.1f}'
+              f'{item["p50_ms"]:>9.1f}{item["p95_ms"]:>9.1f}{item["p99_ms"]:>9.1f}{item["max_ms"]:>9.1f}')
+
+
+def analyze(levels):
+    """根据各级结果找出饱和点和工作进程饥饿"""
+    findings = []
+    saturated = None
+    for (prev_mult, prev, _), (mult, current, _) in zip(levels, levels[1:]):
+        prev_rps = sum(item['rps'] for item in prev.values())
+        rps = sum(item['rps'] for item in current.values())
+        if saturated is None and prev_rps > 0 and rps / prev_rps < SATURATION_GAIN:
+            saturated = prev_mult
+            findings.append(f'饱和点：负载 x{prev_mult}（{prev_rps:.1f} req/s），加到 x{mult} 后吞吐只有 {rps:.1f} req/s')
+    if saturated is None:
+        findings.append('在测试的负载范围内吞吐仍随负载增长，尚未饱和')
+
+    base_browse = levels[0][1].get('browse')
+    for mult, summary, busy_ratio in levels:
+        browse = summary.get('browse')
+        if not base_browse or not browse or not base_browse['p99_ms']:
+            continue
+        slowdown = browse['p99_ms'] / base_browse['p99_ms']
+        if busy_ratio >= STARVATION_BUSY and slowdown >= STARVATION_SLOWDOWN:
+            findings.append(f'工作进程饥饿：负载 x{mult} 时忙碌率 {busy_ratio:.0%}，浏览请求 p99 放大 {slowdown:.1f} 倍'
+                            f'（{browse["p99_ms"]:.0f}ms），轻量请求在排队等待上传/下载占用的工作进程')
+            break
+    errors = [(mult, kind, item['errors'], item['requests']) for mult, summary, _ in levels
+              for kind, item in summary.items() if item['errors']]
+    for mult, kind, count, total in errors:
+        findings.append(f'负载 x{mult} 时 {kind} 有 {count}/{total} 个请求失败')
+    for mult, summary, _ in levels:
+        rejected = {kind: item['rejected'] for kind, item in summary.items() if item['rejected']}
+        if rejected:
+            findings.append(f'负载 x{mult} 时准入控制拒绝了 ' + '、'.join(f'{kind} {count} 个' for kind, count in rejected.items()) +
+                            '请求（429/503），可对照 ADMISSION_POOLS 调整')
+            break
+    return findings
+
+
+def main():
+    config = load_gunicorn_config()
+    parser = argparse.ArgumentParser(description='网盘系统混合流量负载测试')
+    parser.add_argument('--workers', type=int, default=config['workers'], help='默认取 gunicorn_config.py')
+    parser.add_argument('--worker-class', default=config['worker_class'], help='默认取 gunicorn_config.py')
+    parser.add_argument('--threads', type=int, help='gthread 工作进程的线程数，未指定工作进程类型时默认取 gunicorn_config.py')
+    parser.add_argument('--browsers', type=int, default=8, help='x1 负载下浏览文件列表的客户端数')
+    parser.add_argument('--uploaders', type=int, default=1, help='x1 负载下上传大文件的客户端数')
+    parser.add_argument('--share-clients', type=int, default=4, help='x1 负载下访问分享链接的客户端数')
+    parser.add_argument('--quick-clients', type=int, default=2, help='x1 负载下使用快传的客户端数')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2, 4, 8], help='依次运行的负载倍数')
+    parser.add_argument('--step-duration', type=float, default=15, help='每级负载的统计时长（秒）')
+    parser.add_argument('--think-scale', type=float, default=1.0, help='思考时间的缩放系数，0 表示不停顿')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='合成数据规模（同 benchmark.py）')
+    parser.add_argument('--output', help='将各级结果写入 JSON 文件')
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = config['threads'] if args.worker_class == config['worker_class'] else 1
+
+    workdir = tempfile.mkdtemp(prefix='netdisk-load-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+
+    scale = SCALES[args.scale]
+    paths = build_tree(app_module, scale)
+    browse_paths = ['bench', 'bench/wide', paths['deep']] + [f'bench/small/d{i}' for i in range(scale['small_dirs'])]
+    base = {'browse': args.browsers, 'upload': args.uploaders, 'share': args.share_clients,
+            'quick': args.quick_clients}
+    most = {persona: count * max(args.levels) for persona, count in base.items()}
+    copy_browse_trees(app_module, most['browse'])
+
+    print(f'gunicorn: {args.workers} 个 {args.worker_class} 工作进程' +
+          (f'，每个 {args.threads} 线程' if args.threads > 1 else ''))
+    process, port = start_gunicorn(workdir, args.workers, args.worker_class, args.threads,
+                                   {'NETDISK_METRICS_FLUSH_INTERVAL': str(METRICS_FLUSH_INTERVAL)})
+    ctx = multiprocessing.get_context('spawn')
+    levels = []
+    try:
+        admin = HttpDriver(port)
+        admin.login()
+        cookies = prepare_users(admin, most)
+        context = {'browse_paths': browse_paths, 'upload_size': scale['upload_size']}
+        if args.share_clients:
+            _, text, _ = admin.request('POST', '/create-share', json.dumps({'path': 'bench', 'files': ['wide']}).encode(),
+                                       {'Content-Type': 'application/json'})
+            context['share_id'] = json.loads(text)['share_id']
+        for multiplier in args.levels:
+            counts = {persona: count * multiplier for persona, count in base.items()}
+            summary, busy_ratio = run_level(ctx, port, cookies, context, counts, args.think_scale,
+                                            args.step_duration, admin)
+            print_level(multiplier, counts, summary, busy_ratio)
+            levels.append((multiplier, summary, busy_ratio))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('\n== 结论 ==')
+    for finding in analyze(levels):
+        print('- ' + finding)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': {'workers': args.workers, 'worker_class': args.worker_class, 'threads': args.threads},
+                       'levels': [{'multiplier': m, 'busy_ratio': b, 'results': s} for m, s, b in levels]},
+                      f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()